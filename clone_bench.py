@@ -0,0 +1,590 @@
+import argparse
+import contextlib
+import itertools
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Benchmarks import clone_network from a scratch directory so its log files
+# and databases never touch the real ones.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+@contextlib.contextmanager
+def _scratch_dir():
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            yield tmp
+        finally:
+            os.chdir(cwd)
+
+
+def _timeit(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def bench_merge(sizes, batch, sample):
+    """Compare list scans with the hash index when merging peer entries."""
+    from clone_network import LogStream
+    from clone_record import encode, make
+    from clone_store import FileStore
+
+    print(f"{'local':>10} {'list us/entry':>14} {'index us/entry':>15} {'speedup':>9}")
+    for size in sizes:
+        entries = [encode(make('bench', f"clone-{i % 50}", {'text': f"message {i}"}))
+                   for i in range(size + batch // 2)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'stream.log')
+            with open(path, 'w') as f:
+                f.writelines(entry + "\n" for entry in entries[:size])
+            stream = LogStream('bench', FileStore({'bench': path}))
+            local = stream.snapshot()
+            # Half of the remote batch is already known locally.
+            remote = entries[size - batch // 2:]
+
+            probe = remote[:sample]
+            list_cost = _timeit(lambda: [e for e in probe if e not in local]) / len(probe)
+            index_cost = _timeit(lambda: [stream.merge(e) for e in remote]) / len(remote)
+        speedup = list_cost / index_cost if index_cost else float('inf')
+        print(f"{size:>10} {list_cost * 1e6:>14.2f} {index_cost * 1e6:>15.2f} {speedup:>8.0f}x")
+
+
+def bench_memory(count, window, width):
+    """Compare memory held by a stream with and without a hot window."""
+    import tracemalloc
+    from clone_network import LogStream
+    from clone_record import encode, make
+    from clone_store import FileStore
+
+    print(f"{'window':>8} {'held MiB':>9} {'hot page ms':>12} {'cold page ms':>13}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'stream.log')
+        with open(path, 'w') as f:
+            for i in range(count):
+                f.write(encode(make('bench', f"clone-{i % 50}", {'text': f"{'x' * width} {i}"})) + "\n")
+        for hot in (0, window):
+            store = FileStore({'bench': path}, segment_bytes=16 * 1024 * 1024)
+            tracemalloc.start()
+            stream = LogStream('bench', store, hot_limit=hot)
+            held = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            recent = _timeit(lambda: stream.since(count - 100, 100))
+            old = _timeit(lambda: stream.since(count // 2, 100))
+            label = hot or 'all'
+            print(f"{label:>8} {held / 2 ** 20:>9.1f} {recent * 1e3:>12.2f} {old * 1e3:>13.2f}")
+
+
+def bench_search(count, queries):
+    """Index ``count`` entries and time ranked /search queries against them."""
+    from clone_search import SearchIndex
+
+    # Word frequencies follow Zipf's law, like real text: a few words are in
+    # most entries and the long tail is rare.
+    words = ['glitch', 'orbit', 'lattice', 'ember', 'quartz', 'signal', 'harbor',
+             'violet', 'cipher', 'meadow', 'vector', 'summit', 'falcon', 'drift']
+    words += [f"term{i}" for i in range(20000)]
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    rng = random.Random(7)
+    with tempfile.TemporaryDirectory() as tmp:
+        index = SearchIndex(os.path.join(tmp, 'search.db'))
+        start = time.perf_counter()
+        for first in range(1, count + 1, 5000):
+            index.add('messages', [
+                (seq, f"clone-{seq % 50}: " + ' '.join(rng.choices(words, cum_weights=weights, k=12)) + f" {seq}")
+                for seq in range(first, min(first + 5000, count + 1))
+            ])
+        took = time.perf_counter() - start
+        print(f"indexed {count} entries in {took:.1f}s ({count / took:.0f}/s)")
+        print(f"{'query':>24} {'p50 ms':>8} {'p99 ms':>8}")
+        for query in ('glitch', 'glitch orbit ember', 'cip*', '"quartz signal"', f"{count // 2}"):
+            latencies = []
+            for _ in range(queries):
+                start = time.perf_counter()
+                index.search(query, ['messages'], limit=20)
+                latencies.append(time.perf_counter() - start)
+            print(f"{query:>24} {_percentile(latencies, 50) * 1e3:>8.2f} "
+                  f"{_percentile(latencies, 99) * 1e3:>8.2f}")
+
+
+def bench_sanitize(sizes, counts, runs):
+    """Compare one re.sub per pattern with the firewall's prefiltered pass."""
+    import re
+    import firewall
+
+    words = ['glitch', 'orbit', 'lattice', 'ember', 'quartz', 'signal', 'harbor',
+             'violet', 'cipher', 'meadow', 'vector', 'summit', 'falcon', 'drift']
+    rng = random.Random(7)
+    print(f"{'chars':>7} {'patterns':>9} {'message':>8} {'per-regex us':>13} "
+          f"{'prefilter us':>13} {'speedup':>8}")
+    for count in counts:
+        # Extra patterns look like ones a deployment would add.
+        extra = [rf"project[_-]?{i}\b" for i in range(max(0, count - len(firewall.DEFAULT_PATTERNS)))]
+        patterns = extra + firewall.DEFAULT_PATTERNS
+        regexes = [re.compile(p, re.IGNORECASE) for p in patterns]
+        rules = firewall._compile(patterns)
+
+        def sequential(text):
+            for regex in regexes:
+                text = regex.sub(firewall.BLOCKED, text)
+            return text
+
+        for size in sizes:
+            clean = ' '.join(rng.choice(words) for _ in range(size // 5))[:size]
+            middle = len(clean) // 2
+            dirty = clean[:middle] + ' my password is sk-' + 'A' * 40 + ' ' + clean[middle:]
+            for label, text in (('clean', clean), ('secret', dirty)):
+                assert sequential(text) == firewall._apply(rules, text)
+                before = _timeit(lambda: [sequential(text) for _ in range(runs)]) / runs
+                after = _timeit(lambda: [firewall._apply(rules, text) for _ in range(runs)]) / runs
+                print(f"{size:>7} {len(patterns):>9} {label:>8} {before * 1e6:>13.1f} "
+                      f"{after * 1e6:>13.1f} {before / after:>7.1f}x")
+
+
+def bench_ratelimit(sizes, checks):
+    """Time a rate limit check and charge by the number of tracked clones."""
+    from clone_ratelimit import RateLimiter
+
+    print(f"{'clones':>9} {'checks':>9} {'us/check':>9} {'throttled':>10}")
+    for size in sizes:
+        limiter = RateLimiter(100.0, 200.0, max_keys=size)
+        keys = [f"clone-{i}" for i in range(size)]
+        for key in keys:
+            limiter.charge({key: 1})
+        rng = random.Random(7)
+        # Every tenth check comes from one noisy clone.
+        picks = [keys[0] if i % 10 == 0 else rng.choice(keys) for i in range(checks)]
+
+        def run():
+            for key in picks:
+                costs = {key: 1}
+                if not limiter.wait(costs):
+                    limiter.charge(costs)
+
+        elapsed = _timeit(run)
+        print(f"{size:>9} {checks:>9} {elapsed / checks * 1e6:>9.2f} {limiter.throttled:>10}")
+
+
+def _write_through_keyword_stats(cn):
+    """Return the per-message keyword writer /send used before write-behind."""
+    def update(clone_id, text):
+        words = text.lower().split()
+        stats = cn.keyword_stats.setdefault(clone_id, {k: 0 for k in cn.KEYWORDS})
+        updates = {}
+        for kw in cn.KEYWORDS:
+            inc = sum(1 for w in words if kw in w)
+            if inc:
+                stats[kw] += inc
+                updates[kw] = stats[kw]
+        if updates:
+            cn._ensure_db()
+            conn = sqlite3.connect(cn.DB_NAME)
+            for kw, count in updates.items():
+                conn.execute(
+                    "INSERT INTO keyword_usage (clone_id, keyword, count) "
+                    "VALUES (?, ?, ?) "
+                    "ON CONFLICT(clone_id, keyword) DO UPDATE SET count=excluded.count",
+                    (clone_id, kw, count),
+                )
+            conn.commit()
+            conn.close()
+    return update
+
+
+def bench_send(count, clones):
+    """Measure /send throughput with write-through and write-behind stats."""
+    with _scratch_dir():
+        import clone_network as cn
+
+        client = cn.app.test_client()
+        write_behind = cn._update_keyword_stats
+
+        def run():
+            for i in range(count):
+                client.post('/send?forwarded=1', json={
+                    'id': f"clone-{i % clones}",
+                    'message': f"glitch in the frequency {i}",
+                })
+
+        print(f"{'mode':>14} {'requests':>9} {'req/s':>9}")
+        for mode, update in (('write-through', _write_through_keyword_stats(cn)),
+                             ('write-behind', write_behind)):
+            cn._update_keyword_stats = update
+            elapsed = _timeit(run)
+            print(f"{mode:>14} {count:>9} {count / elapsed:>9.0f}")
+        cn._update_keyword_stats = write_behind
+        cn._flush_keyword_stats()
+
+
+@contextlib.contextmanager
+def _cluster(count, base_port, env=None):
+    """Run ``count`` clone servers on localhost, each peered with the rest.
+
+    Every server gets its own scratch directory. Yields the server URLs once
+    all of them answer and have every peer on their active list.
+    """
+    import requests
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clone_network.py')
+    urls = [f"http://127.0.0.1:{base_port + i}" for i in range(count)]
+    procs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            for i, url in enumerate(urls):
+                node_dir = os.path.join(tmp, f"node{i}")
+                os.mkdir(node_dir)
+                node_env = dict(os.environ, **(env or {}))
+                node_env['CLONE_PORT'] = str(base_port + i)
+                node_env['CLONE_PUBLIC_URL'] = url
+                node_env['SERVER_ENDPOINTS'] = ','.join(u for u in urls if u != url)
+                procs.append(subprocess.Popen(
+                    [sys.executable, script], cwd=node_dir, env=node_env,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                ))
+            # Servers that started early drop peers that were not up yet and
+            # pick them up again on a later sync round.
+            deadline = time.time() + 60
+            waiting = set(urls)
+            while waiting and time.time() < deadline:
+                for url in list(waiting):
+                    try:
+                        stats = requests.get(f"{url}/stats", timeout=2).json()
+                        if not stats['lost_endpoints']:
+                            waiting.discard(url)
+                    except Exception:
+                        pass
+                time.sleep(0.2)
+            if waiting:
+                raise RuntimeError(f"servers not ready: {sorted(waiting)}")
+            yield urls
+        finally:
+            for proc in procs:
+                proc.terminate()
+            for proc in procs:
+                proc.wait()
+
+
+def bench_batch(count, size, base_port, timeout):
+    """Compare one /remember per fact with /remember/batch on a server pair."""
+    import requests
+
+    facts = [f"fact {i} about the lattice" for i in range(count)]
+    with _cluster(2, base_port) as urls:
+        url, peer = urls
+        session = requests.Session()
+
+        def single():
+            for fact in facts:
+                session.post(f"{url}/remember", json={'id': 'bench', 'fact': fact},
+                             timeout=10).raise_for_status()
+
+        def batched():
+            for i in range(0, count, size):
+                session.post(f"{url}/remember/batch",
+                             json={'id': 'bench', 'items': facts[i:i + size]},
+                             timeout=60).raise_for_status()
+
+        print(f"{'mode':>14} {'facts':>7} {'facts/s':>9} {'requests':>9} "
+              f"{'replicated s':>13} {'peer posts':>11}")
+        expected = 0
+        for mode, fn, requests_made in (('single', single, count),
+                                        (f"batch of {size}", batched, -(-count // size))):
+            posts = session.get(f"{url}/stats").json()['replication']['batches'].get(peer, 0)
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            expected += count
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                if session.get(f"{peer}/stats").json()['streams'].get('memories', 0) >= expected:
+                    break
+                time.sleep(0.05)
+            replicated = time.perf_counter() - start
+            posts = session.get(f"{url}/stats").json()['replication']['batches'].get(peer, 0) - posts
+            print(f"{mode:>14} {count:>7} {count / elapsed:>9.0f} {requests_made:>9} "
+                  f"{replicated:>13.2f} {posts:>11}")
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def bench_gossip(nodes, fanouts, messages, base_port, timeout, sync_interval):
+    """Measure how fast one write reaches every server, by gossip fanout."""
+    import requests
+
+    print(f"{'fanout':>8} {'nodes':>6} {'p50 ms':>8} {'p99 ms':>8} {'converged':>10} "
+          f"{'copies/write':>13} {'busiest node':>13}")
+    for fanout in fanouts:
+        env = {
+            'SERVER_GOSSIP_FANOUT': str(fanout),
+            'SERVER_SYNC_INTERVAL': str(sync_interval),
+        }
+        with _cluster(nodes, base_port, env) as urls, \
+                ThreadPoolExecutor(max_workers=min(32, nodes)) as pool:
+            sessions = {url: requests.Session() for url in urls}
+
+            def count(url):
+                stats = sessions[url].get(f"{url}/stats", timeout=5).json()
+                return url, stats['streams']['messages']
+
+            times = []
+            for i in range(messages):
+                origin = random.choice(urls)
+                start = time.perf_counter()
+                sessions[origin].post(f"{origin}/send", json={'id': 'bench', 'message': f"gossip {i}"})
+                pending = set(urls)
+                while pending and time.perf_counter() - start < timeout:
+                    for url, seen in pool.map(count, list(pending)):
+                        if seen > i:
+                            pending.discard(url)
+                if not pending:
+                    times.append(time.perf_counter() - start)
+                else:
+                    # Let pull sync repair the stragglers before the next write.
+                    while pending:
+                        time.sleep(0.1)
+                        pending = {url for url, seen in pool.map(count, pending) if seen <= i}
+
+            sent = [sum(sessions[url].get(f"{url}/stats").json()['replication']['sent'].values())
+                    for url in urls]
+        label = fanout if fanout > 0 else 'mesh'
+        print(f"{label:>8} {nodes:>6} {_percentile(times, 50) * 1e3:>8.1f} "
+              f"{_percentile(times, 99) * 1e3:>8.1f} {len(times):>5}/{messages:<4} "
+              f"{sum(sent) / messages:>13.1f} {max(sent) / messages:>13.1f}")
+
+
+LOAD_OPS = ('send', 'remember', 'read', 'memories', 'task', 'assign')
+
+
+def _parse_mix(text):
+    """Parse ``send=60,read=30,...`` into op weights."""
+    mix = {}
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        op, _, weight = part.partition('=')
+        op = op.strip()
+        if op not in LOAD_OPS:
+            raise SystemExit(f"unknown op {op!r}; choose from {', '.join(LOAD_OPS)}")
+        mix[op] = float(weight or 1)
+    return mix
+
+
+def _load_worker(url, clone_id, mix, deadline, tail):
+    """Run one simulated clone until ``deadline``.
+
+    Returns ``(op, seconds, ok)`` samples, the number of tasks created and
+    the ids of the tasks it was assigned.
+    """
+    import requests
+
+    session = requests.Session()
+    ops, weights = zip(*mix.items())
+    samples = []
+    created = 0
+    leased = []
+    i = 0
+    while time.time() < deadline:
+        op = random.choices(ops, weights)[0]
+        i += 1
+        start = time.perf_counter()
+        try:
+            if op == 'send':
+                resp = session.post(f"{url}/send", json={'id': clone_id, 'message': f"load {i} glitch"})
+            elif op == 'remember':
+                resp = session.post(f"{url}/remember", json={'id': clone_id, 'fact': f"fact {i}"})
+            elif op in ('read', 'memories'):
+                resp = session.get(f"{url}/{op}", params={'tail': tail})
+                resp.content
+            elif op == 'task':
+                resp = session.post(f"{url}/task", json={'task': f"{clone_id} job {i}"})
+                created += resp.ok
+            else:
+                resp = session.get(f"{url}/task/assign", params={'id': clone_id})
+                lease = resp.json() if resp.ok else {}
+                if lease.get('task'):
+                    leased.append(lease['task_id'])
+                    samples.append((op, time.perf_counter() - start, True))
+                    op = 'result'
+                    start = time.perf_counter()
+                    resp = session.post(f"{url}/task/result", json={
+                        'id': clone_id, 'result': 'done', 'task_id': lease['task_id'],
+                    })
+            ok = resp.ok
+        except Exception:
+            ok = False
+        samples.append((op, time.perf_counter() - start, ok))
+    return samples, created, leased
+
+
+def _digest_roots(session, url):
+    streams = session.get(f"{url}/digest", timeout=5).json()['streams']
+    return {name: digest['root'] for name, digest in streams.items()}
+
+
+def bench_load(nodes, clones, duration, mix, base_port, tail, env):
+    """Drive a read/write/task mix against a local cluster."""
+    import requests
+
+    with _cluster(nodes, base_port, env) as urls:
+        print(f"{nodes} nodes, {clones} clones, {duration:.0f}s, mix "
+              + ','.join(f"{op}={w:g}" for op, w in mix.items()))
+        deadline = time.time() + duration
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clones) as pool:
+            futures = [pool.submit(_load_worker, urls[i % nodes], f"load-{i}", mix, deadline, tail)
+                       for i in range(clones)]
+            outcomes = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+        samples = [sample for found, _, _ in outcomes for sample in found]
+        created = sum(count for _, count, _ in outcomes)
+        leased = [task_id for _, _, ids in outcomes for task_id in ids]
+
+        by_op = {}
+        for op, seconds, ok in samples:
+            by_op.setdefault(op, []).append((seconds, ok))
+        print(f"{'op':>9} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+        for op in list(LOAD_OPS) + ['result']:
+            rows = by_op.get(op)
+            if not rows:
+                continue
+            latencies = [seconds for seconds, _ in rows]
+            errors = sum(1 for _, ok in rows if not ok)
+            print(f"{op:>9} {len(rows):>9} {errors:>7} {len(rows) / elapsed:>8.0f} "
+                  f"{_percentile(latencies, 50) * 1e3:>8.1f} {_percentile(latencies, 99) * 1e3:>8.1f}")
+        print(f"{'total':>9} {len(samples):>9} {sum(1 for s in samples if not s[2]):>7} "
+              f"{len(samples) / elapsed:>8.0f}")
+        if created or leased:
+            print(f"tasks: {created} created, {len(leased)} assigned, "
+                  f"{len(leased) - len(set(leased))} assigned more than once")
+
+        # Replication convergence: time after the load stops until every
+        # node holds the same set of distinct entries in every stream, as
+        # shown by equal digest roots ("<digest>:<distinct entries>").
+        sessions = {url: requests.Session() for url in urls}
+        converge_start = time.perf_counter()
+        while True:
+            roots = [_digest_roots(sessions[url], url) for url in urls]
+            if all(r == roots[0] for r in roots):
+                break
+            if time.perf_counter() - converge_start > 120:
+                print('not converged after 120s')
+                return
+            time.sleep(0.05)
+        waited = time.perf_counter() - converge_start
+        print(f"converged {waited * 1e3:.0f} ms after load stopped: "
+              + ', '.join(f"{name}={root.split(':')[1]}" for name, root in roots[0].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark clone network internals')
+    sub = parser.add_subparsers(dest='cmd')
+
+    merge_p = sub.add_parser('merge', help='peer sync merge cost by stream size')
+    merge_p.add_argument('--sizes', default='10000,100000,1000000',
+                         help='comma separated local stream sizes')
+    merge_p.add_argument('--batch', type=int, default=2000, help='remote entries per merge')
+    merge_p.add_argument('--sample', type=int, default=200,
+                         help='remote entries probed with the list scan baseline')
+
+    send_p = sub.add_parser('send', help='/send throughput with keyword stats')
+    send_p.add_argument('--count', type=int, default=2000, help='messages to send')
+    send_p.add_argument('--clones', type=int, default=20, help='distinct clone ids')
+
+    gossip_p = sub.add_parser('gossip', help='write convergence time on a local cluster')
+    gossip_p.add_argument('--nodes', type=int, default=20, help='servers to start')
+    gossip_p.add_argument('--fanouts', default='0,2,3,4',
+                          help='comma separated gossip fanouts, 0 for full mesh')
+    gossip_p.add_argument('--messages', type=int, default=50, help='writes to measure')
+    gossip_p.add_argument('--port', type=int, default=5600, help='first server port')
+    gossip_p.add_argument('--timeout', type=float, default=2.0,
+                          help='seconds before a write counts as not converged by push')
+    gossip_p.add_argument('--sync-interval', type=float, default=5.0,
+                          help='SERVER_SYNC_INTERVAL of the servers (pull repair)')
+
+    memory_p = sub.add_parser('memory', help='memory held by a stream with a hot window')
+    memory_p.add_argument('--count', type=int, default=500000, help='entries in the stream')
+    memory_p.add_argument('--window', type=int, default=10000, help='CLONE_HOT_ENTRIES to compare')
+    memory_p.add_argument('--width', type=int, default=200, help='characters per entry')
+
+    search_p = sub.add_parser('search', help='full-text search latency by index size')
+    search_p.add_argument('--count', type=int, default=1000000, help='entries to index')
+    search_p.add_argument('--queries', type=int, default=50, help='runs of each query')
+
+    batch_p = sub.add_parser('batch', help='single writes against batch ingest on a server pair')
+    batch_p.add_argument('--count', type=int, default=5000, help='facts to write per mode')
+    batch_p.add_argument('--size', type=int, default=500, help='facts per batch request')
+    batch_p.add_argument('--port', type=int, default=5800, help='first server port')
+    batch_p.add_argument('--timeout', type=float, default=30.0,
+                         help='seconds to wait for the peer to catch up')
+
+    sanitize_p = sub.add_parser('sanitize', help='firewall sanitizer cost by message size')
+    sanitize_p.add_argument('--sizes', default='100,1000,10000',
+                            help='comma separated message sizes in characters')
+    sanitize_p.add_argument('--patterns', default='6,20,50',
+                            help='comma separated pattern counts, defaults included')
+    sanitize_p.add_argument('--runs', type=int, default=500, help='runs of each message')
+
+    ratelimit_p = sub.add_parser('ratelimit', help='rate limit check cost by tracked clones')
+    ratelimit_p.add_argument('--sizes', default='100,10000,100000',
+                             help='comma separated numbers of clones')
+    ratelimit_p.add_argument('--checks', type=int, default=200000, help='checks to time')
+
+    load_p = sub.add_parser('load', help='throughput and latency of a local cluster under load')
+    load_p.add_argument('--nodes', type=int, default=3, help='servers to start')
+    load_p.add_argument('--clones', type=int, default=32, help='concurrent simulated clones')
+    load_p.add_argument('--duration', type=float, default=10.0, help='seconds of load')
+    load_p.add_argument('--mix', default='send=50,read=20,remember=10,task=10,assign=10',
+                        help=f"op weights, ops: {', '.join(LOAD_OPS)}")
+    load_p.add_argument('--tail', type=int, default=50, help='entries fetched per read')
+    load_p.add_argument('--port', type=int, default=5700, help='first server port')
+    load_p.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra server environment, e.g. CLONE_STORE=sqlite')
+
+    args = parser.parse_args()
+
+    if args.cmd == 'merge':
+        sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+        with _scratch_dir():
+            bench_merge(sizes, args.batch, args.sample)
+    elif args.cmd == 'send':
+        bench_send(args.count, args.clones)
+    elif args.cmd == 'gossip':
+        fanouts = [int(f) for f in args.fanouts.split(',') if f.strip()]
+        bench_gossip(args.nodes, fanouts, args.messages, args.port,
+                     args.timeout, args.sync_interval)
+    elif args.cmd == 'memory':
+        with _scratch_dir():
+            bench_memory(args.count, args.window, args.width)
+    elif args.cmd == 'search':
+        bench_search(args.count, args.queries)
+    elif args.cmd == 'batch':
+        bench_batch(args.count, args.size, args.port, args.timeout)
+    elif args.cmd == 'sanitize':
+        bench_sanitize([int(n) for n in args.sizes.split(',') if n.strip()],
+                       [int(n) for n in args.patterns.split(',') if n.strip()], args.runs)
+    elif args.cmd == 'ratelimit':
+        bench_ratelimit([int(n) for n in args.sizes.split(',') if n.strip()], args.checks)
+    elif args.cmd == 'load':
+        env = {'SERVER_SYNC_INTERVAL': '2'}
+        env.update(item.split('=', 1) for item in args.env if '=' in item)
+        bench_load(args.nodes, args.clones, args.duration, _parse_mix(args.mix),
+                   args.port, args.tail, env)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
 import argparse
 import os
+import sys
+import time
+import uuid
 import requests
 
+from clone_compress import choose_encoding, encode_json
+from clone_record import make, render
+
 def _load_endpoints():
     env = os.getenv('CLONE_ENDPOINTS')
     if env:
@@ -14,6 +20,13 @@ ENDPOINTS = _load_endpoints()
 REGISTRY_URL = os.getenv('SERVER_REGISTRY_URL')
 CLONE_ID = os.getenv('CLONE_ID', os.uname().nodename)
 LOST_ENDPOINTS = []
+COMPRESS_MIN_BYTES = int(os.getenv('CLONE_COMPRESS_MIN_BYTES', '1024'))
+# Request body encodings each server advertised in its responses.
+ENCODINGS = {}
+# Items per request when posting a --batch-file.
+BATCH_SIZE = int(os.getenv('CLONE_BATCH_SIZE', '500'))
+# Times a write is retried after the server answers 429.
+RATE_RETRIES = int(os.getenv('CLONE_RATE_RETRIES', '3'))
 
 
 def _discover_endpoints():
@@ -33,6 +46,29 @@ def _discover_endpoints():
 _discover_endpoints()
 
 
+def _post(url: str, path: str, payload):
+    """POST JSON, compressing large bodies for servers that accept it."""
+    if COMPRESS_MIN_BYTES > 0 and url not in ENCODINGS:
+        body, _ = encode_json(payload)
+        if len(body) >= COMPRESS_MIN_BYTES:
+            resp = requests.get(f"{url}/health", timeout=5)
+            ENCODINGS[url] = choose_encoding(resp.headers.get('Accept-Encoding'))
+    encoding = ENCODINGS.get(url) if COMPRESS_MIN_BYTES > 0 else None
+    body, headers = encode_json(payload, encoding, COMPRESS_MIN_BYTES)
+    for attempt in range(RATE_RETRIES + 1):
+        resp = requests.post(f"{url}{path}", data=body, headers=headers, timeout=5)
+        if resp.status_code != 429 or attempt == RATE_RETRIES:
+            break
+        # Rate limited: wait as long as the server asks, then try again.
+        try:
+            delay = float(resp.headers.get('Retry-After', 1))
+        except ValueError:
+            delay = 1.0
+        time.sleep(min(delay, 60))
+    ENCODINGS[url] = choose_encoding(resp.headers.get('Accept-Encoding'))
+    return resp
+
+
 def _drop_endpoint(url: str):
     if url in ENDPOINTS:
         ENDPOINTS.remove(url)
@@ -52,12 +88,24 @@ def _retry_lost_endpoints():
             pass
 
 
+def _record(stream, text, task_id=None):
+    """Return a new record for ``text``.
+
+    The same record goes to every endpoint, so the network stores it once.
+    """
+    payload = {'text': text}
+    if task_id:
+        payload['task_id'] = task_id
+    return make(stream, CLONE_ID, payload)
+
+
 def send_message(message: str):
     _retry_lost_endpoints()
+    payload = {'id': CLONE_ID, 'message': message, 'record': _record('messages', message)}
     ok = False
     for url in list(ENDPOINTS):
         try:
-            resp = requests.post(f"{url}/send", json={'id': CLONE_ID, 'message': message}, timeout=5)
+            resp = _post(url, '/send', payload)
             if resp.ok:
                 ok = True
         except Exception:
@@ -68,12 +116,13 @@ def send_message(message: str):
         print('error: unable to send message')
 
 
-def read_messages():
+def read_messages(tail=None, limit=None, cursor=None):
     _retry_lost_endpoints()
+    params = {'tail': tail, 'limit': limit, 'cursor': cursor}
     texts = []
     for url in list(ENDPOINTS):
         try:
-            resp = requests.get(f"{url}/read", timeout=5)
+            resp = requests.get(f"{url}/read", params=params, timeout=5)
             if resp.ok:
                 data = resp.text.strip()
                 if data:
@@ -88,10 +137,11 @@ def read_messages():
 
 def remember_fact(fact: str):
     _retry_lost_endpoints()
+    payload = {'id': CLONE_ID, 'fact': fact, 'record': _record('memories', fact)}
     ok = False
     for url in list(ENDPOINTS):
         try:
-            resp = requests.post(f"{url}/remember", json={'id': CLONE_ID, 'fact': fact}, timeout=5)
+            resp = _post(url, '/remember', payload)
             if resp.ok:
                 ok = True
         except Exception:
@@ -102,12 +152,13 @@ def remember_fact(fact: str):
         print('error: unable to store fact')
 
 
-def get_memories():
+def get_memories(tail=None, limit=None, cursor=None):
     _retry_lost_endpoints()
+    params = {'tail': tail, 'limit': limit, 'cursor': cursor}
     texts = []
     for url in list(ENDPOINTS):
         try:
-            resp = requests.get(f"{url}/memories", timeout=5)
+            resp = requests.get(f"{url}/memories", params=params, timeout=5)
             if resp.ok:
                 data = resp.text.strip()
                 if data:
@@ -128,7 +179,10 @@ def fetch_task():
             if resp.ok:
                 data = resp.json()
                 task = data.get('task')
-                print(task if task else '(no task)')
+                if task:
+                    print(f"[{data.get('task_id')}] {task}")
+                else:
+                    print('(no task)')
                 return
         except Exception:
             _drop_endpoint(url)
@@ -137,10 +191,13 @@ def fetch_task():
 
 def queue_task(task: str):
     _retry_lost_endpoints()
+    task_id = uuid.uuid4().hex
+    payload = {'id': CLONE_ID, 'task': task, 'task_id': task_id,
+               'record': _record('tasks', task, task_id)}
     ok = False
     for url in list(ENDPOINTS):
         try:
-            resp = requests.post(f"{url}/task", json={'task': task}, timeout=5)
+            resp = _post(url, '/task', payload)
             if resp.ok:
                 ok = True
         except Exception:
@@ -161,7 +218,7 @@ def read_results():
                 data = resp.json()
                 results = data.get('results', [])
                 if results:
-                    lines.extend(results)
+                    lines.extend(render(entry) for entry in results)
         except Exception:
             _drop_endpoint(url)
     if lines:
@@ -170,12 +227,16 @@ def read_results():
         print('(no results)')
 
 
-def submit_result(result: str):
+def submit_result(result: str, task_id=None):
     _retry_lost_endpoints()
+    payload = {'id': CLONE_ID, 'result': result}
+    if task_id:
+        payload['task_id'] = task_id
+    payload['record'] = _record('results', result, task_id)
     ok = False
     for url in list(ENDPOINTS):
         try:
-            resp = requests.post(f"{url}/task/result", json={'id': CLONE_ID, 'result': result}, timeout=5)
+            resp = _post(url, '/task/result', payload)
             if resp.ok:
                 ok = True
         except Exception:
@@ -186,40 +247,219 @@ def submit_result(result: str):
         print('error: unable to store result')
 
 
+def search(query, stream=None, limit=None, offset=None):
+    """Print the best matches for ``query`` from the first reachable server."""
+    _retry_lost_endpoints()
+    params = {'q': query, 'stream': stream, 'limit': limit, 'offset': offset}
+    for url in list(ENDPOINTS):
+        try:
+            resp = requests.get(f"{url}/search", params=params, timeout=5)
+        except Exception:
+            _drop_endpoint(url)
+            continue
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {'error': f"HTTP {resp.status_code}"}
+        if not resp.ok:
+            print(f"error: {data.get('error')}")
+            return
+        for hit in data.get('hits', []):
+            label = f"{hit['stream']} #{hit['seq']}"
+            if hit.get('id'):
+                label += f" {hit['id']}"
+            print(f"[{label}] {hit['entry']}")
+        if not data.get('hits'):
+            print('(no matches)')
+        if data.get('next_offset') is not None:
+            print(f"(more: --offset {data['next_offset']})")
+        return
+    print('error: unable to search')
+
+
+def _read_batch_file(path):
+    """Return the non-empty lines of ``path``; "-" reads stdin."""
+    if path == '-':
+        return [line.rstrip('\n') for line in sys.stdin if line.strip()]
+    with open(path, encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def post_batch(path, stream, field, lines):
+    """Store one item per line through ``path``/batch, BATCH_SIZE at a time.
+
+    Result lines may start with a task id and a tab. Servers without the
+    batch endpoints get the items one by one.
+    """
+    _retry_lost_endpoints()
+    items = []
+    for line in lines:
+        task_id = None
+        if stream == 'tasks':
+            task_id = uuid.uuid4().hex
+        elif stream == 'results':
+            head, sep, rest = line.partition('\t')
+            if sep and head:
+                task_id, line = head, rest
+        item = {'id': CLONE_ID, field: line, 'record': _record(stream, line, task_id)}
+        if task_id:
+            item['task_id'] = task_id
+        items.append(item)
+    ok = False
+    for url in list(ENDPOINTS):
+        try:
+            for i in range(0, len(items), BATCH_SIZE):
+                chunk = items[i:i + BATCH_SIZE]
+                resp = _post(url, f"{path}/batch", {'items': chunk})
+                if resp.status_code == 404:
+                    for item in chunk:
+                        _post(url, path, item).raise_for_status()
+                else:
+                    resp.raise_for_status()
+            ok = True
+        except Exception:
+            _drop_endpoint(url)
+    if ok:
+        print(f"{len(items)} {stream} stored")
+    else:
+        print('error: unable to store batch')
+
+
+def _iter_sse(resp):
+    """Yield ``(event, data, id)`` tuples from a server-sent event response."""
+    event, data, event_id = None, [], None
+    for line in resp.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if data:
+                yield event, '\n'.join(data), event_id
+            event, data = None, []
+            continue
+        if line.startswith(':'):
+            continue
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'event':
+            event = value
+        elif field == 'data':
+            data.append(value)
+        elif field == 'id':
+            event_id = value
+
+
+def follow(streams=None, tail=None):
+    """Print new entries as the server pushes them, reconnecting on errors."""
+    params = {'streams': streams, 'tail': tail}
+    last_id = None
+    while True:
+        _retry_lost_endpoints()
+        if not ENDPOINTS:
+            print('error: no reachable server')
+            time.sleep(5)
+            continue
+        url = ENDPOINTS[0]
+        headers = {'Last-Event-ID': last_id} if last_id else {}
+        try:
+            with requests.get(f"{url}/stream", params=params, headers=headers,
+                              stream=True, timeout=(5, 60)) as resp:
+                resp.raise_for_status()
+                for event, data, event_id in _iter_sse(resp):
+                    print(f"[{event}] {data}" if streams != 'messages' else data, flush=True)
+                    if event_id:
+                        last_id = event_id
+        except KeyboardInterrupt:
+            return
+        except Exception:
+            _drop_endpoint(url)
+            time.sleep(1)
+
+
+def _add_paging_args(parser):
+    parser.add_argument('--tail', type=int, help='only the newest N entries')
+    parser.add_argument('--limit', type=int, help='maximum entries to return')
+    parser.add_argument('--cursor', help='resume after this cursor (X-Next-Cursor of a page)')
+
+
+# Commands taking --batch-file: endpoint, stream and payload field.
+BATCH_COMMANDS = {
+    'send': ('/send', 'messages', 'message'),
+    'remember': ('/remember', 'memories', 'fact'),
+    'queue-task': ('/task', 'tasks', 'task'),
+    'submit-result': ('/task/result', 'results', 'result'),
+}
+
+
+def _add_batch_arg(parser, help_text='one item per line'):
+    parser.add_argument('--batch-file', metavar='FILE',
+                        help=f'store a file through the batch endpoint: {help_text} ("-" for stdin)')
+
+
 def main():
     parser = argparse.ArgumentParser(description='Interact with a clone server')
     sub = parser.add_subparsers(dest='cmd')
 
     send_p = sub.add_parser('send', help='broadcast a message')
-    send_p.add_argument('message')
+    send_p.add_argument('message', nargs='?')
+    _add_batch_arg(send_p)
 
-    sub.add_parser('read', help='read all messages')
+    read_p = sub.add_parser('read', help='read all messages')
+    _add_paging_args(read_p)
 
     remember_p = sub.add_parser('remember', help='store a shared fact')
-    remember_p.add_argument('fact')
+    remember_p.add_argument('fact', nargs='?')
+    _add_batch_arg(remember_p)
+
+    memories_p = sub.add_parser('memories', help='read shared facts')
+    _add_paging_args(memories_p)
 
-    sub.add_parser('memories', help='read shared facts')
+    follow_p = sub.add_parser('follow', help='print new entries as they arrive')
+    follow_p.add_argument('--streams', default='messages',
+                          help='comma separated streams (messages, memories, results)')
+    follow_p.add_argument('--tail', type=int, help='start with the newest N entries')
+
+    search_p = sub.add_parser('search', help='full-text search of messages and memories')
+    search_p.add_argument('query')
+    search_p.add_argument('--stream', help='only search this stream')
+    search_p.add_argument('--limit', type=int, help='maximum hits to return (default 20)')
+    search_p.add_argument('--offset', type=int, help='skip this many hits')
 
     sub.add_parser('fetch-task', help='request a queued task')
 
     queue_p = sub.add_parser('queue-task', help='add a task to the queue')
-    queue_p.add_argument('task')
+    queue_p.add_argument('task', nargs='?')
+    _add_batch_arg(queue_p)
 
     sub.add_parser('results', help='read completed task results')
 
     result_p = sub.add_parser('submit-result', help='report task result')
-    result_p.add_argument('result')
+    result_p.add_argument('result', nargs='?')
+    result_p.add_argument('--task-id', help='id of the task being completed')
+    _add_batch_arg(result_p, 'one result per line, optionally after a task id and a tab')
 
     args = parser.parse_args()
 
+    if args.cmd in BATCH_COMMANDS:
+        path, stream, field = BATCH_COMMANDS[args.cmd]
+        if args.batch_file is not None:
+            post_batch(path, stream, field, _read_batch_file(args.batch_file))
+            return
+        if getattr(args, field) is None:
+            parser.error(f"{args.cmd} needs a {field} or --batch-file")
+
     if args.cmd == 'send':
         send_message(args.message)
     elif args.cmd == 'read':
-        read_messages()
+        read_messages(args.tail, args.limit, args.cursor)
     elif args.cmd == 'remember':
         remember_fact(args.fact)
     elif args.cmd == 'memories':
-        get_memories()
+        get_memories(args.tail, args.limit, args.cursor)
+    elif args.cmd == 'follow':
+        follow(args.streams, args.tail)
+    elif args.cmd == 'search':
+        search(args.query, args.stream, args.limit, args.offset)
     elif args.cmd == 'fetch-task':
         fetch_task()
     elif args.cmd == 'queue-task':
@@ -227,7 +467,7 @@ def main():
     elif args.cmd == 'results':
         read_results()
     elif args.cmd == 'submit-result':
-        submit_result(args.result)
+        submit_result(args.result, args.task_id)
     else:
         parser.print_help()
 
@@ -0,0 +1,155 @@
+"""Negotiated gzip/zstd compression for clone network traffic.
+
+zstd is used when the optional ``zstandard`` package is installed and the
+other side accepts it; gzip is always available. Servers list the body
+encodings they can decode in an ``Accept-Encoding`` response header so
+senders only compress request bodies for peers that understand them.
+"""
+
+import gzip
+import io
+import json
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+SUPPORTED = ('zstd', 'gzip') if zstandard else ('gzip',)
+ACCEPT_ENCODING = ', '.join(SUPPORTED)
+
+
+def choose_encoding(accept):
+    """Return the preferred encoding listed in an Accept-Encoding value."""
+    offered = set()
+    for part in (accept or '').split(','):
+        name, _, params = part.partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0'):
+            continue
+        offered.add(name.strip().lower())
+    for encoding in SUPPORTED:
+        if encoding in offered:
+            return encoding
+    return None
+
+
+def compress(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(data, encoding, max_bytes):
+    """Decode ``data``, refusing output larger than ``max_bytes``."""
+    if encoding == 'zstd':
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+        body = reader.read(max_bytes + 1)
+    elif encoding == 'gzip':
+        body = zlib.decompressobj(wbits=47).decompress(data, max_bytes + 1)
+    else:
+        raise ValueError(f"unsupported encoding {encoding}")
+    if len(body) > max_bytes:
+        raise ValueError('decoded body too large')
+    return body
+
+
+def _compressor(encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def compress_stream(chunks, encoding, stats=None):
+    """Compress an iterable of str/bytes chunks on the fly."""
+    comp = _compressor(encoding)
+    raw = wire = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        raw += len(chunk)
+        out = comp.compress(chunk)
+        if out:
+            wire += len(out)
+            yield out
+    out = comp.flush()
+    wire += len(out)
+    if stats is not None:
+        stats.add(raw, wire)
+    yield out
+
+
+def encode_json(payload, encoding=None, min_bytes=1024, stats=None):
+    """Serialize ``payload`` for a request body.
+
+    Returns ``(body, headers)``. The body is compressed with ``encoding``
+    when one is given and the JSON is at least ``min_bytes`` long.
+    """
+    body = json.dumps(payload).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if encoding and len(body) >= min_bytes:
+        raw = len(body)
+        body = compress(body, encoding)
+        headers['Content-Encoding'] = encoding
+        if stats is not None:
+            stats.add(raw, len(body))
+    return body, headers
+
+
+class CompressionStats:
+    """Running totals of bytes before and after compression."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def add(self, raw, wire):
+        with self._lock:
+            self.count += 1
+            self.raw_bytes += raw
+            self.wire_bytes += wire
+
+    def snapshot(self):
+        with self._lock:
+            ratio = self.raw_bytes / self.wire_bytes if self.wire_bytes else None
+            return {
+                'count': self.count,
+                'raw_bytes': self.raw_bytes,
+                'wire_bytes': self.wire_bytes,
+                'ratio': ratio,
+            }
+
+
+class DecompressMiddleware:
+    """WSGI middleware that decodes compressed request bodies."""
+
+    def __init__(self, app, max_bytes=64 * 1024 * 1024, stats=None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.stats = stats
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding and encoding != 'identity':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            stream = environ['wsgi.input']
+            wire = stream.read(length) if length else stream.read()
+            try:
+                if encoding not in SUPPORTED:
+                    raise ValueError(f"unsupported encoding {encoding}")
+                body = decompress(wire, encoding, self.max_bytes)
+            except Exception:
+                start_response('415 UNSUPPORTED MEDIA TYPE', [
+                    ('Content-Type', 'application/json'),
+                    ('Accept-Encoding', ACCEPT_ENCODING),
+                ])
+                return [b'{"error": "invalid body encoding"}']
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+            del environ['HTTP_CONTENT_ENCODING']
+            if self.stats is not None:
+                self.stats.add(len(body), len(wire))
+        return self.app(environ, start_response)
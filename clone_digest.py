@@ -0,0 +1,61 @@
+"""Bucketed content digests used for anti-entropy between clone servers.
+
+Every distinct entry hash falls into one of ``LEAVES`` buckets. A bucket's
+digest is the sum of its entry hashes modulo 2**128, so adding an entry is
+O(1) and two servers holding the same set of entries always agree no matter
+in which order the entries arrived. Buckets are grouped ``FANOUT`` at a time
+under a single root, giving a three level tree peers can walk to find the
+few buckets that actually differ.
+"""
+
+FANOUT = 64
+LEAVES = FANOUT * FANOUT
+_MASK = (1 << 128) - 1
+
+
+def bucket_of(key):
+    """Return the leaf bucket for a 16 byte entry hash."""
+    return int.from_bytes(key[:2], 'big') % LEAVES
+
+
+def to_hex(digest, count):
+    """Encode a digest and its entry count for the wire."""
+    return f"{digest:032x}:{count}"
+
+
+class StreamDigest:
+    """Incrementally maintained digest tree for one stream."""
+
+    def __init__(self):
+        self.leaves = [0] * LEAVES
+        self.counts = [0] * LEAVES
+
+    def add(self, key):
+        """Add a new distinct entry hash and return its bucket."""
+        bucket = bucket_of(key)
+        self.leaves[bucket] = (self.leaves[bucket] + int.from_bytes(key, 'big')) & _MASK
+        self.counts[bucket] += 1
+        return bucket
+
+    def remove(self, key):
+        """Take a distinct entry hash back out of the digest."""
+        bucket = bucket_of(key)
+        self.leaves[bucket] = (self.leaves[bucket] - int.from_bytes(key, 'big')) & _MASK
+        self.counts[bucket] -= 1
+        return bucket
+
+    def _sum(self, start, stop):
+        digest = sum(self.leaves[start:stop]) & _MASK
+        return to_hex(digest, sum(self.counts[start:stop]))
+
+    def root(self):
+        return self._sum(0, LEAVES)
+
+    def groups(self):
+        """Return the digest of every group of ``FANOUT`` buckets."""
+        return [self._sum(g * FANOUT, (g + 1) * FANOUT) for g in range(FANOUT)]
+
+    def group_leaves(self, group):
+        """Return the bucket digests inside ``group``."""
+        start = group * FANOUT
+        return [to_hex(self.leaves[b], self.counts[b]) for b in range(start, start + FANOUT)]
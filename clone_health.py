@@ -0,0 +1,109 @@
+"""Per-peer circuit breakers for clone network servers."""
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PeerHealth:
+    """Track failures per peer and decide when a lost peer is tried again.
+
+    A peer's breaker opens after ``threshold`` consecutive failures, so a
+    single timeout no longer drops it. While open the peer is left alone
+    until its backoff expires. The delay doubles with every failed probe up
+    to ``max_delay`` and is jittered so peers that failed together are not
+    probed in lockstep. Any success closes the breaker again.
+    """
+
+    def __init__(self, threshold=3, base_delay=1.0, max_delay=300.0, max_probes=16):
+        self.threshold = max(1, threshold)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_probes = max_probes
+        self._lock = threading.Lock()
+        self._peers = {}
+
+    def _state(self, url):
+        # Caller holds self._lock.
+        state = self._peers.get(url)
+        if state is None:
+            state = self._peers[url] = {'failures': 0, 'open': False, 'trips': 0, 'retry_at': 0.0}
+        return state
+
+    def _backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** max(0, attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def record_success(self, url):
+        with self._lock:
+            state = self._peers.get(url)
+            if state is not None:
+                state.update(failures=0, open=False, trips=0, retry_at=0.0)
+
+    def record_failure(self, url):
+        """Count a failure. Returns True when it opened the peer's breaker."""
+        with self._lock:
+            state = self._state(url)
+            state['failures'] += 1
+            if state['open']:
+                state['trips'] += 1
+            elif state['failures'] >= self.threshold:
+                state['open'] = True
+                state['trips'] = 1
+            else:
+                return False
+            state['retry_at'] = time.time() + self._backoff(state['trips'])
+            return state['trips'] == 1
+
+    def retry_delay(self, url):
+        """Return how long to wait before retrying a peer that is not yet lost."""
+        with self._lock:
+            return self._backoff(self._state(url)['failures'])
+
+    def due(self, urls):
+        """Return the peers in ``urls`` whose backoff has expired."""
+        now = time.time()
+        with self._lock:
+            return [url for url in urls
+                    if url not in self._peers or self._peers[url]['retry_at'] <= now]
+
+    def probe(self, urls, check):
+        """Run ``check(url)`` concurrently for every due peer in ``urls``.
+
+        ``check`` returns True for a healthy peer. Returns the peers that
+        recovered; the others back off further.
+        """
+        due = self.due(urls)
+        if not due:
+            return []
+
+        def run(url):
+            try:
+                return url, bool(check(url))
+            except Exception:
+                return url, False
+
+        with ThreadPoolExecutor(max_workers=min(self.max_probes, len(due))) as pool:
+            outcomes = list(pool.map(run, due))
+        recovered = []
+        for url, ok in outcomes:
+            if ok:
+                self.record_success(url)
+                recovered.append(url)
+            else:
+                self.record_failure(url)
+        return recovered
+
+    def stats(self):
+        """Return failure counts and retry times of every peer not healthy."""
+        now = time.time()
+        with self._lock:
+            return {
+                url: {
+                    'failures': state['failures'],
+                    'open': state['open'],
+                    'retry_in': max(0.0, state['retry_at'] - now) if state['open'] else 0.0,
+                }
+                for url, state in self._peers.items() if state['failures']
+            }
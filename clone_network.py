@@ -1,12 +1,57 @@
+import bisect
+import hashlib
+import hmac
+import math
 import os
+import random
+import socket
 import threading
 import time
+import uuid
+import atexit
+from collections import OrderedDict
+from urllib.parse import urlsplit
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 from firewall import sanitize_text
+from clone_store import entry_hash, open_store
+from clone_record import (
+    decode,
+    encode,
+    id_key,
+    id_time,
+    is_id,
+    make,
+    record_id,
+    render,
+    to_json,
+    validate,
+)
+from clone_ratelimit import RateLimiter
+from clone_replication import Replicator
+from clone_health import PeerHealth
+from clone_registry import Registry
+from clone_ring import HashRing
+from clone_search import SearchIndex
+from clone_metrics import Counter, Histogram, family
+from clone_tasks import SharedTaskQueue, TaskQueue, is_task_id, split_task
+from clone_digest import FANOUT, StreamDigest
+from clone_compress import (
+    ACCEPT_ENCODING,
+    CompressionStats,
+    DecompressMiddleware,
+    choose_encoding,
+    compress,
+    compress_stream,
+)
 import sqlite3
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
 DB_NAME = 'mandemos.db'
 
 
@@ -25,29 +70,188 @@ def _ensure_db():
     conn.commit()
     conn.close()
 
+
+def _load_keyword_stats():
+    """Return persisted keyword counts keyed by clone id."""
+    stats = {}
+    try:
+        conn = sqlite3.connect(DB_NAME)
+        try:
+            rows = conn.execute("SELECT clone_id, keyword, count FROM keyword_usage").fetchall()
+        finally:
+            conn.close()
+    except Exception:
+        return stats
+    for clone_id, keyword, count in rows:
+        if keyword in KEYWORDS:
+            stats.setdefault(clone_id, {k: 0 for k in KEYWORDS})[keyword] = count
+    return stats
+
+
 # Track keyword usage across clones
 KEYWORDS = {"glitch", "frequency", "vibration", "null"}
-keyword_stats = {}
+# Counts are updated in memory and written to DB_NAME in the background
+# every KEYWORD_FLUSH_INTERVAL seconds or once KEYWORD_FLUSH_THRESHOLD
+# increments are waiting.
+KEYWORD_FLUSH_INTERVAL = float(os.getenv("KEYWORD_FLUSH_INTERVAL", "5"))
+KEYWORD_FLUSH_THRESHOLD = int(os.getenv("KEYWORD_FLUSH_THRESHOLD", "1000"))
+_keyword_lock = threading.Lock()
+# Increments not yet written, keyed by (clone_id, keyword). Writing deltas
+# rather than totals lets several processes share one database.
+_keyword_deltas = {}
+_keyword_pending = 0
+_keyword_last_flush = time.time()
+_keyword_flush_now = threading.Event()
+
+_ensure_db()
+keyword_stats = _load_keyword_stats()
 
 # Persisted storage files
 MESSAGES_FILE = "clone_messages.log"
 MEMORIES_FILE = "shared_memory.txt"
 TASKS_FILE = "tasks.log"
 RESULTS_FILE = "task_results.log"
+TASK_EVENTS_FILE = "task_events.log"
+STREAM_FILES = {
+    'messages': MESSAGES_FILE,
+    'memories': MEMORIES_FILE,
+    'tasks': TASKS_FILE,
+    'results': RESULTS_FILE,
+    'task_events': TASK_EVENTS_FILE,
+}
+# Seconds a worker may hold a task before it is handed out again.
+TASK_LEASE_SECONDS = float(os.getenv("CLONE_TASK_LEASE", "300"))
+
+# Storage engine for the streams: "file" keeps the flat logs above,
+# "sqlite" uses a WAL-mode database and imports the flat logs once.
+STORE_KIND = os.getenv("CLONE_STORE", "file")
+STORE_DB = os.getenv("CLONE_STORE_DB", "clone_streams.db")
+STORE_BATCH = int(os.getenv("CLONE_STORE_BATCH", "500"))
+STORE_COMMIT_DELAY = float(os.getenv("CLONE_STORE_COMMIT_DELAY", "0"))
+# Flat logs are rotated into sealed segments at this size (0 never rotates).
+SEGMENT_BYTES = int(os.getenv("CLONE_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+# Every COMPACT_INTERVAL seconds finished tasks and results older than
+# CLONE_RETENTION_DAYS are dropped, and messages older than
+# CLONE_MESSAGE_RETENTION_DAYS when that is set. 0 keeps them forever.
+RETENTION_SECONDS = float(os.getenv("CLONE_RETENTION_DAYS", "7")) * 86400
+MESSAGE_RETENTION_SECONDS = float(os.getenv("CLONE_MESSAGE_RETENTION_DAYS", "0")) * 86400
+COMPACT_INTERVAL = float(os.getenv("CLONE_COMPACT_INTERVAL", "3600"))
+# Hot window kept in memory per stream: the newest CLONE_HOT_ENTRIES
+# entries, none older than CLONE_HOT_MINUTES. Older entries are read from
+# disk on demand. 0 for both keeps every entry in memory.
+HOT_ENTRIES = int(os.getenv("CLONE_HOT_ENTRIES", "0"))
+HOT_SECONDS = float(os.getenv("CLONE_HOT_MINUTES", "0")) * 60
+# Streams indexed for /search in an SQLite FTS5 database. Entries are
+# indexed by a background thread shortly after they are stored. An empty
+# CLONE_SEARCH_STREAMS turns search off.
+SEARCH_DB = os.getenv("CLONE_SEARCH_DB", "clone_search.db")
+SEARCH_STREAMS = [s.strip() for s in os.getenv("CLONE_SEARCH_STREAMS", "messages,memories").split(',')
+                  if s.strip()]
+SEARCH_INTERVAL = float(os.getenv("CLONE_SEARCH_INTERVAL", "1"))
+# Set when several server processes (for example gunicorn workers) share
+# one STORE_DB. Streams, the task queue and keyword counts then live in
+# SQLite and only the process holding SYNC_LOCK_FILE pulls from peers.
+SHARED_STATE = os.getenv("CLONE_SHARED_STATE", "").lower() in ("1", "true", "yes")
+SYNC_LOCK_FILE = os.getenv("CLONE_SYNC_LOCK", "clone_sync.lock")
+if SHARED_STATE:
+    STORE_KIND = 'sqlite'
+
+
+def _normalize_url(url):
+    """Return ``url`` the way servers name each other: no trailing slash.
+
+    Task owners are looked up by exact URL, so every peer list and this
+    server's own URL go through here.
+    """
+    return str(url or '').strip().rstrip('/')
 
 
 def _load_endpoints():
     env = os.getenv("SERVER_ENDPOINTS")
     if env:
-        return [u.strip() for u in env.split(',') if u.strip()]
+        return [_normalize_url(u) for u in env.split(',') if u.strip()]
     return []
 
 
 SERVER_ENDPOINTS = _load_endpoints()
+# Peers from SERVER_ENDPOINTS stay even when the registry stops listing them.
+STATIC_ENDPOINTS = set(SERVER_ENDPOINTS)
 REGISTRY_URL = os.getenv("SERVER_REGISTRY_URL")
-CLONE_PUBLIC_URL = os.getenv("CLONE_PUBLIC_URL")
+# Serve /register and /list so other servers can use this one as their
+# SERVER_REGISTRY_URL. Servers missing heartbeats for SERVER_REGISTRY_TTL
+# seconds are dropped from the list.
+REGISTRY_MODE = os.getenv("SERVER_REGISTRY_MODE", "").lower() in ("1", "true", "yes")
+REGISTRY_TTL = float(os.getenv("SERVER_REGISTRY_TTL", "30"))
+CLONE_PUBLIC_URL = _normalize_url(os.getenv("CLONE_PUBLIC_URL")) or None
 SYNC_INTERVAL = float(os.getenv("SERVER_SYNC_INTERVAL", "10"))
+UPDATES_PAGE_LIMIT = int(os.getenv("SERVER_UPDATES_LIMIT", "1000"))
+# Entries pulled from a stream per chunk when streaming /read and /memories.
+READ_CHUNK_SIZE = 500
+# Most items accepted by one /send/batch, /remember/batch, /task/batch,
+# /task/result/batch or peer /batch request.
+BATCH_LIMIT = int(os.getenv("SERVER_BATCH_LIMIT", "1000"))
+# Token bucket limits on client writes: SERVER_CLONE_RATE items per second
+# for each clone id and SERVER_IP_RATE for each client address, with bursts
+# of SERVER_CLONE_BURST and SERVER_IP_BURST. A rate of 0 turns a limit off.
+CLONE_RATE = float(os.getenv("SERVER_CLONE_RATE", "0"))
+CLONE_BURST = float(os.getenv("SERVER_CLONE_BURST", str(max(1.0, CLONE_RATE * 2))))
+IP_RATE = float(os.getenv("SERVER_IP_RATE", "0"))
+IP_BURST = float(os.getenv("SERVER_IP_BURST", str(max(1.0, IP_RATE * 2))))
+RATE_LIMIT_KEYS = int(os.getenv("SERVER_RATE_LIMIT_KEYS", "100000"))
+# Writes from peers skip the rate limits. A peer is a client whose address
+# is that of a server configured in SERVER_ENDPOINTS, or one sending
+# SERVER_PEER_TOKEN in the X-Clone-Peer-Token header. Servers found through
+# a registry are not trusted by address, since anyone can register. This
+# server sends its token with everything it passes on.
+PEER_TOKEN = os.getenv("SERVER_PEER_TOKEN", "")
+PEER_TOKEN_HEADER = 'X-Clone-Peer-Token'
+PEER_HEADERS = {PEER_TOKEN_HEADER: PEER_TOKEN} if PEER_TOKEN else {}
+# Seconds between lookups of the SERVER_ENDPOINTS host names.
+PEER_ADDRESS_TTL = 30.0
 LOST_ENDPOINTS = []
+# A peer is moved to LOST_ENDPOINTS after SERVER_FAILURE_THRESHOLD failures
+# in a row. Lost peers are probed again after a jittered backoff that starts
+# at SERVER_BACKOFF_BASE seconds and doubles up to SERVER_BACKOFF_MAX.
+FAILURE_THRESHOLD = int(os.getenv("SERVER_FAILURE_THRESHOLD", "3"))
+BACKOFF_BASE = float(os.getenv("SERVER_BACKOFF_BASE", "1"))
+BACKOFF_MAX = float(os.getenv("SERVER_BACKOFF_MAX", "300"))
+HEALTH_PROBE_TIMEOUT = float(os.getenv("SERVER_PROBE_TIMEOUT", "2"))
+# Responses and peer request bodies at least this large are compressed
+# when the other side accepts gzip or zstd. 0 disables compression.
+COMPRESS_MIN_BYTES = int(os.getenv("CLONE_COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_ENABLED = COMPRESS_MIN_BYTES > 0
+compression_stats = {
+    'responses': CompressionStats(),
+    'requests': CompressionStats(),
+}
+
+# Peers written to concurrently by the background replication pool.
+REPLICATION_WORKERS = int(os.getenv("SERVER_REPLICATION_WORKERS", "8"))
+REPLICATION_QUEUE_LIMIT = int(os.getenv("SERVER_REPLICATION_QUEUE_LIMIT", "10000"))
+# Writes to a peer are coalesced into one /batch request for this many
+# seconds or until this many are waiting.
+REPLICATION_BATCH_WINDOW = float(os.getenv("SERVER_REPLICATION_BATCH_WINDOW", "0.05"))
+REPLICATION_BATCH_SIZE = int(os.getenv("SERVER_REPLICATION_BATCH_SIZE", "200"))
+# With a fanout above 0 writes spread by gossip: the origin and every
+# server that sees a write for the first time pass it to this many random
+# peers, instead of the origin sending it to every peer itself.
+GOSSIP_FANOUT = int(os.getenv("SERVER_GOSSIP_FANOUT", "0"))
+# Hops a gossiped write may travel, and how many write ids are remembered
+# so copies arriving over other paths are dropped.
+GOSSIP_TTL = int(os.getenv("SERVER_GOSSIP_TTL", "8"))
+GOSSIP_SEEN_LIMIT = int(os.getenv("SERVER_GOSSIP_SEEN_LIMIT", "100000"))
+# With CLONE_PUBLIC_URL set every task has one owner, chosen by consistent
+# hashing of its id over this server and its live peers. Only the owner
+# hands a task out; other servers forward /task/assign to it.
+TASK_PARTITION = os.getenv("SERVER_TASK_PARTITION", "1").lower() in ("1", "true", "yes")
+
+# Last sequence number pulled from each peer, per stream.
+PEER_CURSORS = {}
+# Seconds between digest comparisons with each peer. Cursor pulls keep
+# replicas current; the digest pass repairs anything they missed.
+ANTI_ENTROPY_INTERVAL = float(os.getenv("SERVER_ANTI_ENTROPY_INTERVAL", "300"))
+# Buckets requested per /digest entries call.
+ANTI_ENTROPY_BUCKETS_PER_REQUEST = 64
 
 
 def _setup_public_url():
@@ -78,28 +282,51 @@ def _setup_public_url():
 
 
 _setup_public_url()
+CLONE_PUBLIC_URL = _normalize_url(CLONE_PUBLIC_URL) or None
+
+
+_registry_etag = None
+_registry_peers = set()
+_next_heartbeat = 0.0
 
 
 def _discover_endpoints():
-    """Register with the central registry and pull the latest peer list."""
+    """Heartbeat to the central registry and apply changes to its peer list.
+
+    Heartbeats are sent three times per registry TTL. The list is requested
+    with the last ETag, so an unchanged list costs a 304.
+    """
+    global _registry_etag, _registry_peers, _next_heartbeat
     if not REGISTRY_URL:
         return
     try:
-        if CLONE_PUBLIC_URL:
+        now = time.time()
+        if CLONE_PUBLIC_URL and now >= _next_heartbeat:
             try:
-                requests.post(
+                resp = requests.post(
                     f"{REGISTRY_URL}/register",
                     json={"url": CLONE_PUBLIC_URL},
                     timeout=5,
                 )
+                ttl = resp.json().get("ttl") if resp.ok else None
+                _next_heartbeat = now + float(ttl) / 3 if ttl else 0.0
             except Exception:
                 pass
-        resp = requests.get(f"{REGISTRY_URL}/list", timeout=5)
-        if resp.ok:
-            data = resp.json()
-            for url in data.get("servers", []):
-                if url != CLONE_PUBLIC_URL and url not in SERVER_ENDPOINTS:
-                    SERVER_ENDPOINTS.append(url)
+        headers = {"If-None-Match": _registry_etag} if _registry_etag else {}
+        resp = requests.get(f"{REGISTRY_URL}/list", headers=headers, timeout=5)
+        if resp.status_code == 304 or not resp.ok:
+            return
+        servers = {_normalize_url(url) for url in resp.json().get("servers", [])} - {CLONE_PUBLIC_URL}
+        for url in sorted(servers - _registry_peers):
+            if url not in SERVER_ENDPOINTS and url not in LOST_ENDPOINTS:
+                SERVER_ENDPOINTS.append(url)
+        for url in _registry_peers - servers - STATIC_ENDPOINTS:
+            # Expired from the registry: stop syncing with it.
+            for endpoints in (SERVER_ENDPOINTS, LOST_ENDPOINTS):
+                if url in endpoints:
+                    endpoints.remove(url)
+        _registry_peers = servers
+        _registry_etag = resp.headers.get("ETag")
     except Exception:
         pass
 
@@ -108,130 +335,1370 @@ if REGISTRY_URL:
     _discover_endpoints()
 
 
-def _load_lines(path):
-    """Return list of non-empty lines from a file."""
-    if os.path.exists(path):
+# Streams with a hot window are loaded this many entries at a time, and
+# evict in chunks of up to _EVICT_SLACK entries.
+_LOAD_PAGE = 10000
+_EVICT_SLACK = 256
+
+
+class LogStream:
+    """In-memory list of entries mirrored to a storage engine.
+
+    Entries are record lines (see ``clone_record``). An index keyed by
+    record id is kept alongside the list, so membership checks during peer
+    sync are O(1) instead of a scan over every stored entry.
+    Each entry also carries a monotonically increasing sequence number
+    that peers use as a sync cursor. Callables in ``listeners`` receive
+    every list of newly stored entries. A bucketed digest of the distinct
+    entries lets peers find divergent buckets without a full transfer.
+
+    With ``shared`` set the store is the source of truth: several processes
+    write to it, sequence numbers are assigned by the store, and the list
+    is a cache that picks up new rows before every read. When another
+    process compacted the stream the cache is loaded again.
+
+    ``admit``, when set, is asked about every entry before it is stored and
+    turns away the ones it returns False for, such as records older than
+    the stream's retention that a peer still holds.
+
+    With ``hot_limit`` or ``hot_seconds`` set the list only holds the hot
+    window: at most ``hot_limit`` of the newest entries, none created more
+    than ``hot_seconds`` ago by the time in its record id, so a restart
+    does not pull old history back into memory. Older entries are read
+    back from the store when a cursor or digest bucket reaches them. The
+    hash index and digest still cover the whole stream, but hold a
+    fixed-size hash per entry instead of its text.
+    """
+
+    def __init__(self, name, store, shared=False, hot_limit=0, hot_seconds=0):
+        self.name = name
+        self.store = store
+        self.shared = shared
+        self.hot_limit = hot_limit
+        self.hot_seconds = hot_seconds
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.admit = None
+        self._generation = store.generation(name) if shared else 0
+        self._load()
+
+    def _load(self):
+        # Caller holds self.lock, or nobody else can see the stream yet.
+        self.seqs = []
+        self.entries = []
+        self._times = []
+        self.total = 0
+        self.last_seq = 0
+        self.digest = StreamDigest()
+        # Hash -> seq of its first copy, extra copies of duplicated hashes,
+        # and the hashes in each digest bucket.
+        self._index = {}
+        self._dupes = {}
+        self._buckets = {}
+        if not (self.hot_limit or self.hot_seconds):
+            for seq, entry in self.store.load(self.name):
+                self._add(seq, entry)
+            return
+        cursor = 0
+        while True:
+            page = self.store.read(self.name, cursor, limit=_LOAD_PAGE)
+            for seq, entry in page:
+                self._add(seq, entry)
+            if len(page) < _LOAD_PAGE:
+                break
+            cursor = page[-1][0]
+
+    def _index_add(self, entry, seq):
+        key = entry_hash(entry)
+        if key in self._index:
+            self._dupes[key] = self._dupes.get(key, 0) + 1
+        else:
+            self._index[key] = seq
+            self._buckets.setdefault(self.digest.add(key), []).append(key)
+
+    def _add(self, seq, entry):
+        # Caller holds self.lock.
+        self.last_seq = seq
+        self.total += 1
+        self._index_add(entry, seq)
+        self.entries.append(entry)
+        self.seqs.append(seq)
+        if self.hot_seconds:
+            # Creation times, kept non-decreasing so the window can be cut
+            # with a bisect: an old record synced late leaves with the
+            # entries before it. Legacy lines count as created at the epoch.
+            created = min(id_time(record_id(entry)), time.time())
+            self._times.append(max(created, self._times[-1]) if self._times else created)
+        if self.hot_limit or self.hot_seconds:
+            self._evict()
+
+    def _evict(self):
+        # Caller holds self.lock. Entries leave the window in chunks so an
+        # append stays O(1) amortised.
+        excess = len(self.entries) - self.hot_limit if self.hot_limit else 0
+        if self.hot_seconds:
+            cutoff = time.time() - self.hot_seconds
+            excess = max(excess, bisect.bisect_left(self._times, cutoff))
+        slack = min(_EVICT_SLACK, max(1, self.hot_limit // 8)) if self.hot_limit else _EVICT_SLACK
+        if excess >= slack:
+            del self.entries[:excess]
+            del self.seqs[:excess]
+            del self._times[:excess]
+
+    def _hot_start(self):
+        # Caller holds self.lock. Entries below this seq live only on disk.
+        return self.seqs[0] if self.seqs else self.last_seq + 1
+
+    def _has_cold(self):
+        # Caller holds self.lock.
+        return self.total > len(self.entries)
+
+    def stage(self, entries):
+        """Add ``entries`` in memory and return their storage records.
+
+        The caller must hold ``self.lock`` and hand the records to the
+        store before releasing it, so log order matches sequence order.
+        """
+        now = time.time()
+        records = []
+        for entry in entries:
+            self._add(self.last_seq + 1, entry)
+            records.append((self.last_seq, now, entry))
+        return records
+
+    def unstage(self, records):
+        """Take back staged records the store failed to write.
+
+        The caller must hold ``self.lock``. Sequence numbers are handed out
+        again when nothing was staged after ``records``.
+        """
+        if not records:
+            return
+        self._forget([(seq, entry) for seq, _, entry in records])
+        if self.last_seq == records[-1][0]:
+            self.last_seq = records[0][0] - 1
+
+    def refresh(self):
+        """Load entries that other processes stored since our last look."""
+        if not self.shared:
+            return
+        generation = self.store.generation(self.name)
+        if generation != self._generation:
+            self._reload(generation)
+        rows = self.store.load_since(self.name, self.last_seq)
+        if not rows:
+            return
+        fresh = []
+        with self.lock:
+            for seq, entry in rows:
+                if seq > self.last_seq:
+                    self._add(seq, entry)
+                    fresh.append(entry)
+        if fresh:
+            self.notify(fresh)
+
+    def _reload(self, generation):
+        # Another process compacted the store: cached entries may be gone.
+        with self.lock:
+            if generation == self._generation:
+                return
+            last = self.last_seq
+            self._generation = generation
+            self._load()
+            fresh = [entry for seq, entry in zip(self.seqs, self.entries) if seq > last]
+        if fresh:
+            self.notify(fresh)
+
+    def __contains__(self, entry):
+        self.refresh()
+        return entry_hash(entry) in self._index
+
+    def seq_of(self, record_id):
+        """Return the sequence number of the record ``record_id``, or None."""
+        self.refresh()
+        return self._index.get(id_key(record_id))
+
+    def entry_at(self, seq):
+        """Return the entry stored under ``seq``, or None."""
+        self.refresh()
+        with self.lock:
+            if seq >= self._hot_start():
+                i = bisect.bisect_left(self.seqs, seq)
+                return self.entries[i] if i < len(self.seqs) and self.seqs[i] == seq else None
+        pairs = self.store.get(self.name, [seq])
+        return pairs[0][1] if pairs else None
+
+    def __len__(self):
+        self.refresh()
+        return self.total
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def head(self):
+        """Return the sequence number of the newest entry."""
+        self.refresh()
+        return self.last_seq
+
+    def snapshot(self):
+        """Return a copy of every entry, reading evicted ones from disk."""
+        self.refresh()
+        with self.lock:
+            hot = list(self.entries)
+            if not self._has_cold():
+                return hot
+            start = self._hot_start()
+        return [entry for _, entry in self.store.read(self.name, 0, until=start - 1)] + hot
+
+    def since(self, cursor, limit=None, until=None):
+        """Return ``(entries, cursor, more)`` for entries after ``cursor``.
+
+        At most ``limit`` entries are returned and none past sequence
+        number ``until``. The new cursor is the sequence number of the last
+        returned entry and ``more`` tells the caller whether another page
+        is waiting. Entries older than the hot window come from the store.
+        """
+        self.refresh()
+        page = []
+        while True:
+            with self.lock:
+                start = self._hot_start()
+                if not (self._has_cold() and cursor < start - 1
+                        and (until is None or cursor < until)):
+                    first = bisect.bisect_right(self.seqs, cursor)
+                    stop = len(self.entries)
+                    if until is not None:
+                        stop = bisect.bisect_right(self.seqs, until)
+                    end = stop if limit is None else min(first + limit - len(page), stop)
+                    page.extend(self.entries[first:end])
+                    if end > first:
+                        cursor = self.seqs[end - 1]
+                    return page, cursor, end < stop
+                last = self.last_seq if until is None else until
+            # The window may move on while the store is read; the next pass
+            # picks up whatever was evicted meanwhile.
+            stop = min(last, start - 1)
+            room = None if limit is None else limit - len(page)
+            pairs = self.store.read(self.name, cursor, room, stop)
+            page.extend(entry for _, entry in pairs)
+            if room is not None and len(pairs) >= room:
+                cursor = pairs[-1][0]
+                return page, cursor, cursor < last
+            cursor = stop
+
+    def page_bounds(self, cursor, limit=None):
+        """Return ``(last_seq, more)`` for a page of entries after ``cursor``."""
+        self.refresh()
+        with self.lock:
+            cold = self._has_cold() and cursor < self._hot_start() - 1
+            if not cold:
+                start = bisect.bisect_right(self.seqs, cursor)
+                end = len(self.entries) if limit is None else min(start + limit, len(self.entries))
+                last = self.seqs[end - 1] if end > start else cursor
+                return last, end < len(self.entries)
+            if limit is None:
+                return self.last_seq, False
+        _, last, more = self.since(cursor, limit)
+        return last, more
+
+    def tail_cursor(self, count):
+        """Return the cursor that precedes the newest ``count`` entries."""
+        self.refresh()
+        with self.lock:
+            if count <= 0:
+                return self.last_seq
+            if count < len(self.seqs):
+                return self.seqs[-count - 1]
+            if not self._has_cold():
+                return 0
+            need = count - len(self.seqs)
+            start = self._hot_start()
+        pairs = self.store.read_tail(self.name, need + 1, start)
+        return pairs[0][0] if len(pairs) > need else 0
+
+    def extend(self, entries):
+        """Store ``entries`` even if identical ones already exist."""
+        if not entries:
+            return
+        if self.shared:
+            self.store.insert_many([(self.name, entries)]).wait()
+            self.refresh()
+            return
+        with self.lock:
+            records = self.stage(entries)
+            pending = self._write(records)
+        self._wait(pending, records)
+        self.notify(entries)
+
+    def _write(self, records):
+        # Caller holds self.lock.
         try:
-            with open(path, "r") as f:
-                return [line.strip() for line in f if line.strip()]
+            return self.store.append(self.name, records)
         except Exception:
-            pass
-    return []
+            self.unstage(records)
+            raise
 
+    def _wait(self, pending, records):
+        try:
+            pending.wait()
+        except Exception:
+            with self.lock:
+                self.unstage(records)
+            raise
+
+    def append(self, entry):
+        """Store ``entry`` even if an identical one already exists."""
+        self.extend([entry])
+
+    def merge(self, entry):
+        """Store ``entry`` only if it is not already present.
+
+        Returns True when the entry was added.
+        """
+        return bool(self.merge_many([entry]))
+
+    def fresh(self, entries):
+        """Return the entries whose record is not stored yet, once each.
+
+        The caller must hold ``self.lock``.
+        """
+        fresh = []
+        seen = set()
+        for entry in entries:
+            key = entry_hash(entry)
+            if key not in self._index and key not in seen:
+                seen.add(key)
+                if self.admit is None or self.admit(entry):
+                    fresh.append(entry)
+        return fresh
+
+    def merge_many(self, entries):
+        """Store every entry not already present with one storage write.
+
+        Returns the list of entries that were added.
+        """
+        self.refresh()
+        with self.lock:
+            fresh = self.fresh(entries)
+            if not fresh:
+                return []
+            if not self.shared:
+                records = self.stage(fresh)
+                pending = self._write(records)
+        if self.shared:
+            # Another process may store the same entries meanwhile; the
+            # store checks again inside its transaction.
+            if not self.store.insert_many([(self.name, fresh)], dedup=True).wait():
+                return []
+            self.refresh()
+            return fresh
+        self._wait(pending, records)
+        self.notify(fresh)
+        return fresh
+
+    def digest_root(self):
+        self.refresh()
+        with self.lock:
+            return self.digest.root()
+
+    def digest_groups(self):
+        self.refresh()
+        with self.lock:
+            return self.digest.groups()
+
+    def digest_leaves(self, group):
+        self.refresh()
+        with self.lock:
+            return self.digest.group_leaves(group)
+
+    def bucket_entries(self, buckets):
+        """Return the distinct entries whose hash falls in ``buckets``."""
+        self.refresh()
+        with self.lock:
+            start = self._hot_start()
+            found = []
+            cold = []
+            for bucket in buckets:
+                for key in self._buckets.get(bucket, ()):
+                    seq = self._index[key]
+                    if seq >= start:
+                        found.append(self.entries[bisect.bisect_left(self.seqs, seq)])
+                    else:
+                        cold.append(seq)
+        if cold:
+            found.extend(entry for _, entry in self.store.get(self.name, cold))
+        return found
+
+    def drop(self, pairs):
+        """Forget the ``(seq, entry)`` pairs compaction removed from the store."""
+        if not pairs:
+            return
+        with self.lock:
+            if self.shared:
+                generation = self.store.generation(self.name)
+                if generation != self._generation + 1:
+                    # Already reloaded, or behind and reloaded on refresh.
+                    return
+                self._generation = generation
+            orphans = self._forget(pairs)
+        if orphans:
+            self._rehome(orphans)
+
+    def _forget(self, pairs):
+        # Caller holds self.lock. Returns the duplicated hashes whose
+        # indexed copy was among ``pairs``.
+        gone = {seq for seq, _ in pairs}
+        orphans = set()
+        if self.seqs and self.seqs[0] <= max(gone):
+            kept = [i for i, seq in enumerate(self.seqs) if seq not in gone]
+            self.seqs = [self.seqs[i] for i in kept]
+            self.entries = [self.entries[i] for i in kept]
+            if self._times:
+                self._times = [self._times[i] for i in kept]
+        self.total -= len(pairs)
+        for seq, entry in pairs:
+            key = entry_hash(entry)
+            if key not in self._index:
+                continue
+            extra = self._dupes.pop(key, 0)
+            if extra:
+                if extra > 1:
+                    self._dupes[key] = extra - 1
+                if self._index[key] in gone:
+                    orphans.add(key)
+                continue
+            del self._index[key]
+            self._buckets[self.digest.remove(key)].remove(key)
+            orphans.discard(key)
+        return orphans
+
+    def _rehome(self, orphans):
+        # Point the index at a surviving copy of every duplicate entry
+        # whose recorded copy was compacted away.
+        found = {}
+        cursor = 0
+        while len(found) < len(orphans):
+            page = self.store.read(self.name, cursor, limit=_LOAD_PAGE)
+            for seq, entry in page:
+                key = entry_hash(entry)
+                if key in orphans and key not in found:
+                    found[key] = seq
+            if len(page) < _LOAD_PAGE:
+                break
+            cursor = page[-1][0]
+        with self.lock:
+            for key, seq in found.items():
+                if key in self._index:
+                    self._index[key] = seq
+
+    def notify(self, entries):
+        """Pass newly stored ``entries`` to every listener."""
+        for listener in self.listeners:
+            listener(entries)
+
+
+def _mark_lost(url):
+    """Move an unreachable peer from the active list to LOST_ENDPOINTS."""
+    if url in SERVER_ENDPOINTS:
+        SERVER_ENDPOINTS.remove(url)
+        if url not in LOST_ENDPOINTS:
+            LOST_ENDPOINTS.append(url)
+
+
+def _peer_failed(url):
+    """Count a failure and mark the peer lost once its breaker opens."""
+    if peer_health.record_failure(url):
+        _mark_lost(url)
+
+
+# Shared by the sync loop and the replication pool so both paths see the
+# same failure counts.
+peer_health = PeerHealth(
+    threshold=FAILURE_THRESHOLD,
+    base_delay=BACKOFF_BASE,
+    max_delay=BACKOFF_MAX,
+)
+replicator = Replicator(
+    max_workers=REPLICATION_WORKERS,
+    queue_limit=REPLICATION_QUEUE_LIMIT,
+    on_failure=_mark_lost,
+    # Stay within the batch size peers accept.
+    batch_size=min(REPLICATION_BATCH_SIZE, BATCH_LIMIT),
+    batch_window=REPLICATION_BATCH_WINDOW,
+    compress_min_bytes=COMPRESS_MIN_BYTES if COMPRESS_ENABLED else None,
+    health=peer_health,
+    headers=PEER_HEADERS,
+)
+
+
+_gossip_lock = threading.Lock()
+_gossip_seen = OrderedDict()
+gossip_stats = {'relayed': 0, 'duplicates': 0}
+
+
+def _first_sighting(gossip):
+    """Remember a gossip id. Returns False if it was already seen here."""
+    if not isinstance(gossip, dict) or not gossip.get('id'):
+        return True
+    gossip_id = str(gossip['id'])
+    with _gossip_lock:
+        if gossip_id in _gossip_seen:
+            _gossip_seen.move_to_end(gossip_id)
+            gossip_stats['duplicates'] += 1
+            return False
+        _gossip_seen[gossip_id] = None
+        if len(_gossip_seen) > GOSSIP_SEEN_LIMIT:
+            _gossip_seen.popitem(last=False)
+    return True
 
-def _append_line(path, line):
-    """Append a single line to a file, ignore errors."""
-    try:
-        with open(path, "a") as f:
-            f.write(line + "\n")
-    except Exception:
-        pass
+
+def _gossip(path, payload, gossip):
+    peers = list(SERVER_ENDPOINTS)
+    targets = random.sample(peers, min(int(gossip['fanout']), len(peers)))
+    if targets:
+        replicator.submit(targets, path, dict(payload, gossip=gossip))
 
 
 def _broadcast(path, payload):
-    """Send a POST request with payload to all known endpoints."""
-    for url in list(SERVER_ENDPOINTS):
-        try:
-            requests.post(f"{url}{path}?forwarded=1", json=payload, timeout=5)
-        except Exception:
-            if url in SERVER_ENDPOINTS:
-                SERVER_ENDPOINTS.remove(url)
-                if url not in LOST_ENDPOINTS:
-                    LOST_ENDPOINTS.append(url)
+    """Queue a POST of payload to all known endpoints.
+
+    Delivery happens on the replication pool so the caller only waits for
+    its local write. In gossip mode only GOSSIP_FANOUT random peers are
+    sent the write and they pass it on.
+    """
+    _broadcast_many([(path, payload)])
+
+
+def _broadcast_many(items):
+    """Queue ``(path, payload)`` writes for peers in one replication round.
+
+    In gossip mode each write gets its own gossip id, but the whole group
+    goes to the same random peers.
+    """
+    if not SERVER_ENDPOINTS:
+        return
+    peers = list(SERVER_ENDPOINTS)
+    if GOSSIP_FANOUT <= 0:
+        replicator.submit_many(peers, items)
+        return
+    tagged = []
+    for path, payload in items:
+        gossip = {'id': uuid.uuid4().hex, 'ttl': GOSSIP_TTL, 'fanout': GOSSIP_FANOUT}
+        _first_sighting(gossip)
+        tagged.append((path, dict(payload, gossip=gossip)))
+    replicator.submit_many(random.sample(peers, min(GOSSIP_FANOUT, len(peers))), tagged)
+
+
+def _relay(path, payload, gossip):
+    """Pass a gossiped write on to random peers until its hops run out."""
+    try:
+        ttl = int(gossip.get('ttl', 0)) - 1
+        fanout = int(gossip.get('fanout', GOSSIP_FANOUT))
+    except (AttributeError, TypeError, ValueError):
+        return
+    if ttl <= 0 or fanout <= 0 or not SERVER_ENDPOINTS:
+        return
+    with _gossip_lock:
+        gossip_stats['relayed'] += 1
+    _gossip(path, payload, {'id': gossip['id'], 'ttl': ttl, 'fanout': fanout})
+
+
+def _propagate(path, payload, gossip=None):
+    """Send a write on: to peers if it started here, onward if gossiped."""
+    if not request.args.get('forwarded'):
+        _broadcast(path, payload)
+    elif gossip:
+        _relay(path, payload, gossip)
+
+
+def _format_cursors(cursors):
+    return ','.join(f"{name}:{seq}" for name, seq in cursors.items())
+
+
+def _parse_cursors(value):
+    """Parse ``since`` as one sequence number or ``stream:cursor`` pairs.
+
+    A stream's cursor is a record id or a sequence number.
+    """
+    value = (value or '').strip()
+    if not value:
+        return {}
+    if ':' not in value:
+        seq = int(value)
+        return {name: seq for name in STREAMS}
+    cursors = {}
+    for part in value.split(','):
+        name, _, cursor = part.partition(':')
+        if name.strip() in STREAMS:
+            cursors[name.strip()] = _cursor_seq(STREAMS[name.strip()], cursor.strip())
+    return cursors
+
+
+def _diff_buckets(url, name, stream):
+    """Walk a peer's digest tree and return the buckets that differ."""
+    resp = requests.get(f"{url}/digest/{name}", timeout=5)
+    resp.raise_for_status()
+    local = stream.digest_groups()
+    groups = [g for g, digest in enumerate(resp.json()['groups']) if digest != local[g]]
+    if not groups:
+        return []
+    resp = requests.get(
+        f"{url}/digest/{name}",
+        params={'groups': ','.join(str(g) for g in groups)},
+        timeout=5,
+    )
+    resp.raise_for_status()
+    buckets = []
+    for group, leaves in resp.json()['leaves'].items():
+        group = int(group)
+        mine = stream.digest_leaves(group)
+        start = group * len(mine)
+        buckets.extend(start + i for i, digest in enumerate(leaves) if digest != mine[i])
+    return buckets
+
+
+def _anti_entropy(url):
+    """Fetch only the entries in buckets whose digests differ from a peer's.
+
+    Returns the peer's epoch and the cursors it reported before computing
+    its digests, or None if the peer does not serve digests.
+    """
+    resp = requests.get(f"{url}/digest", timeout=5)
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    data = resp.json()
+    for name, remote in data.get('streams', {}).items():
+        stream = STREAMS.get(name)
+        if stream is None or remote.get('root') == stream.digest_root():
+            continue
+        buckets = _diff_buckets(url, name, stream)
+        for i in range(0, len(buckets), ANTI_ENTROPY_BUCKETS_PER_REQUEST):
+            chunk = buckets[i:i + ANTI_ENTROPY_BUCKETS_PER_REQUEST]
+            resp = requests.get(
+                f"{url}/digest/{name}/entries",
+                params={'buckets': ','.join(str(b) for b in chunk)},
+                timeout=5,
+            )
+            resp.raise_for_status()
+            stream.merge_many(resp.json().get('entries', []))
+    return data.get('epoch'), data.get('cursors', {})
+
+
+def _pull_updates(url):
+    """Fetch and merge every entry a peer has added since our last visit.
+
+    The first visit, a changed peer epoch and every ANTI_ENTROPY_INTERVAL
+    start with a digest comparison instead of replaying history.
+    """
+    state = PEER_CURSORS.get(url)
+    now = time.time()
+    if state is None or now - state['checked'] >= ANTI_ENTROPY_INTERVAL:
+        synced = _anti_entropy(url)
+        if state is None:
+            state = PEER_CURSORS[url] = {'epoch': None, 'cursors': {}}
+        state['checked'] = now
+        if synced is not None:
+            state['epoch'], state['cursors'] = synced
+    while True:
+        resp = requests.get(
+            f"{url}/updates",
+            params={'since': _format_cursors(state['cursors']) or '0',
+                    'limit': UPDATES_PAGE_LIMIT},
+            timeout=5,
+        )
+        if not resp.ok:
+            return
+        data = resp.json()
+        epoch = data.get('epoch')
+        if state['epoch'] is not None and epoch != state['epoch']:
+            # The peer renumbered its streams; reconcile from scratch.
+            del PEER_CURSORS[url]
+            return _pull_updates(url)
+        state['epoch'] = epoch
+        for name, stream in STREAMS.items():
+            stream.merge_many(data.get(name, []))
+        if 'cursors' not in data:
+            # Older peers only serve full snapshots.
+            return
+        state['cursors'].update(data['cursors'])
+        if not data.get('more'):
+            return
 
 
 def _sync_from_servers():
     """Merge updates from peer servers and drop unreachable ones."""
     for url in list(SERVER_ENDPOINTS):
         try:
-            resp = requests.get(f"{url}/updates", timeout=5)
-            if not resp.ok:
-                continue
-            data = resp.json()
-            for entry in data.get('messages', []):
-                if entry not in messages:
-                    messages.append(entry)
-                    _append_line(MESSAGES_FILE, entry)
-            for entry in data.get('memories', []):
-                if entry not in memories:
-                    memories.append(entry)
-                    _append_line(MEMORIES_FILE, entry)
-            for entry in data.get('tasks', []):
-                if entry not in tasks:
-                    tasks.append(entry)
-                    _append_line(TASKS_FILE, entry)
-            for entry in data.get('results', []):
-                if entry not in results:
-                    results.append(entry)
-                    _append_line(RESULTS_FILE, entry)
+            _pull_updates(url)
+            peer_health.record_success(url)
         except Exception:
-            if url in SERVER_ENDPOINTS:
-                SERVER_ENDPOINTS.remove(url)
-                if url not in LOST_ENDPOINTS:
-                    LOST_ENDPOINTS.append(url)
+            _peer_failed(url)
+
+
+def _probe(url):
+    return requests.get(f"{url}/health", timeout=HEALTH_PROBE_TIMEOUT).ok
 
 
 def _retry_lost_endpoints():
-    """Attempt to reconnect to previously unreachable endpoints."""
-    for url in list(LOST_ENDPOINTS):
+    """Probe, all at once, the lost endpoints whose backoff has expired."""
+    for url in peer_health.probe(list(LOST_ENDPOINTS), _probe):
+        if url in LOST_ENDPOINTS:
+            LOST_ENDPOINTS.remove(url)
+        if url not in SERVER_ENDPOINTS:
+            SERVER_ENDPOINTS.append(url)
+
+
+_sync_lock_fd = None
+
+
+def _hold_sync_lock():
+    """Return True if this process should pull from peers.
+
+    With SHARED_STATE only one process syncs at a time. The lock is
+    released by the OS when its holder exits, so another process takes
+    over on its next round.
+    """
+    global _sync_lock_fd
+    if not SHARED_STATE or fcntl is None or _sync_lock_fd is not None:
+        return True
+    fd = os.open(SYNC_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _sync_lock_fd = fd
+    return True
+
+
+sync_duration = Histogram(
+    'clone_sync_round_duration_seconds',
+    'Time taken by one round of registry discovery, peer probes and pulls.',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+_last_sync_round = None
+
+
+# Addresses of the SERVER_ENDPOINTS hosts, looked up by the sync loop so
+# requests never wait on DNS.
+peer_addresses = frozenset()
+_next_peer_lookup = 0.0
+
+
+def _resolve_peer_addresses():
+    """Look up the SERVER_ENDPOINTS host names every PEER_ADDRESS_TTL seconds.
+
+    A name that does not resolve is left out until the next lookup.
+    """
+    global peer_addresses, _next_peer_lookup
+    now = time.monotonic()
+    if now < _next_peer_lookup:
+        return
+    _next_peer_lookup = now + PEER_ADDRESS_TTL
+    found = set()
+    for url in STATIC_ENDPOINTS:
         try:
-            resp = requests.get(f"{url}/health", timeout=5)
-            if resp.ok:
-                LOST_ENDPOINTS.remove(url)
-                if url not in SERVER_ENDPOINTS:
-                    SERVER_ENDPOINTS.append(url)
+            host = urlsplit(url).hostname
+            if host:
+                found.update(info[4][0] for info in socket.getaddrinfo(host, None))
         except Exception:
             pass
+    peer_addresses = frozenset(found)
 
 
 def _sync_loop():
+    global _last_sync_round
     while True:
-        _discover_endpoints()
-        _retry_lost_endpoints()
-        _sync_from_servers()
+        # Every worker process needs the addresses, not just the syncing one.
+        _resolve_peer_addresses()
+        if _hold_sync_lock():
+            start = time.perf_counter()
+            _discover_endpoints()
+            _retry_lost_endpoints()
+            _refresh_task_ring()
+            _sync_from_servers()
+            sync_duration.observe(time.perf_counter() - start)
+            _last_sync_round = time.time()
         time.sleep(SYNC_INTERVAL)
 
 
 def _update_keyword_stats(clone_id, text):
     """Increment keyword counts for the given clone based on text."""
+    global _keyword_pending
     words = text.lower().split()
-    stats = keyword_stats.setdefault(clone_id, {k: 0 for k in KEYWORDS})
-    updates = {}
-    for kw in KEYWORDS:
-        inc = sum(1 for w in words if kw in w)
-        if inc:
-            stats[kw] += inc
-            updates[kw] = stats[kw]
-
-    if updates:
-        try:
-            _ensure_db()
-            conn = sqlite3.connect(DB_NAME)
-            cur = conn.cursor()
-            for kw, count in updates.items():
-                cur.execute(
-                    "INSERT INTO keyword_usage (clone_id, keyword, count) "
-                    "VALUES (?, ?, ?) "
-                    "ON CONFLICT(clone_id, keyword) DO UPDATE SET count=excluded.count",
-                    (clone_id, kw, count),
-                )
-            conn.commit()
-        except Exception:
-            pass
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
+    with _keyword_lock:
+        stats = keyword_stats.setdefault(clone_id, {k: 0 for k in KEYWORDS})
+        for kw in KEYWORDS:
+            inc = sum(1 for w in words if kw in w)
+            if inc:
+                stats[kw] += inc
+                key = (clone_id, kw)
+                _keyword_deltas[key] = _keyword_deltas.get(key, 0) + inc
+                _keyword_pending += 1
+        if _keyword_pending >= KEYWORD_FLUSH_THRESHOLD:
+            _keyword_flush_now.set()
+
+
+def _flush_keyword_stats():
+    """Add every pending keyword increment to the database in one commit."""
+    global _keyword_pending, _keyword_last_flush
+    with _keyword_lock:
+        deltas = dict(_keyword_deltas)
+        rows = [(clone_id, kw, inc) for (clone_id, kw), inc in deltas.items()]
+        _keyword_deltas.clear()
+        _keyword_pending = 0
+    if not rows:
+        _keyword_last_flush = time.time()
+        return
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_NAME)
+        conn.executemany(
+            "INSERT INTO keyword_usage (clone_id, keyword, count) "
+            "VALUES (?, ?, ?) "
+            "ON CONFLICT(clone_id, keyword) DO UPDATE SET count=count + excluded.count",
+            rows,
+        )
+        conn.commit()
+        _keyword_last_flush = time.time()
+    except Exception:
+        with _keyword_lock:
+            for key, inc in deltas.items():
+                _keyword_deltas[key] = _keyword_deltas.get(key, 0) + inc
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def _keyword_flush_loop():
+    while True:
+        _keyword_flush_now.wait(KEYWORD_FLUSH_INTERVAL)
+        _keyword_flush_now.clear()
+        _flush_keyword_stats()
+
+
+threading.Thread(target=_keyword_flush_loop, daemon=True).start()
+atexit.register(_flush_keyword_stats)
 
 app = Flask(__name__)
 CORS(app)
+app.wsgi_app = DecompressMiddleware(app.wsgi_app, stats=compression_stats['requests'])
+
+
+@app.after_request
+def _compress_response(resp):
+    """Compress large or streamed bodies with the encoding the caller accepts."""
+    resp.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    if not COMPRESS_ENABLED or resp.headers.get('Content-Encoding'):
+        return resp
+    if resp.status_code < 200 or resp.status_code in (204, 304):
+        return resp
+    if resp.mimetype == 'text/event-stream':
+        return resp
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if not encoding:
+        return resp
+    if resp.is_streamed:
+        resp.response = compress_stream(resp.response, encoding, compression_stats['responses'])
+        resp.headers.pop('Content-Length', None)
+    else:
+        body = resp.get_data()
+        if len(body) < COMPRESS_MIN_BYTES:
+            return resp
+        wire = compress(body, encoding)
+        resp.set_data(wire)
+        compression_stats['responses'].add(len(body), len(wire))
+    resp.headers['Content-Encoding'] = encoding
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+request_duration = Histogram(
+    'clone_http_request_duration_seconds',
+    'Time to handle a request, up to the first body chunk for streamed responses.',
+    ('route', 'method'),
+)
+request_count = Counter(
+    'clone_http_requests_total',
+    'Requests handled by route, method and status code.',
+    ('route', 'method', 'status'),
+)
+task_forwards = Counter(
+    'clone_task_assign_forwards_total',
+    'Assign requests forwarded to the server owning a task, by outcome.',
+    ('outcome',),
+)
+
+
+@app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def _record_request(resp):
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_duration.observe(time.perf_counter() - start, route, request.method)
+        request_count.inc(route, request.method, str(resp.status_code))
+    return resp
+
 
 # Load persisted data
-messages = _load_lines(MESSAGES_FILE)
-memories = _load_lines(MEMORIES_FILE)
-tasks = _load_lines(TASKS_FILE)
-results = _load_lines(RESULTS_FILE)
+store = open_store(
+    STORE_KIND,
+    STREAM_FILES,
+    db_path=STORE_DB,
+    batch_size=STORE_BATCH,
+    commit_delay=STORE_COMMIT_DELAY,
+    segment_bytes=SEGMENT_BYTES,
+)
+atexit.register(store.close)
+
+# Identifies this server's sequence numbering; peers reset their cursors
+# when it changes (for example after the log files were wiped).
+SERVER_EPOCH = store.epoch
+
+messages = LogStream('messages', store, SHARED_STATE, HOT_ENTRIES, HOT_SECONDS)
+memories = LogStream('memories', store, SHARED_STATE, HOT_ENTRIES, HOT_SECONDS)
+tasks = LogStream('tasks', store, SHARED_STATE, HOT_ENTRIES, HOT_SECONDS)
+results = LogStream('results', store, SHARED_STATE, HOT_ENTRIES, HOT_SECONDS)
+STREAMS = {
+    'messages': messages,
+    'memories': memories,
+    'tasks': tasks,
+    'results': results,
+}
+
+
+def _task_id(entry):
+    """Return a stable id for a task entry stored without one."""
+    return hashlib.blake2b(entry.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _split_task(entry):
+    """Return ``(task_id, task)`` for an entry of the tasks stream."""
+    payload = decode(entry)['payload']
+    if 'task_id' not in payload:
+        # A line written before records existed.
+        return split_task(entry, _task_id)
+    return payload['task_id'], payload['text']
+
+
+def _queue_tasks(entries):
+    task_queue.add_many([_split_task(entry) for entry in entries])
+
+
+task_ring = HashRing()
+
+
+def _owns_task(task_id):
+    owner = task_ring.owner(task_id)
+    return owner is None or owner == CLONE_PUBLIC_URL
+
+
+def _refresh_task_ring():
+    """Rebuild the task ring from the live peers and rebalance on change."""
+    if not (TASK_PARTITION and CLONE_PUBLIC_URL):
+        return
+    if task_ring.rebuild([_normalize_url(url) for url in SERVER_ENDPOINTS + [CLONE_PUBLIC_URL]]):
+        task_queue.rebalance()
+
+
+_task_owns = _owns_task if TASK_PARTITION else None
+if SHARED_STATE:
+    task_queue = SharedTaskQueue(STORE_DB, lease_seconds=TASK_LEASE_SECONDS, owns=_task_owns)
+    if task_queue.is_empty():
+        task_queue.import_journal(store.load('task_events'))
+else:
+    task_queue = TaskQueue(store, journal='task_events', lease_seconds=TASK_LEASE_SECONDS,
+                           owns=_task_owns)
+_refresh_task_ring()
+_queue_tasks(tasks.snapshot())
+tasks.listeners.append(_queue_tasks)
+
+
+def _ack_results(entries):
+    """Acknowledge the task of every new result, however it reached us.
+
+    Results arrive through writes, peer batches, pull sync and anti-entropy;
+    all of them notify the results stream.
+    """
+    for entry in entries:
+        task_id = decode(entry)['payload'].get('task_id')
+        if task_id:
+            task_queue.ack(task_id)
+
+
+results.listeners.append(_ack_results)
+
+compaction_stats = {'last_run': None, 'dropped': {}}
+
+
+def _created_since(cutoff):
+    """Keep entries whose record was created at ``cutoff`` or later.
+
+    Retention goes by the creation time in the record id rather than by
+    when this server stored it. Lines written before records existed count
+    as created at the epoch.
+    """
+    return lambda seq, entry: id_time(record_id(entry)) >= cutoff
+
+
+def _recent(entry, seconds):
+    # Lines written before records existed carry no creation time. Peers
+    # that have not upgraded yet still send them, so they count as recent,
+    # as they do when loaded from disk.
+    created = id_time(record_id(entry))
+    return not created or created >= time.time() - seconds
+
+
+def _retained(seconds):
+    """Admit records created less than ``seconds`` ago.
+
+    Peers that have not compacted yet still offer what compaction dropped
+    here; without this sync would store it again.
+    """
+    return lambda entry: _recent(entry, seconds)
+
+
+def _live_task(entry):
+    # Finished tasks past retention were compacted away; keep them out.
+    if _recent(entry, RETENTION_SECONDS):
+        return True
+    return not task_queue.is_done(_split_task(entry)[0])
+
+
+if COMPACT_INTERVAL > 0:
+    if RETENTION_SECONDS > 0:
+        results.admit = _retained(RETENTION_SECONDS)
+        tasks.admit = _live_task
+    if MESSAGE_RETENTION_SECONDS > 0:
+        messages.admit = _retained(MESSAGE_RETENTION_SECONDS)
+
+
+def _compact_streams():
+    """Drop finished tasks, old results and expired messages from storage.
+
+    Dropped task ids stay known as finished for another retention period,
+    long enough for peers to compact the same entries, so a copy pulled
+    back from a peer is not run again.
+    """
+    now = time.time()
+    dropped = {}
+    if RETENTION_SECONDS > 0:
+        cutoff = now - RETENTION_SECONDS
+        pairs = store.compact('results', _created_since(cutoff), before=cutoff)
+        results.drop(pairs)
+        _unindex('results', pairs)
+        dropped['results'] = len(pairs)
+
+        finished = []
+
+        def keep_task(seq, entry):
+            task_id, _ = _split_task(entry)
+            if task_queue.is_done(task_id):
+                finished.append(task_id)
+                return False
+            return True
+
+        pairs = store.compact('tasks', keep_task, before=cutoff)
+        tasks.drop(pairs)
+        _unindex('tasks', pairs)
+        task_queue.forget(finished)
+        dropped['tasks'] = len(pairs)
+        dropped['task_events'] = task_queue.compact(now - 2 * RETENTION_SECONDS)
+    if MESSAGE_RETENTION_SECONDS > 0:
+        cutoff = now - MESSAGE_RETENTION_SECONDS
+        pairs = store.compact('messages', _created_since(cutoff), before=cutoff)
+        messages.drop(pairs)
+        _unindex('messages', pairs)
+        dropped['messages'] = len(pairs)
+    compaction_stats['last_run'] = now
+    for name, count in dropped.items():
+        compaction_stats['dropped'][name] = compaction_stats['dropped'].get(name, 0) + count
+
+
+def _compaction_loop():
+    while True:
+        time.sleep(COMPACT_INTERVAL)
+        # With SHARED_STATE the process that syncs with peers also compacts.
+        if _hold_sync_lock():
+            try:
+                _compact_streams()
+            except Exception:
+                pass
+
+
+if COMPACT_INTERVAL > 0:
+    threading.Thread(target=_compaction_loop, daemon=True).start()
+
+search_index = None
+if SEARCH_STREAMS:
+    try:
+        search_index = SearchIndex(SEARCH_DB)
+    except sqlite3.Error:
+        # SQLite built without FTS5.
+        SEARCH_STREAMS = []
+_search_wake = threading.Event()
+# Entries read from the store per indexing transaction.
+_SEARCH_PAGE = 5000
+
+
+def _unindex(name, pairs):
+    if search_index is not None and name in SEARCH_STREAMS:
+        search_index.remove(name, [seq for seq, _ in pairs])
+
+
+def _index_streams():
+    """Index entries stored since the last pass. Returns how many."""
+    indexed = 0
+    for name in SEARCH_STREAMS:
+        if name not in STREAMS:
+            continue
+        position = search_index.position(name)
+        if position > STREAMS[name].head():
+            # The log was wiped and started over.
+            search_index.reset(name)
+            position = 0
+        while True:
+            page = store.read(name, position, limit=_SEARCH_PAGE)
+            if not page:
+                break
+            indexed += search_index.add(
+                name, [(seq, render(entry), record_id(entry)) for seq, entry in page])
+            position = page[-1][0]
+            if len(page) < _SEARCH_PAGE:
+                break
+    return indexed
+
+
+def _search_loop():
+    while True:
+        _search_wake.wait(SEARCH_INTERVAL)
+        _search_wake.clear()
+        # With SHARED_STATE the process that syncs with peers also indexes.
+        if _hold_sync_lock():
+            try:
+                _index_streams()
+            except Exception:
+                pass
+
+
+if search_index is not None:
+    for _name in SEARCH_STREAMS:
+        if _name in STREAMS:
+            STREAMS[_name].listeners.append(lambda entries: _search_wake.set())
+    threading.Thread(target=_search_loop, daemon=True).start()
+
+# Replicated write paths accepted by /batch and the stream and payload
+# field each one stores.
+BATCH_ROUTES = {
+    '/send': ('messages', 'message'),
+    '/remember': ('memories', 'fact'),
+    '/task': ('tasks', 'task'),
+    '/task/result': ('results', 'result'),
+}
+
+
+def _incoming_record(name, data, field):
+    """Return the record a write request stores in stream ``name``.
+
+    Peers replicating a write send the record the origin server made, so it
+    is stored under the same id everywhere. Other requests get a new record
+    for their ``field`` text from clone ``id``. Returns None when there is
+    no text to store.
+    """
+    record = validate(data.get('record'), name)
+    if record is None:
+        text = data.get(field)
+        if text is None:
+            return None
+        payload = {'text': str(text)}
+        if isinstance(data.get('task_id'), str):
+            payload['task_id'] = data['task_id']
+        record = make(name, str(data.get('id', 'unknown')), payload)
+    payload = record['payload']
+    if not payload['text'] and name != 'results':
+        return None
+    payload['text'] = sanitize_text(payload['text'])
+    if name == 'tasks' and not is_task_id(payload.get('task_id')):
+        payload['task_id'] = uuid.uuid4().hex
+    return record
+
+
+def _replica(record, field):
+    """Return the payload that passes ``record`` on to peers.
+
+    The flat fields keep peers from before records working.
+    """
+    payload = {'id': record['origin'], field: record['payload']['text'], 'record': record}
+    if 'task_id' in record['payload']:
+        payload['task_id'] = record['payload']['task_id']
+    return payload
+
+
+def _store_batch(batches):
+    """Store ``{stream name: [records]}`` with a single storage write.
+
+    Records already stored are skipped. Keyword counts are updated for the
+    new ones. Returns how many were stored.
+    """
+    involved = [stream for name, stream in STREAMS.items() if batches.get(name)]
+    lines = {stream.name: [encode(record) for record in batches[stream.name]]
+             for stream in involved}
+    if SHARED_STATE:
+        # Another process may store the same records meanwhile; the store
+        # checks again inside its transaction.
+        fresh = {}
+        for stream in involved:
+            stream.refresh()
+            with stream.lock:
+                fresh[stream.name] = stream.fresh(lines[stream.name])
+        store.insert_many([(name, fresh[name]) for name in fresh if fresh[name]],
+                          dedup=True).wait()
+        for stream in involved:
+            stream.refresh()
+    else:
+        staged = {}
+        for stream in involved:
+            stream.lock.acquire()
+        try:
+            fresh = {stream.name: stream.fresh(lines[stream.name]) for stream in involved}
+            staged = {stream: stream.stage(fresh[stream.name])
+                      for stream in involved if fresh[stream.name]}
+            pending = store.append_many([(stream.name, records)
+                                         for stream, records in staged.items()])
+        except Exception:
+            for stream, records in staged.items():
+                stream.unstage(records)
+            raise
+        finally:
+            for stream in reversed(involved):
+                stream.lock.release()
+        try:
+            pending.wait()
+        except Exception:
+            for stream, records in staged.items():
+                with stream.lock:
+                    stream.unstage(records)
+            raise
+        for stream in involved:
+            if fresh[stream.name]:
+                stream.notify(fresh[stream.name])
+    for name, records in batches.items():
+        if name in ('messages', 'memories'):
+            new = {record_id(line) for line in fresh.get(name, ())}
+            for record in records:
+                if record['id'] in new:
+                    _update_keyword_stats(record['origin'], record['payload']['text'])
+    return sum(len(entries) for entries in fresh.values())
+
+
+def _accept_write(path, data):
+    """Store the write ``data`` posted to ``path`` and pass it on.
+
+    Returns the record, or None when the request holds no text.
+    """
+    name, field = BATCH_ROUTES[path]
+    record = _incoming_record(name, data, field)
+    if record is None:
+        return None
+    gossip = data.get('gossip')
+    if _first_sighting(gossip):
+        _store_batch({name: [record]})
+        _propagate(path, _replica(record, field), gossip)
+    return record
+
+
+rate_limits = {
+    'clone': RateLimiter(CLONE_RATE, CLONE_BURST, RATE_LIMIT_KEYS),
+    'ip': RateLimiter(IP_RATE, IP_BURST, RATE_LIMIT_KEYS),
+}
+_LIMITED_PATHS = {path: path for path in BATCH_ROUTES}
+_LIMITED_PATHS.update({f"{path}/batch": path for path in BATCH_ROUTES})
+_LIMITED_PATHS['/batch'] = '/batch'
+
+
+def _from_peer():
+    """True when the current request comes from a peer server."""
+    token = request.headers.get(PEER_TOKEN_HEADER)
+    if PEER_TOKEN and token and hmac.compare_digest(token, PEER_TOKEN):
+        return True
+    return request.remote_addr in peer_addresses
+
+
+def _origin(item):
+    # The clone a write item is charged to, as _incoming_record reads it.
+    record = item.get('record')
+    if isinstance(record, dict) and isinstance(record.get('origin'), str):
+        return record['origin']
+    return str(item.get('id', 'unknown'))
+
+
+def _write_costs(data):
+    """Return ``{clone id: items}`` for the body of a write request.
+
+    Returns None for a batch over BATCH_LIMIT, which is refused unstored.
+    """
+    if not isinstance(data, (dict, list)):
+        return {}
+    if request.path.endswith('/batch'):
+        origin = None
+        if isinstance(data, dict):
+            origin = data.get('id')
+            data = data.get('items')
+        if not isinstance(data, list):
+            return {}
+        if len(data) > BATCH_LIMIT:
+            return None
+        if request.path == '/batch':
+            # Replicated writes: each item wraps the body of a single write.
+            data = [item.get('payload') if isinstance(item, dict) else None for item in data]
+        costs = {}
+        for item in data:
+            if isinstance(item, dict):
+                key = _origin(item if origin is None else dict(item, id=item.get('id', origin)))
+            else:
+                key = str(origin if origin is not None else 'unknown')
+            costs[key] = costs.get(key, 0) + 1
+        return costs
+    return {_origin(data): 1} if isinstance(data, dict) else {}
+
+
+@app.before_request
+def _admit_write():
+    """Answer 429 to client writes over their clone's or address's rate.
+
+    Writes from peers are not limited; each was admitted by the server it
+    reached first. A ``forwarded`` flag alone does not make a client a peer.
+    """
+    if request.path not in _LIMITED_PATHS:
+        return None
+    if not (rate_limits['clone'].enabled or rate_limits['ip'].enabled):
+        return None
+    if _from_peer():
+        return None
+    try:
+        # Not silent, so the handler reuses the parsed body.
+        data = request.get_json(force=True)
+    except Exception:
+        data = None
+    clones = _write_costs(data)
+    if clones is None:
+        return _too_large()
+    address = {request.remote_addr or 'unknown': max(1, sum(clones.values()))}
+    wait = max(rate_limits['clone'].wait(clones), rate_limits['ip'].wait(address))
+    if wait:
+        resp = jsonify({'error': 'rate limited', 'retry_after': round(wait, 3)})
+        resp.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+        return resp, 429
+    rate_limits['clone'].charge(clones)
+    rate_limits['ip'].charge(address)
+    return None
+
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -240,98 +1707,586 @@ def health():
 
 @app.route('/send', methods=['POST'])
 def send_message():
-    data = request.get_json(force=True)
-    clone_id = data.get('id', 'unknown')
-    msg = data.get('message', '')
-    if msg:
-        msg = sanitize_text(msg)
-        entry = f"{clone_id}: {msg}"
-        messages.append(entry)
-        _append_line(MESSAGES_FILE, entry)
-        _update_keyword_stats(clone_id, msg)
-        if not request.args.get('forwarded'):
-            _broadcast('/send', {'id': clone_id, 'message': msg})
-        return jsonify({'status': 'ok'})
-    return jsonify({'error': 'missing message'}), 400
+    record = _accept_write('/send', request.get_json(force=True))
+    if record is None:
+        return jsonify({'error': 'missing message'}), 400
+    return jsonify({'status': 'ok', 'record_id': record['id']})
+
+def _view(stream, entry, fmt):
+    """Return an entry as ``"origin: text"`` or, for ``json``, its record."""
+    return to_json(entry, stream.name) if fmt == 'json' else render(entry)
+
+
+def _iter_text(stream, cursor, until, fmt):
+    """Yield newline separated entries in bounded chunks."""
+    first = True
+    while True:
+        page, cursor, more = stream.since(cursor, READ_CHUNK_SIZE, until)
+        if page:
+            body = '\n'.join(_view(stream, entry, fmt) for entry in page)
+            yield body if first else '\n' + body
+            first = False
+        if not more:
+            return
+
+
+def _cursor_seq(stream, value):
+    """Return the sequence number a cursor points at.
+
+    Cursors are record ids. Plain sequence numbers from older clients still
+    work. An id that is no longer stored was compacted away, so reading
+    resumes at the oldest entry left.
+    """
+    if is_id(value):
+        seq = stream.seq_of(value)
+        return 0 if seq is None else seq
+    return int(value)
+
+
+def _cursor_token(stream, seq):
+    """Return the cursor for resuming after ``seq``: its record id."""
+    entry = stream.entry_at(seq) if seq else None
+    return record_id(entry) if entry is not None else str(seq)
+
+
+def _text_response(stream):
+    """Stream entries as text, honouring ``cursor``, ``limit`` and ``tail``.
+
+    ``tail`` starts from the newest N entries, ``cursor`` resumes after a
+    record id and ``limit`` caps the page size. The cursor for the next
+    page is returned in ``X-Next-Cursor`` and ``X-More`` is "1" when
+    further entries remain. ``format=json`` returns one JSON record per
+    line instead of the ``"origin: text"`` view.
+    """
+    try:
+        cursor = request.args.get('cursor')
+        cursor = _cursor_seq(stream, cursor) if cursor else None
+    except ValueError:
+        return jsonify({'error': 'invalid cursor'}), 400
+    limit = request.args.get('limit', type=int)
+    tail = request.args.get('tail', type=int)
+    fmt = request.args.get('format', 'text')
+    if cursor is None:
+        cursor = stream.tail_cursor(tail) if tail is not None else 0
+    if limit is not None:
+        limit = max(1, limit)
+    until, more = stream.page_bounds(cursor, limit)
+    resp = Response(
+        stream_with_context(_iter_text(stream, cursor, until, fmt)),
+        mimetype='application/x-ndjson' if fmt == 'json' else 'text/plain',
+    )
+    resp.headers['X-Next-Cursor'] = _cursor_token(stream, until)
+    resp.headers['X-More'] = '1' if more else '0'
+    return resp
+
 
 @app.route('/read', methods=['GET'])
 def read_messages():
-    return '\n'.join(messages)
+    return _text_response(messages)
 
 @app.route('/remember', methods=['POST'])
 def remember_fact():
-    data = request.get_json(force=True)
-    clone_id = data.get('id', 'unknown')
-    fact = data.get('fact', '')
-    if fact:
-        fact = sanitize_text(fact)
-        entry = f"{clone_id}: {fact}"
-        memories.append(entry)
-        _append_line(MEMORIES_FILE, entry)
-        _update_keyword_stats(clone_id, fact)
-        if not request.args.get('forwarded'):
-            _broadcast('/remember', {'id': clone_id, 'fact': fact})
-        return jsonify({'status': 'ok'})
-    return jsonify({'error': 'missing fact'}), 400
+    record = _accept_write('/remember', request.get_json(force=True))
+    if record is None:
+        return jsonify({'error': 'missing fact'}), 400
+    return jsonify({'status': 'ok', 'record_id': record['id']})
 
 @app.route('/memories', methods=['GET'])
 def get_memories():
-    return '\n'.join(memories)
+    return _text_response(memories)
+
+
+@app.route('/stats', methods=['GET'])
+def server_stats():
+    """Return stream sizes and per-peer replication queue depth."""
+    return jsonify({
+        'streams': {name: len(stream) for name, stream in STREAMS.items()},
+        'hot_entries': {name: len(stream.entries) for name, stream in STREAMS.items()},
+        'replication': replicator.stats(),
+        'gossip': dict(gossip_stats, fanout=GOSSIP_FANOUT, seen=len(_gossip_seen)),
+        'compression': {
+            name: stats.snapshot() for name, stats in compression_stats.items()
+        },
+        'tasks': task_queue.stats(),
+        'task_owners': list(task_ring.members),
+        'search': {name: search_index.position(name) for name in SEARCH_STREAMS}
+                  if search_index is not None else None,
+        'compaction': compaction_stats,
+        'keywords': {
+            'pending': _keyword_pending,
+            'last_flush': _keyword_last_flush,
+        },
+        'rate_limits': {name: limiter.stats() for name, limiter in rate_limits.items()},
+        'lost_endpoints': list(LOST_ENDPOINTS),
+        'peers': peer_health.stats(),
+        'registry': len(registry) if registry is not None else None,
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Expose server metrics in the Prometheus text format."""
+    now = time.time()
+    replication = replicator.stats()
+    lines = request_duration.render() + request_count.render() + sync_duration.render()
+    lines += task_forwards.render()
+    lines += family('clone_sync_last_round_age_seconds',
+                    'Seconds since the last completed sync round.', 'gauge',
+                    [((), now - _last_sync_round if _last_sync_round else None)])
+    lines += family('clone_stream_entries', 'Entries stored per stream.', 'gauge',
+                    [((('stream', name),), len(stream)) for name, stream in STREAMS.items()])
+    lines += family('clone_replication_pending', 'Writes queued for each peer.', 'gauge',
+                    [((('peer', url),), n) for url, n in sorted(replication['pending'].items())])
+    for key, help_text in (('sent', 'Writes delivered to each peer.'),
+                           ('dropped', 'Writes dropped for each peer.')):
+        lines += family(f'clone_replication_{key}_total', help_text, 'counter',
+                        [((('peer', url),), n) for url, n in sorted(replication[key].items())])
+    lines += family('clone_peers', 'Known peers by state.', 'gauge',
+                    [((('state', 'active'),), len(SERVER_ENDPOINTS)),
+                     ((('state', 'lost'),), len(LOST_ENDPOINTS))])
+    lines += family('clone_peer_failures', 'Consecutive failures of unhealthy peers.', 'gauge',
+                    [((('peer', url),), state['failures'])
+                     for url, state in sorted(peer_health.stats().items())])
+    lines += family('clone_tasks', 'Tasks by queue state.', 'gauge',
+                    [((('state', state),), n) for state, n in sorted(task_queue.stats().items())])
+    lines += family('clone_gossip_total', 'Gossiped writes relayed or dropped as duplicates.',
+                    'counter', [((('kind', k),), n) for k, n in sorted(gossip_stats.items())])
+    lines += family('clone_rate_limited_total', 'Client writes refused with 429, by limit.',
+                    'counter', [((('limit', name),), limiter.throttled)
+                                for name, limiter in sorted(rate_limits.items())])
+    lines += family('clone_keyword_pending', 'Keyword increments waiting to be flushed.',
+                    'gauge', [((), _keyword_pending)])
+    lines += family('clone_keyword_flush_lag_seconds', 'Seconds since keyword counts were flushed.',
+                    'gauge', [((), now - _keyword_last_flush)])
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/search', methods=['GET'])
+def search_entries():
+    """Return ranked full-text matches from the indexed streams.
+
+    All words of ``q`` must match, ``word*`` matches a prefix and
+    ``"a phrase"`` matches words in order. ``stream`` restricts the search
+    to one stream; ``limit`` (at most 100) and ``offset`` page through the
+    hits, best first. ``next_offset`` is null on the last page. Each hit
+    carries its record ``id``, which names it on every server.
+    """
+    if search_index is None:
+        return jsonify({'error': 'search is disabled'}), 503
+    query = request.args.get('q', '')
+    name = request.args.get('stream')
+    if name and name not in SEARCH_STREAMS:
+        return jsonify({'error': f'stream {name!r} is not indexed'}), 400
+    limit = min(100, max(1, request.args.get('limit', 20, type=int)))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    try:
+        hits, more = search_index.search(query, [name] if name else SEARCH_STREAMS, limit, offset)
+    except ValueError:
+        return jsonify({'error': 'missing q'}), 400
+    return jsonify({'hits': hits, 'next_offset': offset + len(hits) if more else None})
 
 
 @app.route('/keywords', methods=['GET'])
 def get_keyword_stats():
     """Return keyword usage statistics."""
-    return jsonify(keyword_stats)
+    if SHARED_STATE:
+        # Other processes count their own requests; the database has the sum.
+        _flush_keyword_stats()
+        return jsonify(_load_keyword_stats())
+    with _keyword_lock:
+        return jsonify(keyword_stats)
 
 @app.route('/task', methods=['POST'])
 def add_task():
-    data = request.get_json(force=True)
-    task = data.get('task')
-    if task:
-        task = sanitize_text(task)
-        tasks.append(task)
-        _append_line(TASKS_FILE, task)
-        if not request.args.get('forwarded'):
-            _broadcast('/task', {'task': task})
-        return jsonify({'status': 'queued'})
-    return jsonify({'error': 'missing task'}), 400
+    record = _accept_write('/task', request.get_json(force=True))
+    if record is None:
+        return jsonify({'error': 'missing task'}), 400
+    return jsonify({'status': 'queued', 'task_id': record['payload']['task_id'],
+                    'record_id': record['id']})
+
+def _forward_assign(worker):
+    """Ask the owner of the oldest task queued elsewhere for a lease.
+
+    When no server answers as that owner the task is leased here instead,
+    so a dead or misnamed owner cannot strand its tasks.
+    """
+    task_id = task_queue.next_foreign()
+    url = task_ring.owner(task_id) if task_id else None
+    if url is None or url == CLONE_PUBLIC_URL:
+        return None
+    try:
+        resp = requests.get(
+            f"{url}/task/assign",
+            params={'id': worker, 'forwarded': '1'},
+            headers=PEER_HEADERS,
+            timeout=5,
+        )
+        resp.raise_for_status()
+        data = resp.json()
+    except Exception:
+        task_forwards.inc('failed')
+        _peer_failed(url)
+        return _adopt_task(task_id, worker)
+    peer_health.record_success(url)
+    if not data.get('task'):
+        task_forwards.inc('empty')
+        # Servers name themselves in the reply; one that goes by another
+        # URL means nobody owns the task under the name the ring gave it.
+        server = data.get('server')
+        if server is not None and _normalize_url(server) != url:
+            return _adopt_task(task_id, worker)
+        return None
+    task_forwards.inc('leased')
+    data['owner'] = url
+    return data
+
+
+def _adopt_task(task_id, worker):
+    task_queue.adopt(task_id)
+    lease = task_queue.lease(worker)
+    if lease is None:
+        return None
+    task_forwards.inc('adopted')
+    task_id, task, expires = lease
+    return {'task': task, 'task_id': task_id, 'lease_expires': expires}
+
 
 @app.route('/task/assign', methods=['GET'])
 def assign_task():
-    if tasks:
-        task = tasks.pop(0)
-        return jsonify({'task': task})
-    return jsonify({'task': None})
+    """Lease the next queued task to the calling clone.
+
+    The worker must report back through /task/result with the returned
+    ``task_id`` before ``lease_expires``, otherwise the task is requeued.
+    Only tasks this server owns are leased here. With none queued the
+    request is forwarded to the owner of the oldest task queued elsewhere.
+    """
+    worker = request.args.get('id', 'unknown')
+    _refresh_task_ring()
+    lease = task_queue.lease(worker)
+    if lease is None:
+        if not request.args.get('forwarded'):
+            forwarded = _forward_assign(worker)
+            if forwarded is not None:
+                return jsonify(forwarded)
+        return jsonify({'task': None, 'server': CLONE_PUBLIC_URL})
+    task_id, task, expires = lease
+    return jsonify({'task': task, 'task_id': task_id, 'lease_expires': expires,
+                    'server': CLONE_PUBLIC_URL})
 
 @app.route('/task/result', methods=['POST'])
 def store_result():
+    record = _accept_write('/task/result', request.get_json(force=True))
+    if record is None:
+        return jsonify({'error': 'missing result'}), 400
+    return jsonify({'status': 'stored', 'record_id': record['id']})
+
+
+def _too_large():
+    return jsonify({'error': f'at most {BATCH_LIMIT} items per batch'}), 413
+
+
+@app.route('/batch', methods=['POST'])
+def ingest_batch():
+    """Store a batch of replicated writes from a peer in one transaction."""
     data = request.get_json(force=True)
-    result = data.get('result')
-    clone_id = data.get('id', 'unknown')
-    if result is not None:
-        result = sanitize_text(str(result))
-        entry = f"{clone_id}: {result}"
-        results.append(entry)
-        _append_line(RESULTS_FILE, entry)
-        if not request.args.get('forwarded'):
-            _broadcast('/task/result', {'id': clone_id, 'result': result})
-        return jsonify({'status': 'stored'})
-    return jsonify({'error': 'missing result'}), 400
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not all(
+            isinstance(item, dict) and isinstance(item.get('path'), str)
+            and isinstance(item.get('payload') or {}, dict) for item in items):
+        return jsonify({'error': 'items must be objects with a path and payload'}), 400
+    if len(items) > BATCH_LIMIT:
+        return _too_large()
+    batches = {}
+    relays = []
+    for item in items:
+        route = BATCH_ROUTES.get(item['path'])
+        payload = item.get('payload') or {}
+        if not route:
+            continue
+        name, field = route
+        record = _incoming_record(name, payload, field)
+        if record is None:
+            continue
+        gossip = payload.get('gossip')
+        if not _first_sighting(gossip):
+            continue
+        batches.setdefault(name, []).append(record)
+        if gossip:
+            relays.append((item['path'], _replica(record, field), gossip))
+    stored = _store_batch(batches)
+    for path, payload, gossip in relays:
+        _relay(path, payload, gossip)
+    return jsonify({'status': 'ok', 'stored': stored})
+
+
+def _accept_batch(path):
+    """Store an array of writes to ``path`` and pass them on to peers.
+
+    The body is a JSON array, or an object whose ``items`` array shares its
+    ``id``. Each item is the body the single write endpoint takes, or just
+    the text. All items are stored in one transaction and queued for peers
+    in one replication round. ``record_ids`` lines up with the items and is
+    null for an item without text.
+    """
+    name, field = BATCH_ROUTES[path]
+    data = request.get_json(force=True)
+    origin = None
+    if isinstance(data, dict):
+        origin = data.get('id')
+        data = data.get('items')
+    if not isinstance(data, list) or not data:
+        return jsonify({'error': 'missing items'}), 400
+    if len(data) > BATCH_LIMIT:
+        return _too_large()
+    records = []
+    found = []
+    for item in data:
+        if isinstance(item, str):
+            item = {field: item}
+        record = None
+        if isinstance(item, dict):
+            if origin is not None:
+                item.setdefault('id', origin)
+            record = _incoming_record(name, item, field)
+        if record is not None:
+            records.append(record)
+        found.append(record)
+    stored = _store_batch({name: records})
+    if not request.args.get('forwarded'):
+        _broadcast_many([(path, _replica(record, field)) for record in records])
+    body = {'status': 'ok', 'stored': stored,
+            'record_ids': [record and record['id'] for record in found]}
+    if name == 'tasks':
+        body['task_ids'] = [record and record['payload']['task_id'] for record in found]
+    return jsonify(body)
+
+
+@app.route('/send/batch', methods=['POST'])
+def send_batch():
+    return _accept_batch('/send')
+
+
+@app.route('/remember/batch', methods=['POST'])
+def remember_batch():
+    return _accept_batch('/remember')
+
+
+@app.route('/task/batch', methods=['POST'])
+def add_task_batch():
+    return _accept_batch('/task')
+
+
+@app.route('/task/result/batch', methods=['POST'])
+def store_result_batch():
+    return _accept_batch('/task/result')
+
+
+registry = Registry(REGISTRY_TTL) if REGISTRY_MODE else None
+
+
+@app.route('/register', methods=['POST'])
+def register_server():
+    """Record a heartbeat from a server, or remove it when ``leave`` is set."""
+    if registry is None:
+        return jsonify({'error': 'registry mode disabled'}), 404
+    data = request.get_json(force=True)
+    url = _normalize_url(data.get('url'))
+    if not url.startswith(('http://', 'https://')):
+        return jsonify({'error': 'invalid url'}), 400
+    if data.get('leave'):
+        registry.unregister(url)
+    else:
+        registry.register(url)
+    return jsonify({'status': 'ok', 'ttl': registry.ttl})
+
+
+@app.route('/list', methods=['GET'])
+def list_servers():
+    """Return live servers, or 304 when ``If-None-Match`` is current."""
+    if registry is None:
+        return jsonify({'error': 'registry mode disabled'}), 404
+    etag, body = registry.listing()
+    resp = Response(body, mimetype='application/json')
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+
+@app.route('/digest', methods=['GET'])
+def digest_roots():
+    """Return every stream's root digest and current cursor."""
+    body = {'epoch': SERVER_EPOCH, 'cursors': {}, 'streams': {}}
+    for name, stream in STREAMS.items():
+        body['cursors'][name] = stream.head()
+        body['streams'][name] = {'root': stream.digest_root()}
+    return jsonify(body)
+
+
+@app.route('/digest/<name>', methods=['GET'])
+def digest_tree(name):
+    """Return group digests, or the bucket digests of the listed ``groups``."""
+    stream = STREAMS.get(name)
+    if stream is None:
+        return jsonify({'error': 'unknown stream'}), 404
+    groups = request.args.get('groups')
+    if not groups:
+        return jsonify({'groups': stream.digest_groups()})
+    try:
+        wanted = sorted({int(g) for g in groups.split(',')})
+    except ValueError:
+        return jsonify({'error': 'invalid groups'}), 400
+    if any(not 0 <= g < FANOUT for g in wanted):
+        return jsonify({'error': 'invalid groups'}), 400
+    leaves = {str(g): stream.digest_leaves(g) for g in wanted}
+    return jsonify({'leaves': leaves})
+
+
+@app.route('/digest/<name>/entries', methods=['GET'])
+def digest_entries(name):
+    """Return the entries stored in the listed digest ``buckets``."""
+    stream = STREAMS.get(name)
+    if stream is None:
+        return jsonify({'error': 'unknown stream'}), 404
+    try:
+        buckets = [int(b) for b in request.args.get('buckets', '').split(',') if b]
+    except ValueError:
+        return jsonify({'error': 'invalid buckets'}), 400
+    return jsonify({'entries': stream.bucket_entries(buckets)})
 
 
 @app.route('/updates', methods=['GET'])
 def all_updates():
-    """Return all stored messages, memories, tasks and results."""
-    return jsonify({
-        'messages': messages,
-        'memories': memories,
-        'tasks': tasks,
-        'results': results,
-    })
+    """Return stored messages, memories, tasks and results.
 
-if __name__ == '__main__':
+    ``since`` selects entries after a cursor: either one sequence number
+    for every stream or comma separated ``stream:seq`` pairs. ``limit``
+    caps the entries returned per stream and ``more`` is set when any
+    stream has another page. Without ``since`` the full history is sent.
+    """
+    since = request.args.get('since')
+    limit = request.args.get('limit', type=int)
+    if since is not None and limit is None:
+        limit = UPDATES_PAGE_LIMIT
+    if limit is not None:
+        limit = max(1, limit)
+    try:
+        cursors = _parse_cursors(since)
+    except ValueError:
+        return jsonify({'error': 'invalid since'}), 400
+    body = {'epoch': SERVER_EPOCH, 'cursors': {}, 'more': False}
+    for name, stream in STREAMS.items():
+        page, cursor, more = stream.since(cursors.get(name, 0), limit)
+        body[name] = page
+        body['cursors'][name] = cursor
+        body['more'] = body['more'] or more
+    return jsonify(body)
+
+# Streams pushed by /stream unless the caller picks others.
+STREAM_DEFAULT = ('messages', 'memories', 'results')
+# Seconds between keepalive comments on an idle /stream connection.
+STREAM_KEEPALIVE = float(os.getenv("SERVER_STREAM_KEEPALIVE", "15"))
+_stream_changed = threading.Condition()
+_stream_version = 0
+
+
+def _wake_subscribers(entries):
+    global _stream_version
+    with _stream_changed:
+        _stream_version += 1
+        _stream_changed.notify_all()
+
+
+for _stream in STREAMS.values():
+    _stream.listeners.append(_wake_subscribers)
+
+
+def _sse_event(name, entries, tokens, fmt):
+    """Format ``entries`` as SSE events, tagging the last with the cursors."""
+    lines = []
+    for i, entry in enumerate(entries):
+        lines.append(f"event: {name}")
+        lines.extend(f"data: {part}" for part in _view(STREAMS[name], entry, fmt).split('\n'))
+        if i == len(entries) - 1:
+            lines.append(f"id: {_format_cursors(tokens)}")
+        lines.append('')
+    return '\n'.join(lines) + '\n'
+
+
+def _iter_events(selected, cursors, fmt):
+    yield f"retry: {int(STREAM_KEEPALIVE * 1000)}\n\n"
+    # Event ids carry record ids, so a client can resume on any server.
+    tokens = {name: _cursor_token(STREAMS[name], cursors[name]) for name in selected}
+    # Shared-state workers are not woken by writes in other processes.
+    wait = min(1.0, STREAM_KEEPALIVE) if SHARED_STATE else STREAM_KEEPALIVE
+    last_sent = time.time()
+    while True:
+        version = _stream_version
+        for name in selected:
+            more = True
+            while more:
+                page, cursor, more = STREAMS[name].since(cursors[name], READ_CHUNK_SIZE)
+                if not page:
+                    break
+                cursors[name] = cursor
+                tokens[name] = record_id(page[-1])
+                yield _sse_event(name, page, tokens, fmt)
+                last_sent = time.time()
+        with _stream_changed:
+            if _stream_version == version:
+                _stream_changed.wait(wait)
+        if time.time() - last_sent >= STREAM_KEEPALIVE:
+            yield ": keepalive\n\n"
+            last_sent = time.time()
+
+
+@app.route('/stream', methods=['GET'])
+def stream_events():
+    """Push new entries to the caller as server-sent events.
+
+    ``streams`` picks the streams to follow (messages, memories and results
+    by default). Events start after the ``since`` cursors, the
+    ``Last-Event-ID`` header of a reconnecting client, or the newest
+    ``tail`` entries; otherwise only entries stored from now on are sent.
+    Each event is named after its stream and its id holds the cursors to
+    resume from. ``format=json`` sends records instead of the text view.
+    """
+    names = request.args.get('streams')
+    selected = [n.strip() for n in names.split(',')] if names else list(STREAM_DEFAULT)
+    if not selected or any(name not in STREAMS for name in selected):
+        return jsonify({'error': 'unknown stream'}), 400
+    since = request.args.get('since') or request.headers.get('Last-Event-ID')
+    tail = request.args.get('tail', type=int)
+    try:
+        given = _parse_cursors(since)
+    except ValueError:
+        return jsonify({'error': 'invalid since'}), 400
+    cursors = {}
+    for name in selected:
+        if name in given:
+            cursors[name] = given[name]
+        elif tail is not None:
+            cursors[name] = STREAMS[name].tail_cursor(tail)
+        else:
+            cursors[name] = STREAMS[name].head()
+    resp = Response(
+        stream_with_context(_iter_events(selected, cursors, request.args.get('format', 'text'))),
+        mimetype='text/event-stream',
+    )
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+
+def _start_sync():
     if SERVER_ENDPOINTS or REGISTRY_URL:
         threading.Thread(target=_sync_loop, daemon=True).start()
+
+
+# Worker processes import the app without running __main__.
+if SHARED_STATE:
+    _start_sync()
+
+if __name__ == '__main__':
+    if not SHARED_STATE:
+        _start_sync()
     port = int(os.getenv('CLONE_PORT', '5000'))
     app.run(host='0.0.0.0', port=port)
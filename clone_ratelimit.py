@@ -0,0 +1,89 @@
+"""Token bucket rate limits for clone network writes."""
+
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    """Token buckets keyed by clone id, address or anything else.
+
+    Every key gets ``burst`` tokens that refill at ``rate`` per second. A
+    request is admitted while its bucket is not empty and then pays its full
+    cost, so one large batch can leave the bucket in debt instead of never
+    fitting. Buckets live in memory and are updated in place, so a check is
+    a dict lookup and a little arithmetic. At most ``max_keys`` buckets are
+    kept; the one used longest ago is forgotten first, which only hands a
+    quiet key the full bucket it would have refilled to anyway.
+
+    A ``rate`` of 0 turns the limiter off.
+    """
+
+    def __init__(self, rate, burst=None, max_keys=100000):
+        self.rate = rate
+        self.burst = max(1.0, burst if burst is not None else rate)
+        self.max_keys = max_keys
+        self.throttled = 0
+        self._lock = threading.Lock()
+        # key -> [tokens, last refill time, requests throttled]
+        self._buckets = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def _bucket(self, key, now):
+        # Caller holds self._lock.
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now, 0]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def wait(self, costs):
+        """Return the seconds until ``{key: cost}`` is admitted, 0 if now.
+
+        Nothing is charged; call ``charge`` once every limiter the request
+        passes through has admitted it. A refusal counts as a throttle.
+        """
+        if not self.enabled or not costs:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            for key in costs:
+                bucket = self._bucket(key, now)
+                if bucket[0] < 1:
+                    bucket[2] += 1
+                    wait = max(wait, (1 - bucket[0]) / self.rate)
+            if wait:
+                self.throttled += 1
+            return wait
+
+    def charge(self, costs):
+        """Take ``cost`` tokens from the bucket of every key in ``costs``."""
+        if not self.enabled or not costs:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for key, cost in costs.items():
+                self._bucket(key, now)[0] -= cost
+
+    def stats(self, top=10):
+        """Return the settings, tracked keys and most throttled keys."""
+        with self._lock:
+            worst = heapq.nlargest(top, ((bucket[2], key) for key, bucket in
+                                         self._buckets.items() if bucket[2]))
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'tracked': len(self._buckets),
+                'throttled': self.throttled,
+                'top': {key: count for count, key in worst},
+            }
@@ -0,0 +1,181 @@
+"""Structured records stored in clone network streams.
+
+Every stream entry is a record: a unique id, the clone it came from, the
+time it was created, its stream and a payload. Records are stored and
+replicated as one line of JSON with the id first. Ids are ULIDs, 48 bits of
+milliseconds followed by 80 random bits in Crockford base32, so they sort
+by creation time and two identical messages are still two records.
+
+Lines stored before records existed are plain ``"origin: text"`` strings.
+They are read as records whose id is derived from their text, so every
+server gives such a line the same id, and they are never rewritten.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+
+_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_CROCKFORD = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ234567', _ALPHABET)
+# Crockford digits to the ones int(value, 32) reads.
+_DIGITS = str.maketrans(_ALPHABET, '0123456789ABCDEFGHIJKLMNOPQRSTUV')
+_ID = re.compile(r'[0-7][0-9A-HJKMNP-TV-Z]{25}')
+_PREFIX = '{"id":"'
+_ID_END = len(_PREFIX) + 26
+
+
+def _encode(value):
+    # 26 base32 digits are 130 bits; pad the 128 bit value to 160 bits so
+    # the standard encoder lines up, then swap in the Crockford alphabet.
+    return base64.b32encode((value << 30).to_bytes(20, 'big'))[:26].decode('ascii').translate(_CROCKFORD)
+
+
+def new_id(ts=None):
+    """Return a fresh ULID for a record created at ``ts`` (default now)."""
+    ms = int((time.time() if ts is None else ts) * 1000)
+    return _encode((ms << 80) | int.from_bytes(os.urandom(10), 'big'))
+
+
+def is_id(value):
+    """Return True if ``value`` is a well-formed record id."""
+    return isinstance(value, str) and _ID.fullmatch(value) is not None
+
+
+def id_time(record_id):
+    """Return the creation time encoded in a record id, in seconds."""
+    ms = 0
+    for char in record_id[:10]:
+        ms = ms * 32 + _ALPHABET.index(char)
+    return ms / 1000
+
+
+def _legacy_bytes(line):
+    # A zero timestamp sorts legacy lines before every record.
+    return bytes(6) + hashlib.blake2b(line.encode('utf-8'), digest_size=10).digest()
+
+
+def _legacy_id(line):
+    return _encode(int.from_bytes(_legacy_bytes(line), 'big'))
+
+
+def _parse(line):
+    # The record stored as a JSON line, or None for a legacy text line.
+    if not line.startswith('{'):
+        return None
+    try:
+        value = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(value, dict) or not isinstance(value.get('stream'), (str, type(None))):
+        return None
+    return validate(value, value.get('stream'))
+
+
+def _fast_id(line):
+    # The id of a line written by encode(), or None.
+    if line.startswith(_PREFIX) and line[_ID_END:_ID_END + 1] == '"':
+        value = line[len(_PREFIX):_ID_END]
+        if _ID.fullmatch(value):
+            return value
+    return None
+
+
+def record_id(line):
+    """Return the id of a stored line, reading only the id when it can."""
+    value = _fast_id(line)
+    if value is None:
+        record = _parse(line)
+        value = record['id'] if record is not None else _legacy_id(line)
+    return value
+
+
+def id_key(value):
+    """Return the 16 byte hash of a record id."""
+    raw = int(value.translate(_DIGITS), 32).to_bytes(16, 'big')
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+
+def entry_key(line):
+    """Return the 16 byte hash of a line's record id.
+
+    Dedup, the stream index and the anti-entropy digests key off it, so two
+    copies of one record match however they were encoded.
+    """
+    value = _fast_id(line)
+    if value is None:
+        record = _parse(line)
+        if record is None:
+            return hashlib.blake2b(_legacy_bytes(line), digest_size=16).digest()
+        value = record['id']
+    return id_key(value)
+
+
+def make(stream, origin, payload, ts=None):
+    """Return a new record for ``payload`` written by ``origin``."""
+    ts = time.time() if ts is None else ts
+    return {'id': new_id(ts), 'origin': origin, 'ts': round(ts, 3),
+            'stream': stream, 'payload': payload}
+
+
+def encode(record):
+    """Return the one line JSON form of ``record``, id first."""
+    return json.dumps(
+        {'id': record['id'], 'origin': record['origin'], 'ts': record['ts'],
+         'stream': record['stream'], 'payload': record['payload']},
+        separators=(',', ':'), ensure_ascii=False,
+    )
+
+
+def validate(value, stream):
+    """Return ``value`` as a record of ``stream``, or None if it is not one.
+
+    Used for records received from peers and clients. The payload must hold
+    a text; anything in it besides the text and a task id is dropped.
+    """
+    if not isinstance(value, dict) or not is_id(value.get('id')):
+        return None
+    payload = value.get('payload')
+    if not isinstance(payload, dict) or not isinstance(payload.get('text'), str):
+        return None
+    origin = value.get('origin')
+    ts = value.get('ts')
+    if not isinstance(origin, str) or isinstance(ts, bool) or not isinstance(ts, (int, float)):
+        return None
+    kept = {'text': payload['text']}
+    if isinstance(payload.get('task_id'), str):
+        kept['task_id'] = payload['task_id']
+    return {'id': value['id'], 'origin': origin, 'ts': ts, 'stream': stream, 'payload': kept}
+
+
+def decode(line, stream=None):
+    """Return the record stored as ``line``, converting legacy text lines."""
+    record = _parse(line)
+    if record is not None:
+        return record
+    origin, sep, text = line.partition(': ')
+    if not sep:
+        origin, text = None, line
+    return {'id': _legacy_id(line), 'origin': origin, 'ts': None, 'stream': stream,
+            'payload': {'text': text}}
+
+
+def render(line):
+    """Return the text view of a stored line: ``"origin: text"``.
+
+    Tasks show their task id in place of the origin, as they always have.
+    Legacy lines are returned unchanged.
+    """
+    record = _parse(line)
+    if record is None:
+        return line
+    payload = record['payload']
+    label = payload.get('task_id') if record['stream'] == 'tasks' else None
+    return f"{label or record['origin']}: {payload['text']}"
+
+
+def to_json(line, stream=None):
+    """Return ``line`` as a one line JSON record, converting legacy lines."""
+    return encode(decode(line, stream))
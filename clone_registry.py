@@ -0,0 +1,65 @@
+"""Peer registry for clone network servers.
+
+Servers register their public URL and repeat the registration as a
+heartbeat. Any server not heard from within ``ttl`` seconds is dropped
+from the list.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class Registry:
+    """Servers that registered within the last ``ttl`` seconds.
+
+    Registrations are kept in heartbeat order so expiry only looks at the
+    oldest ones. The serialized list is rebuilt only when membership
+    changes, and its ETag lets callers skip lists they already have.
+    """
+
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+        self._listing = None
+
+    def _expire(self, now):
+        # Caller holds self._lock.
+        while self._seen:
+            url, last = next(iter(self._seen.items()))
+            if now - last <= self.ttl:
+                break
+            del self._seen[url]
+            self._listing = None
+
+    def register(self, url):
+        """Record a heartbeat from ``url``."""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if url in self._seen:
+                self._seen.move_to_end(url)
+            else:
+                self._listing = None
+            self._seen[url] = now
+
+    def unregister(self, url):
+        with self._lock:
+            if self._seen.pop(url, None) is not None:
+                self._listing = None
+
+    def listing(self):
+        """Return ``(etag, body)`` for the JSON list of live servers."""
+        with self._lock:
+            self._expire(time.time())
+            if self._listing is None:
+                body = json.dumps({'servers': sorted(self._seen), 'ttl': self.ttl}).encode('utf-8')
+                self._listing = (hashlib.blake2b(body, digest_size=8).hexdigest(), body)
+            return self._listing
+
+    def __len__(self):
+        with self._lock:
+            return len(self._seen)
@@ -0,0 +1,211 @@
+"""Background replication of clone network writes to peer servers."""
+
+import heapq
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from clone_compress import CompressionStats, choose_encoding, encode_json
+
+
+class Replicator:
+    """Fan writes out to peers without blocking the request handler.
+
+    Each peer has its own FIFO queue drained by at most one worker at a
+    time, so per-peer ordering is preserved while different peers are
+    served concurrently by a bounded thread pool. Every peer keeps a pooled
+    ``requests.Session`` so connections are reused between posts.
+
+    Writes are coalesced: a peer's queue is held for ``batch_window``
+    seconds (or until ``batch_size`` writes are waiting) and then shipped
+    as a single ``batch_path`` request. Peers that do not know the batch
+    endpoint get the writes one by one as before.
+
+    With ``compress_min_bytes`` set, bodies of at least that size are
+    compressed once a peer has advertised a supported encoding in the
+    ``Accept-Encoding`` header of an earlier response.
+
+    ``headers`` are added to every post, e.g. the token that marks this
+    server as a peer.
+
+    With a ``health`` tracker (see ``clone_health.PeerHealth``) a failed
+    post keeps the peer's writes and retries them after a backoff. Only
+    once the peer's breaker opens are its writes dropped and
+    ``on_failure`` called.
+    """
+
+    def __init__(self, max_workers=8, timeout=5, queue_limit=10000, on_failure=None,
+                 batch_size=200, batch_window=0.05, batch_path='/batch',
+                 compress_min_bytes=None, health=None, headers=None):
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        self.queue_limit = queue_limit
+        self.on_failure = on_failure
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window
+        self.batch_path = batch_path
+        self.compress_min_bytes = compress_min_bytes
+        self.health = health
+        self.compression = CompressionStats()
+        self._encodings = {}
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='replicate')
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._queues = {}
+        self._active = set()
+        self._due = []
+        self._sessions = {}
+        self._legacy = set()
+        self.sent = {}
+        self.batches = {}
+        self.dropped = {}
+        self._scheduler = threading.Thread(target=self._schedule_loop, daemon=True)
+        self._scheduler.start()
+
+    def _session(self, url):
+        with self._lock:
+            session = self._sessions.get(url)
+            if session is None:
+                session = self._sessions[url] = requests.Session()
+            return session
+
+    def submit(self, urls, path, payload):
+        """Queue ``payload`` for delivery to ``path`` on every peer in ``urls``."""
+        self.submit_many(urls, [(path, payload)])
+
+    def submit_many(self, urls, items):
+        """Queue ``(path, payload)`` items for every peer in ``urls`` at once.
+
+        A large group starts its peers' deliveries right away instead of
+        waiting out the batch window.
+        """
+        if not items:
+            return
+        with self._lock:
+            for url in urls:
+                q = self._queues.setdefault(url, deque())
+                for item in items:
+                    if len(q) >= self.queue_limit:
+                        # The peer catches up through /updates; keep the newest writes.
+                        q.popleft()
+                        self.dropped[url] = self.dropped.get(url, 0) + 1
+                    q.append(item)
+                if url in self._active:
+                    continue
+                if len(q) >= self.batch_size or not self.batch_window:
+                    self._start(url)
+                elif len(q) == len(items):
+                    heapq.heappush(self._due, (time.monotonic() + self.batch_window, url))
+                    self._wakeup.notify()
+
+    def _start(self, url):
+        # Caller holds self._lock.
+        self._active.add(url)
+        self._pool.submit(self._drain, url)
+
+    def _schedule_loop(self):
+        with self._lock:
+            while True:
+                if not self._due:
+                    self._wakeup.wait()
+                    continue
+                due, url = self._due[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+                heapq.heappop(self._due)
+                if url not in self._active and self._queues.get(url):
+                    self._start(url)
+
+    def _send(self, session, url, path, payload):
+        encoding = self._encodings.get(url)
+        if self.compress_min_bytes is None:
+            encoding = None
+        body, headers = encode_json(payload, encoding, self.compress_min_bytes or 0, self.compression)
+        headers = dict(self.headers, **headers)
+        resp = session.post(f"{url}{path}?forwarded=1", data=body, headers=headers, timeout=self.timeout)
+        self._encodings[url] = choose_encoding(resp.headers.get('Accept-Encoding'))
+        return resp
+
+    def _post(self, session, url, items):
+        """Deliver ``items`` to ``url``, as one batch when the peer allows it.
+
+        Raises when the peer refuses them, so they stay queued.
+        """
+        if url not in self._legacy:
+            body = {'items': [{'path': path, 'payload': payload} for path, payload in items]}
+            resp = self._send(session, url, self.batch_path, body)
+            if resp.status_code != 404:
+                resp.raise_for_status()
+                return
+            self._legacy.add(url)
+        for path, payload in items:
+            self._send(session, url, path, payload).raise_for_status()
+
+    def _drain(self, url):
+        session = self._session(url)
+        while True:
+            with self._lock:
+                q = self._queues.get(url)
+                if not q:
+                    self._active.discard(url)
+                    return
+                items = [q[i] for i in range(min(len(q), self.batch_size))]
+            try:
+                self._post(session, url, items)
+            except Exception:
+                self._fail(url)
+                return
+            if self.health is not None:
+                self.health.record_success(url)
+            with self._lock:
+                for item in items:
+                    if q and q[0] is item:
+                        q.popleft()
+                self.sent[url] = self.sent.get(url, 0) + len(items)
+                self.batches[url] = self.batches.get(url, 0) + 1
+
+    def _fail(self, url):
+        if self.health is not None and not self.health.record_failure(url):
+            # Not lost yet: keep the writes and try again after a backoff.
+            retry_at = time.monotonic() + self.health.retry_delay(url)
+            with self._lock:
+                self._active.discard(url)
+                heapq.heappush(self._due, (retry_at, url))
+                self._wakeup.notify()
+            return
+        with self._lock:
+            q = self._queues.pop(url, None)
+            self._active.discard(url)
+            if q:
+                self.dropped[url] = self.dropped.get(url, 0) + len(q)
+            session = self._sessions.pop(url, None)
+            self._legacy.discard(url)
+            self._encodings.pop(url, None)
+        if session is not None:
+            session.close()
+        if self.on_failure:
+            self.on_failure(url)
+
+    def stats(self):
+        """Return queue depth, delivered and dropped writes per peer."""
+        with self._lock:
+            return {
+                'pending': {url: len(q) for url, q in self._queues.items() if q},
+                'sent': dict(self.sent),
+                'batches': dict(self.batches),
+                'dropped': dict(self.dropped),
+                'compression': self.compression.snapshot(),
+            }
+
+    def close(self):
+        """Deliver everything still queued and stop the worker pool."""
+        with self._lock:
+            for url, q in self._queues.items():
+                if q and url not in self._active:
+                    self._start(url)
+        self._pool.shutdown(wait=True)
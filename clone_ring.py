@@ -0,0 +1,42 @@
+"""Consistent hashing of task ids onto clone network servers."""
+
+import bisect
+import hashlib
+
+
+def _point(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Map keys to members by consistent hashing.
+
+    Every member sits on the ring at ``vnodes`` points and a key belongs to
+    the member at the first point after the key's own hash. When a member
+    joins or leaves only the keys next to its points move, about one in
+    ``len(members)`` of them, so servers agree on most owners even while
+    their peer lists briefly differ.
+    """
+
+    def __init__(self, vnodes=64):
+        self.vnodes = vnodes
+        self.members = ()
+        self._ring = ((), ())
+
+    def rebuild(self, members):
+        """Place ``members`` on the ring. Returns True if the set changed."""
+        members = tuple(sorted(set(members)))
+        if members == self.members:
+            return False
+        points = sorted((_point(f"{member}#{i}"), member)
+                        for member in members for i in range(self.vnodes))
+        self._ring = (tuple(point for point, _ in points), tuple(member for _, member in points))
+        self.members = members
+        return True
+
+    def owner(self, key):
+        """Return the member owning ``key``, or None for an empty ring."""
+        points, owners = self._ring
+        if not points:
+            return None
+        return owners[bisect.bisect(points, _point(key)) % len(points)]
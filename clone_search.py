@@ -0,0 +1,279 @@
+"""Full-text search over clone network streams.
+
+Entries are indexed in an SQLite FTS5 table kept beside the stream store.
+The index records how far it got in every stream, so indexing resumes after
+a restart where it stopped.
+
+FTS5's own ``bm25()`` walks the whole posting list of every query term to
+find how many entries contain it, which takes tens of milliseconds for a
+common word in a large index. Those document frequencies are kept in a
+table of their own instead, updated as entries are indexed, and matches
+are scored with BM25 here.
+"""
+
+import math
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+
+# rowid = seq * _CODES + stream code, so an entry is found without a scan.
+_CODES = 16
+_TERM = re.compile(r'"([^"]*)"|(\S+)')
+_TOKEN = re.compile(r'[^\W_]+')
+_K1 = 1.2
+_B = 0.75
+
+
+def tokenize(text):
+    """Split ``text`` into lowercase tokens the way FTS5's unicode61 does."""
+    text = text.lower()
+    if not text.isascii():
+        text = ''.join(ch for ch in unicodedata.normalize('NFKD', text)
+                       if not unicodedata.combining(ch))
+    return _TOKEN.findall(text)
+
+
+def parse_query(text):
+    """Return the ``(kind, tokens)`` terms of a search query.
+
+    Every word must match, ``word*`` matches a prefix and ``"two words"``
+    matches a phrase; ``kind`` is 'word', 'prefix' or 'phrase'. Anything
+    else is plain text, so user input can never be an FTS5 syntax error.
+    """
+    terms = []
+    for phrase, word in _TERM.findall(text):
+        if phrase:
+            tokens = tokenize(phrase)
+            if tokens:
+                terms.append(('phrase' if len(tokens) > 1 else 'word', tuple(tokens)))
+            continue
+        tokens = tokenize(word)
+        for i, token in enumerate(tokens):
+            prefix = word.endswith('*') and i == len(tokens) - 1
+            terms.append(('prefix' if prefix else 'word', (token,)))
+    return terms
+
+
+def _fts_query(terms):
+    parts = []
+    for kind, tokens in terms:
+        part = '"' + ' '.join(tokens) + '"'
+        parts.append(part + '*' if kind == 'prefix' else part)
+    return ' '.join(parts)
+
+
+def _frequency(kind, tokens, doc):
+    # How often a term occurs in the token list ``doc``.
+    if kind == 'word':
+        return doc.count(tokens[0])
+    if kind == 'prefix':
+        return sum(1 for token in doc if token.startswith(tokens[0]))
+    size = len(tokens)
+    return sum(1 for i in range(len(doc) - size + 1) if tuple(doc[i:i + size]) == tokens)
+
+
+class SearchIndex:
+    """FTS5 index of stream entries keyed by stream and sequence number.
+
+    A query matching more than ``rank_limit`` entries ranks only the newest
+    ``rank_limit`` of them, so its cost does not grow with the index. Every
+    page of a query is cut from that same ranking.
+    """
+
+    def __init__(self, path, rank_limit=1000):
+        self.path = path
+        self.rank_limit = rank_limit
+        self._local = threading.local()
+        self._codes = {}
+
+        def init(conn):
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(docs)")]
+            if columns and 'record' not in columns:
+                # Indexes from before record ids are rebuilt from the streams.
+                conn.execute("DROP TABLE docs")
+                conn.execute("DROP TABLE IF EXISTS positions")
+                conn.execute("DROP TABLE IF EXISTS terms")
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5("
+                "entry, stream UNINDEXED, seq UNINDEXED, record UNINDEXED, "
+                "tokenize = 'unicode61 remove_diacritics 2')"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS positions ("
+                "stream TEXT PRIMARY KEY, code INTEGER NOT NULL, "
+                "seq INTEGER NOT NULL, docs INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS terms ("
+                "term TEXT PRIMARY KEY, docs INTEGER NOT NULL) WITHOUT ROWID"
+            )
+        self._write(init)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, fn):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _code(self, conn, stream):
+        code = self._codes.get(stream)
+        if code is None:
+            row = conn.execute("SELECT code FROM positions WHERE stream = ?", (stream,)).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO positions (stream, code, seq, docs) "
+                    "SELECT ?, COALESCE(MAX(code) + 1, 0), 0, 0 FROM positions",
+                    (stream,),
+                )
+                row = conn.execute("SELECT code FROM positions WHERE stream = ?", (stream,)).fetchone()
+            code = self._codes[stream] = row[0]
+        return code
+
+    def _count_terms(self, conn, entries, sign):
+        counts = Counter()
+        for entry in entries:
+            counts.update(set(tokenize(entry)))
+        conn.executemany(
+            "INSERT INTO terms (term, docs) VALUES (?, ?) "
+            "ON CONFLICT(term) DO UPDATE SET docs = docs + excluded.docs",
+            [(term, sign * count) for term, count in counts.items()],
+        )
+        if sign < 0:
+            conn.executemany(
+                "DELETE FROM terms WHERE term = ? AND docs <= 0", [(term,) for term in counts]
+            )
+
+    def position(self, stream):
+        """Return the sequence number indexing has reached in ``stream``."""
+        row = self._conn().execute(
+            "SELECT seq FROM positions WHERE stream = ?", (stream,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def add(self, stream, pairs):
+        """Index ``(seq, entry)`` or ``(seq, entry, record id)`` past the stream's position."""
+        def insert(conn):
+            code = self._code(conn, stream)
+            start = conn.execute(
+                "SELECT seq FROM positions WHERE stream = ?", (stream,)
+            ).fetchone()[0]
+            rows = [(pair[0] * _CODES + code, pair[1], stream, pair[0],
+                     pair[2] if len(pair) > 2 else None)
+                    for pair in pairs if pair[0] > start]
+            if not rows:
+                return 0
+            conn.executemany(
+                "INSERT INTO docs (rowid, entry, stream, seq, record) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._count_terms(conn, [row[1] for row in rows], 1)
+            conn.execute(
+                "UPDATE positions SET seq = ?, docs = docs + ? WHERE stream = ?",
+                (rows[-1][3], len(rows), stream),
+            )
+            return len(rows)
+        return self._write(insert)
+
+    def remove(self, stream, seqs):
+        """Drop the entries of ``stream`` stored under ``seqs``."""
+        def delete(conn):
+            code = self._code(conn, stream)
+            entries = []
+            for seq in seqs:
+                rowid = seq * _CODES + code
+                row = conn.execute("SELECT entry FROM docs WHERE rowid = ?", (rowid,)).fetchone()
+                if row is not None:
+                    entries.append(row[0])
+                    conn.execute("DELETE FROM docs WHERE rowid = ?", (rowid,))
+            self._count_terms(conn, entries, -1)
+            conn.execute(
+                "UPDATE positions SET docs = docs - ? WHERE stream = ?", (len(entries), stream)
+            )
+        if seqs:
+            self._write(delete)
+
+    def reset(self, stream):
+        """Forget everything indexed for ``stream``."""
+        def clear(conn):
+            entries = [row[0] for row in conn.execute(
+                "SELECT entry FROM docs WHERE stream = ?", (stream,))]
+            self._count_terms(conn, entries, -1)
+            conn.execute("DELETE FROM docs WHERE stream = ?", (stream,))
+            conn.execute("UPDATE positions SET seq = 0, docs = 0 WHERE stream = ?", (stream,))
+        self._write(clear)
+
+    def _document_frequency(self, conn, kind, tokens):
+        if kind == 'prefix':
+            row = conn.execute(
+                "SELECT MAX(docs) FROM terms WHERE term >= ? AND term < ?",
+                (tokens[0], tokens[0] + '\U0010ffff'),
+            ).fetchone()
+            return row[0] or 0
+        counts = []
+        for token in tokens:
+            row = conn.execute("SELECT docs FROM terms WHERE term = ?", (token,)).fetchone()
+            counts.append(row[0] if row else 0)
+        return min(counts)
+
+    def search(self, text, streams=None, limit=20, offset=0):
+        """Return ``(hits, more)`` for the best matches of ``text``.
+
+        Hits are dicts with the stream, seq, record id, entry and BM25
+        score, best match first. Pages reach at most ``rank_limit`` hits
+        deep. Raises ValueError for a query without any words.
+        """
+        terms = parse_query(text)
+        if not terms:
+            raise ValueError('empty query')
+        conn = self._conn()
+        where = "docs MATCH ?"
+        codes = dict(conn.execute("SELECT stream, code FROM positions").fetchall())
+        if streams and set(codes) - set(streams):
+            wanted = [codes[stream] for stream in streams if stream in codes]
+            if not wanted:
+                return [], False
+            # The stream code is part of the rowid, so no entry is read.
+            where += f" AND rowid % {_CODES} IN ({','.join(str(code) for code in wanted)})"
+        # Always rank the same window, so offsets page through one ranking.
+        rows = conn.execute(
+            f"SELECT rowid, stream, seq, entry, record FROM docs WHERE {where} "
+            "ORDER BY rowid DESC LIMIT ?",
+            (_fts_query(terms), self.rank_limit),
+        ).fetchall()
+        if not rows:
+            return [], False
+        total = conn.execute("SELECT COALESCE(SUM(docs), 0) FROM positions").fetchone()[0]
+        weights = []
+        for kind, tokens in terms:
+            found = self._document_frequency(conn, kind, tokens)
+            weights.append(math.log(1 + (total - found + 0.5) / (found + 0.5)))
+        docs = [tokenize(row[3]) for row in rows]
+        average = sum(len(doc) for doc in docs) / len(docs) or 1.0
+        scored = []
+        for row, doc in zip(rows, docs):
+            norm = _K1 * (1 - _B + _B * len(doc) / average)
+            score = 0.0
+            for (kind, tokens), weight in zip(terms, weights):
+                tf = _frequency(kind, tokens, doc)
+                score += weight * tf * (_K1 + 1) / (tf + norm)
+            scored.append((score, row))
+        scored.sort(key=lambda hit: (-hit[0], -hit[1][0]))
+        hits = [
+            {'stream': stream, 'seq': seq, 'id': record, 'entry': entry, 'score': round(score, 4)}
+            for score, (_, stream, seq, entry, record) in scored[offset:offset + limit]
+        ]
+        return hits, offset + limit < len(scored)
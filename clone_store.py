@@ -0,0 +1,769 @@
+"""Storage engines for the clone network streams.
+
+A store persists ``(seq, ts, entry)`` records per named stream. ``seq``
+increases monotonically within a stream, ``ts`` is a UNIX timestamp and
+``entry`` the line holding the record (see ``clone_record``).
+
+``append`` and ``append_many`` take records whose ``seq`` the caller has
+already assigned. ``insert_many`` (SQLite only) lets the store assign
+sequence numbers inside its own transaction, which is what several
+processes sharing one database need. All writes return a pending handle
+whose ``wait()`` returns once the records are durable, so callers can
+release their own locks before waiting on the disk. A write that fails
+raises, either from the call or from ``wait()``, and stores nothing, so
+callers can take back sequence numbers they assigned.
+
+``compact`` removes entries the caller no longer needs. It never removes
+the newest entry of a stream, so sequence numbers are never reused.
+
+``read``, ``get`` and ``read_tail`` serve entries that callers no longer
+keep in memory straight from disk.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+from clone_record import entry_key
+
+# Entries are indexed by a hash of their record id; databases written
+# when the hash covered the whole entry are rehashed on open.
+entry_hash = entry_key
+_HASH_VERSION = '2'
+
+
+def _load_lines(path):
+    """Return list of non-empty lines from a file."""
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                return [line.strip() for line in f if line.strip()]
+        except Exception:
+            pass
+    return []
+
+
+class _Pending:
+    """Completion handle for a queued write."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def set(self, result=None):
+        self.result = result
+        self._event.set()
+
+    def fail(self, error):
+        self.error = error
+        self._event.set()
+
+    def wait(self):
+        self._event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _done(result=None):
+    pending = _Pending()
+    pending.set(result)
+    return pending
+
+
+# First line of a segment rewritten by compaction; every following line
+# is "<seq> <entry>" because the remaining entries are no longer contiguous.
+_COMPACTED = '#seq'
+
+
+def _read_segment(path, first):
+    lines = _load_lines(path)
+    if lines and lines[0] == _COMPACTED:
+        pairs = []
+        for line in lines[1:]:
+            seq, _, entry = line.partition(' ')
+            pairs.append((int(seq), entry))
+        return pairs
+    return list(enumerate(lines, start=first))
+
+
+# One offset is kept per this many entries of a segment file.
+_INDEX_EVERY = 256
+
+
+class _LineIndex:
+    """Sparse seq to byte offset index of one segment file.
+
+    Every ``_INDEX_EVERY``-th entry is recorded, so a read seeks close to
+    the entry it wants and scans at most that many lines. The index is
+    extended as the file grows, which lets reads of the active segment
+    reuse it.
+    """
+
+    def __init__(self, inode, first):
+        self.inode = inode
+        self.first = first
+        self.compacted = False
+        self.start = 0
+        self.scanned = 0
+        self.count = 0
+        self.next = first
+        self.seqs = []
+        self.offsets = []
+
+    def extend(self, mm, size):
+        pos = self.scanned
+        while pos < size:
+            end = mm.find(b'\n', pos, size)
+            if end < 0:
+                break
+            line = mm[pos:end].decode('utf-8', 'replace').strip()
+            if line:
+                if pos == 0 and line == _COMPACTED:
+                    self.compacted = True
+                    self.start = end + 1
+                else:
+                    seq = int(line.partition(' ')[0]) if self.compacted else self.next
+                    if self.count % _INDEX_EVERY == 0:
+                        self.seqs.append(seq)
+                        self.offsets.append(pos)
+                    self.count += 1
+                    self.next = seq + 1
+            pos = end + 1
+        self.scanned = pos
+
+    def _seek(self, seq):
+        # Position of the last indexed entry at or before ``seq``.
+        i = bisect.bisect_right(self.seqs, seq) - 1
+        if i < 0:
+            return self.start, self.first
+        return self.offsets[i], self.seqs[i]
+
+    def _entries(self, mm, pos, seq):
+        while pos < self.scanned:
+            end = mm.find(b'\n', pos, self.scanned)
+            line = mm[pos:end].decode('utf-8', 'replace').strip()
+            pos = end + 1
+            if not line:
+                continue
+            if self.compacted:
+                head, _, line = line.partition(' ')
+                seq = int(head)
+            yield seq, line
+            seq += 1
+
+    def scan(self, mm, after, until=None, room=None):
+        """Return up to ``room`` pairs with ``after < seq <= until``."""
+        pairs = []
+        for seq, entry in self._entries(mm, *self._seek(after)):
+            if until is not None and seq > until:
+                break
+            if seq > after:
+                pairs.append((seq, entry))
+                if room is not None and len(pairs) >= room:
+                    break
+        return pairs
+
+    def pick(self, mm, wanted):
+        """Return the pairs whose seq is in the sorted list ``wanted``."""
+        found = []
+        entries = None
+        current = None
+        for want in wanted:
+            pos, seq = self._seek(want)
+            if entries is None or current is None or current >= want or seq > current:
+                entries = self._entries(mm, pos, seq)
+                current = None
+            for seq, entry in entries:
+                current = seq
+                if seq >= want:
+                    if seq == want:
+                        found.append((seq, entry))
+                    break
+        return found
+
+    def tail(self, mm, count, before):
+        """Return the newest ``count`` pairs with seq below ``before``."""
+        i = bisect.bisect_left(self.seqs, before)
+        if i == 0:
+            return []
+        below = (i - 1) * _INDEX_EVERY + len(
+            self.scan(mm, self.seqs[i - 1] - 1, until=before - 1))
+        j = max(0, below - count) // _INDEX_EVERY
+        return self.scan(mm, self.seqs[j] - 1, until=before - 1)[-count:]
+
+
+class FileStore:
+    """Append-only text files per stream, one entry per line.
+
+    New entries go to the stream's own file (the active segment). Once it
+    reaches ``segment_bytes`` it is renamed to ``<file>.<first>-<last>``
+    after the sequence numbers it holds and a new active segment starts.
+    Sequence numbers count lines from the first segment on, so they survive
+    restarts. Only sealed segments are ever rewritten by ``compact``.
+
+    Entries are read back from disk through a memory map of each segment
+    and a sparse offset index built the first time a segment is read.
+
+    With ``epoch_path`` set the epoch is kept in that file together with
+    the next sequence number of every stream. It only changes when a
+    stream's numbering went backwards since then, i.e. its files were
+    truncated or removed.
+    """
+
+    def __init__(self, paths, segment_bytes=0, epoch_path=None):
+        self.paths = paths
+        self.segment_bytes = segment_bytes
+        self.epoch_path = epoch_path
+        self._lock = threading.Lock()
+        self._base = {}
+        self._next = {}
+        self._size = {}
+        self._index_lock = threading.Lock()
+        self._indexes = {}
+        self.epoch = uuid.uuid4().hex
+        if epoch_path:
+            self._open_epoch()
+
+    def _open_epoch(self):
+        try:
+            with open(self.epoch_path) as f:
+                saved = json.load(f)
+            epoch, marks = saved['epoch'], saved['next']
+        except Exception:
+            epoch, marks = None, {}
+        for stream in self.paths:
+            self._active(stream, self.segments(stream))
+            if self._next[stream] < marks.get(stream, 1):
+                epoch = None
+        if epoch:
+            self.epoch = epoch
+        self._save_epoch()
+
+    def _save_epoch(self):
+        with self._lock:
+            marks = dict(self._next)
+        try:
+            tmp = self.epoch_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'epoch': self.epoch, 'next': marks}, f)
+            os.replace(tmp, self.epoch_path)
+        except Exception:
+            pass
+
+    def segments(self, stream):
+        """Return ``(first, last, path)`` for every sealed segment, oldest first."""
+        path = self.paths[stream]
+        folder = os.path.dirname(path) or '.'
+        pattern = re.compile(re.escape(os.path.basename(path)) + r'\.(\d+)-(\d+)$')
+        found = []
+        try:
+            names = os.listdir(folder)
+        except Exception:
+            return found
+        for name in names:
+            match = pattern.match(name)
+            if match:
+                found.append((int(match.group(1)), int(match.group(2)), os.path.join(folder, name)))
+        return sorted(found)
+
+    def _active(self, stream, sealed):
+        # Track where the active segment starts and how large it is.
+        path = self.paths[stream]
+        lines = _load_lines(path)
+        base = sealed[-1][1] + 1 if sealed else 1
+        with self._lock:
+            self._base[stream] = base
+            self._next[stream] = base + len(lines)
+            self._size[stream] = os.path.getsize(path) if os.path.exists(path) else 0
+        return list(enumerate(lines, start=base))
+
+    def load(self, stream):
+        """Return ``(seq, entry)`` pairs for every stored entry."""
+        sealed = self.segments(stream)
+        pairs = []
+        for first, _, path in sealed:
+            pairs.extend(_read_segment(path, first))
+        pairs.extend(self._active(stream, sealed))
+        return pairs
+
+    def _files(self, stream):
+        # Sealed segments plus the active one, oldest first.
+        sealed = self.segments(stream)
+        if stream not in self._next:
+            self._active(stream, sealed)
+        with self._lock:
+            base = self._base[stream]
+        return sealed + [(base, None, self.paths[stream])]
+
+    def _mapped(self, path, first, fn):
+        # Run ``fn(index, mm)`` on a memory map of ``path``.
+        try:
+            with open(path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if not stat.st_size:
+                    return []
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, self._index_lock:
+                    index = self._indexes.get(path)
+                    if (index is None or index.inode != stat.st_ino or index.first != first
+                            or index.scanned > stat.st_size):
+                        index = self._indexes[path] = _LineIndex(stat.st_ino, first)
+                    index.extend(mm, stat.st_size)
+                    return fn(index, mm)
+        except Exception:
+            return []
+
+    def read(self, stream, after, limit=None, until=None):
+        """Return up to ``limit`` ``(seq, entry)`` pairs with ``after < seq <= until``."""
+        pairs = []
+        for first, last, path in self._files(stream):
+            if last is not None and last <= after:
+                continue
+            if until is not None and first > until:
+                break
+            room = None if limit is None else limit - len(pairs)
+            pairs.extend(self._mapped(path, first, lambda index, mm: index.scan(mm, after, until, room)))
+            if limit is not None and len(pairs) >= limit:
+                break
+        return pairs
+
+    def get(self, stream, seqs):
+        """Return the ``(seq, entry)`` pairs stored under ``seqs``."""
+        wanted = sorted(set(seqs))
+        found = []
+        for first, last, path in self._files(stream):
+            inside = [seq for seq in wanted if seq >= first and (last is None or seq <= last)]
+            if inside:
+                found.extend(self._mapped(path, first, lambda index, mm: index.pick(mm, inside)))
+        return found
+
+    def read_tail(self, stream, count, before):
+        """Return the newest ``count`` pairs whose seq is below ``before``."""
+        pairs = []
+        for first, _, path in reversed(self._files(stream)):
+            if first >= before:
+                continue
+            need = count - len(pairs)
+            pairs[:0] = self._mapped(path, first, lambda index, mm: index.tail(mm, need, before))
+            if len(pairs) >= count:
+                break
+        return pairs
+
+    def append(self, stream, records):
+        """Append ``(seq, ts, entry)`` records."""
+        return self.append_many([(stream, records)])
+
+    def append_many(self, batches):
+        """Append ``(stream, records)`` batches, one file write per stream.
+
+        If any write fails the files written so far are cut back to their
+        old size and the error is raised, so nothing of the call is stored.
+        """
+        written = []
+        try:
+            for stream, records in batches:
+                if stream not in self._next:
+                    self._active(stream, self.segments(stream))
+                data = ''.join(entry + "\n" for _, _, entry in records).encode('utf-8')
+                path = self.paths[stream]
+                with self._lock:
+                    size = self._size[stream]
+                written.append((stream, path, size, len(records), len(data)))
+                with open(path, "ab") as f:
+                    f.write(data)
+        except Exception:
+            for _, path, size, _, _ in written:
+                try:
+                    os.truncate(path, size)
+                except Exception:
+                    pass
+            raise
+        with self._lock:
+            for stream, _, _, count, length in written:
+                self._next[stream] += count
+                self._size[stream] += length
+                if self.segment_bytes and self._size[stream] >= self.segment_bytes:
+                    self._rotate(stream)
+        return _done()
+
+    def _rotate(self, stream):
+        # Caller holds self._lock.
+        path = self.paths[stream]
+        base, last = self._base[stream], self._next[stream] - 1
+        try:
+            os.replace(path, f"{path}.{base}-{last}")
+        except Exception:
+            return
+        self._base[stream] = last + 1
+        self._size[stream] = 0
+
+    def compact(self, stream, keep, before=None):
+        """Drop entries for which ``keep(seq, entry)`` is False.
+
+        Only sealed segments last written before ``before`` (a UNIX time)
+        are rewritten; segments left empty are deleted. The newest sealed
+        segment is kept even when empty, since its name is where the active
+        segment's numbering continues from. Returns the dropped ``(seq,
+        entry)`` pairs.
+        """
+        sealed = self.segments(stream)
+        if stream not in self._next:
+            self._active(stream, sealed)
+        newest = self._next[stream] - 1
+        marker = sealed[-1][2] if sealed else None
+        dropped = []
+        for first, _, path in sealed:
+            try:
+                mtime = os.path.getmtime(path)
+                if before is not None and mtime >= before:
+                    continue
+                pairs = _read_segment(path, first)
+                kept = [(seq, entry) for seq, entry in pairs if seq == newest or keep(seq, entry)]
+                if len(kept) == len(pairs) and (pairs or path == marker):
+                    continue
+                if kept or path == marker:
+                    tmp = path + '.tmp'
+                    with open(tmp, 'w') as f:
+                        f.write(_COMPACTED + '\n')
+                        f.writelines(f"{seq} {entry}\n" for seq, entry in kept)
+                    os.replace(tmp, path)
+                    # Keep the age of the entries for later retention checks.
+                    os.utime(path, (mtime, mtime))
+                else:
+                    os.remove(path)
+            except Exception:
+                continue
+            kept_seqs = {seq for seq, _ in kept}
+            dropped.extend(pair for pair in pairs if pair[0] not in kept_seqs)
+            with self._index_lock:
+                self._indexes.pop(path, None)
+        return dropped
+
+    def generation(self, stream):
+        """Return how often ``stream`` was compacted; files are never shared."""
+        return 0
+
+    def close(self):
+        if self.epoch_path:
+            self._save_epoch()
+
+
+class SQLiteStore:
+    """SQLite backend in WAL mode with group commits.
+
+    Writes are queued for a single writer thread that commits everything
+    waiting (up to ``batch_size`` records) in one transaction, so concurrent
+    writers share a single fsync. ``commit_delay`` optionally holds a commit
+    open a little longer to gather more writers. Transactions take the
+    write lock up front, so several processes can share the database.
+    """
+
+    def __init__(self, path, batch_size=500, commit_delay=0.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.commit_delay = commit_delay
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        conn = self._connect()
+        conn.isolation_level = None
+        # Take the write lock first so processes starting together do not
+        # race each other through the schema migration.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "stream TEXT NOT NULL, "
+                "seq INTEGER NOT NULL, "
+                "ts REAL NOT NULL, "
+                "entry TEXT NOT NULL, "
+                "PRIMARY KEY (stream, seq)"
+                ")"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(entries)")]
+            if 'hash' not in columns:
+                conn.execute("ALTER TABLE entries ADD COLUMN hash BLOB")
+            version = conn.execute("SELECT value FROM meta WHERE key = 'hash'").fetchone()
+            if version is None or version[0] != _HASH_VERSION:
+                rows = conn.execute("SELECT rowid, entry FROM entries").fetchall()
+                conn.executemany(
+                    "UPDATE entries SET hash = ? WHERE rowid = ?",
+                    [(entry_hash(entry), rowid) for rowid, entry in rows],
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('hash', ?)", (_HASH_VERSION,)
+                )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_hash ON entries (stream, hash)")
+            conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)",
+                (uuid.uuid4().hex,),
+            )
+            self.epoch = conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.close()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def load(self, stream):
+        """Return ``(seq, entry)`` pairs for every stored entry."""
+        return self.load_since(stream, 0)
+
+    def load_since(self, stream, seq):
+        """Return ``(seq, entry)`` pairs stored after ``seq``."""
+        return self.read(stream, seq)
+
+    def read(self, stream, after, limit=None, until=None):
+        """Return up to ``limit`` ``(seq, entry)`` pairs with ``after < seq <= until``."""
+        sql = "SELECT seq, entry FROM entries WHERE stream = ? AND seq > ?"
+        params = [stream, after]
+        if until is not None:
+            sql += " AND seq <= ?"
+            params.append(until)
+        sql += " ORDER BY seq"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._reader().execute(sql, params).fetchall()
+
+    def get(self, stream, seqs):
+        """Return the ``(seq, entry)`` pairs stored under ``seqs``."""
+        wanted = sorted(set(seqs))
+        found = []
+        for i in range(0, len(wanted), 500):
+            chunk = wanted[i:i + 500]
+            found.extend(self._reader().execute(
+                "SELECT seq, entry FROM entries WHERE stream = ? AND seq IN (%s) ORDER BY seq"
+                % ','.join('?' * len(chunk)),
+                [stream] + chunk,
+            ).fetchall())
+        return found
+
+    def read_tail(self, stream, count, before):
+        """Return the newest ``count`` pairs whose seq is below ``before``."""
+        rows = self._reader().execute(
+            "SELECT seq, entry FROM entries WHERE stream = ? AND seq < ? "
+            "ORDER BY seq DESC LIMIT ?",
+            (stream, before, count),
+        ).fetchall()
+        return rows[::-1]
+
+    def compact(self, stream, keep, before=None):
+        """Delete entries for which ``keep(seq, entry)`` is False.
+
+        Only entries stored before ``before`` (a UNIX time) are considered.
+        Returns the dropped ``(seq, entry)`` pairs.
+        """
+        sql = ("SELECT seq, entry FROM entries WHERE stream = ? "
+               "AND seq < (SELECT MAX(seq) FROM entries WHERE stream = ?)")
+        params = [stream, stream]
+        if before is not None:
+            sql += " AND ts < ?"
+            params.append(before)
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+            dropped = [(seq, entry) for seq, entry in rows if not keep(seq, entry)]
+            if dropped:
+                with conn:
+                    conn.executemany(
+                        "DELETE FROM entries WHERE stream = ? AND seq = ?",
+                        [(stream, seq) for seq, _ in dropped],
+                    )
+                    # Other processes caching the stream reload when it moves.
+                    conn.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES (?, "
+                        "COALESCE((SELECT CAST(value AS INTEGER) FROM meta WHERE key = ?), 0) + 1)",
+                        (f'compacted:{stream}', f'compacted:{stream}'),
+                    )
+        finally:
+            conn.close()
+        return dropped
+
+    def generation(self, stream):
+        """Return how many compactions have removed entries from ``stream``."""
+        row = self._reader().execute(
+            "SELECT value FROM meta WHERE key = ?", (f'compacted:{stream}',)
+        ).fetchone()
+        return int(row[0]) if row else 0
+
+    def is_empty(self, stream):
+        row = self._reader().execute(
+            "SELECT 1 FROM entries WHERE stream = ? LIMIT 1", (stream,)
+        ).fetchone()
+        return row is None
+
+    def import_entries(self, stream, pairs):
+        """Copy ``(seq, entry)`` pairs into ``stream`` in a single transaction."""
+        now = time.time()
+        rows = [(stream, seq, now, entry, entry_hash(entry)) for seq, entry in pairs]
+        if not rows:
+            return 0
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO entries (stream, seq, ts, entry, hash) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+        finally:
+            conn.close()
+        return len(rows)
+
+    def append(self, stream, records):
+        """Queue ``(seq, ts, entry)`` records for the next group commit."""
+        return self.append_many([(stream, records)])
+
+    def append_many(self, batches):
+        """Queue ``(stream, records)`` batches to be committed together."""
+        pending = _Pending()
+        self._queue.put(('records', batches, pending))
+        return pending
+
+    def insert_many(self, batches, dedup=False):
+        """Queue ``(stream, entries)`` batches and number them in the commit.
+
+        With ``dedup`` entries whose content is already stored are skipped.
+        ``wait()`` on the result returns the number of entries written.
+        """
+        pending = _Pending()
+        self._queue.put(('dedup' if dedup else 'entries', batches, pending))
+        return pending
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        size = sum(len(records) for _, records in first[1])
+        deadline = time.monotonic() + self.commit_delay
+        while size < self.batch_size:
+            try:
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+            size += sum(len(records) for _, records in item[1])
+        return batch
+
+    def _write_records(self, conn, stream, records):
+        conn.executemany(
+            "INSERT OR IGNORE INTO entries (stream, seq, ts, entry, hash) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(stream, seq, ts, entry, entry_hash(entry)) for seq, ts, entry in records],
+        )
+        return len(records)
+
+    def _write_entries(self, conn, stream, entries, dedup, now):
+        seq = conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM entries WHERE stream = ?", (stream,)
+        ).fetchone()[0]
+        rows = []
+        seen = set()
+        for entry in entries:
+            key = entry_hash(entry)
+            if dedup:
+                if key in seen or conn.execute(
+                    "SELECT 1 FROM entries WHERE stream = ? AND hash = ? LIMIT 1",
+                    (stream, key),
+                ).fetchone():
+                    continue
+                seen.add(key)
+            seq += 1
+            rows.append((stream, seq, now, entry, key))
+        conn.executemany(
+            "INSERT INTO entries (stream, seq, ts, entry, hash) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        return len(rows)
+
+    def _write_loop(self):
+        conn = self._connect()
+        conn.isolation_level = None
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            written = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                now = time.time()
+                for kind, batches, _ in batch:
+                    count = 0
+                    for stream, items in batches:
+                        if kind == 'records':
+                            count += self._write_records(conn, stream, items)
+                        else:
+                            count += self._write_entries(conn, stream, items, kind == 'dedup', now)
+                    written.append(count)
+                conn.execute("COMMIT")
+            except Exception as exc:
+                try:
+                    conn.execute("ROLLBACK")
+                except Exception:
+                    pass
+                # The whole group commit is undone; every writer in it hears.
+                for _, _, pending in batch:
+                    pending.fail(exc)
+                continue
+            for (_, _, pending), count in zip(batch, written):
+                pending.set(count)
+        conn.close()
+
+    def close(self):
+        """Flush queued records and stop the writer thread."""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+
+def open_store(kind, paths, db_path=None, segment_bytes=0, **options):
+    """Return the storage engine named by ``kind``.
+
+    ``paths`` maps stream names to their flat log files. The SQLite engine
+    imports those files into any stream that is still empty, so switching
+    an existing server over keeps its history. ``segment_bytes`` sets the
+    rotation size of the file engine, which keeps its epoch in
+    ``clone_store.epoch`` beside the first stream file.
+    """
+    if kind == 'sqlite':
+        store = SQLiteStore(db_path or 'clone_streams.db', **options)
+        for stream, path in paths.items():
+            if store.is_empty(stream):
+                store.import_entries(stream, FileStore({stream: path}).load(stream))
+        return store
+    folder = os.path.dirname(next(iter(paths.values()), '')) or '.'
+    return FileStore(paths, segment_bytes=segment_bytes,
+                     epoch_path=os.path.join(folder, 'clone_store.epoch'))
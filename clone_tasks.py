@@ -0,0 +1,468 @@
+"""Persistent, lease-based task queue for the clone network."""
+
+import heapq
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+_TASK_ENTRY = re.compile(r"^([0-9a-f]{32}): (.*)$", re.DOTALL)
+_TASK_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def is_task_id(value):
+    """Return True if ``value`` is a well-formed task id."""
+    return isinstance(value, str) and _TASK_ID.fullmatch(value) is not None
+
+
+def split_task(entry, legacy_id):
+    """Return ``(task_id, task)`` for a stored tasks stream entry.
+
+    Entries are written as ``"<task_id>: <task>"``. Older logs hold the bare
+    task text, in which case ``legacy_id(entry)`` supplies a stable id.
+    """
+    match = _TASK_ENTRY.match(entry)
+    if match:
+        return match.group(1), match.group(2)
+    return legacy_id(entry), entry
+
+
+class TaskQueue:
+    """Queue of tasks that move from queued to leased to done.
+
+    Dequeue is O(1). Leases expire after ``lease_seconds`` and the task
+    goes back to the front of the queue unless the worker acked it first.
+    Every lease and ack is journalled to the ``journal`` stream of the
+    store, so a restart resumes with the same state instead of handing
+    out every task again.
+
+    Only unfinished tasks keep their text in memory; a finished one is
+    remembered by id alone.
+
+    With ``owns`` set only tasks for which ``owns(task_id)`` is True are
+    handed out. The others wait in a separate list, in arrival order, until
+    ``rebalance`` finds they moved to this server or an ack finishes them.
+    """
+
+    def __init__(self, store, journal='task_events', lease_seconds=300, owns=None):
+        self.store = store
+        self.journal = journal
+        self.lease_seconds = lease_seconds
+        self.owns = owns
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.done = set()
+        self.leases = {}
+        self._queue = deque()
+        self._queued = set()
+        self._foreign = {}
+        self._expiry = []
+        self._seq = 0
+        self._replay()
+
+    def _replay(self):
+        events = self.store.load(self.journal)
+        if events:
+            self._seq = events[-1][0]
+        for _, event in events:
+            op, _, rest = event.partition(' ')
+            if op == 'lease':
+                parts = rest.split(' ', 2)
+                owner = parts[2] if len(parts) > 2 else ''
+                self.leases[parts[0]] = (float(parts[1]), owner)
+            elif op == 'done':
+                self.done.add(rest)
+                self.leases.pop(rest, None)
+        for task_id, (expires, _) in self.leases.items():
+            heapq.heappush(self._expiry, (expires, task_id))
+
+    def _record(self, event):
+        # Caller holds self.lock so journal order matches state order.
+        self._seq += 1
+        return self.store.append(self.journal, [(self._seq, time.time(), event)])
+
+    def _enqueue(self, task_id, front=False):
+        # Caller holds self.lock.
+        if self.owns is not None and not self.owns(task_id):
+            self._foreign[task_id] = None
+        elif front:
+            self._queue.appendleft(task_id)
+            self._queued.add(task_id)
+        else:
+            self._queue.append(task_id)
+            self._queued.add(task_id)
+
+    def _requeue_expired(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires, task_id = heapq.heappop(self._expiry)
+            lease = self.leases.get(task_id)
+            if lease and lease[0] == expires:
+                del self.leases[task_id]
+                self._enqueue(task_id, front=True)
+
+    def add(self, task_id, task):
+        """Queue a task unless it is already known. Returns True if added."""
+        with self.lock:
+            if task_id in self.tasks:
+                return False
+            if task_id in self.done:
+                self.tasks[task_id] = None
+                return True
+            self.tasks[task_id] = task
+            if task_id not in self.leases:
+                self._enqueue(task_id)
+            return True
+
+    def add_many(self, items):
+        """Queue several ``(task_id, task)`` pairs. Returns the number added."""
+        return sum(1 for task_id, task in items if self.add(task_id, task))
+
+    def lease(self, owner=''):
+        """Lease the next task to ``owner``.
+
+        Returns ``(task_id, task, expires)`` or None when nothing is queued.
+        """
+        owner = '_'.join(str(owner).split())
+        now = time.time()
+        with self.lock:
+            self._requeue_expired(now)
+            while self._queue:
+                task_id = self._queue.popleft()
+                if task_id not in self._queued:
+                    continue
+                self._queued.discard(task_id)
+                expires = now + self.lease_seconds
+                self.leases[task_id] = (expires, owner)
+                heapq.heappush(self._expiry, (expires, task_id))
+                pending = self._record(f"lease {task_id} {expires:.3f} {owner}")
+                break
+            else:
+                return None
+        pending.wait()
+        return task_id, self.tasks[task_id], expires
+
+    def ack(self, task_id):
+        """Mark a task done. Returns False if it was already done."""
+        with self.lock:
+            if task_id in self.done:
+                return False
+            self.done.add(task_id)
+            if task_id in self.tasks:
+                self.tasks[task_id] = None
+            self.leases.pop(task_id, None)
+            self._queued.discard(task_id)
+            self._foreign.pop(task_id, None)
+            pending = self._record(f"done {task_id}")
+        pending.wait()
+        return True
+
+    def is_done(self, task_id):
+        with self.lock:
+            return task_id in self.done
+
+    def rebalance(self):
+        """Re-sort queued tasks after the set of owners changed.
+
+        Tasks that moved here join the end of the queue; tasks that moved
+        away wait with the other foreign ones. Leases already handed out are
+        kept until they are acked or expire.
+        """
+        if self.owns is None:
+            return
+        with self.lock:
+            queued = [task_id for task_id in self._queue if task_id in self._queued]
+            waiting = list(self._foreign)
+            self._queue = deque()
+            self._queued = set()
+            self._foreign = {}
+            for task_id in queued + waiting:
+                self._enqueue(task_id)
+
+    def next_foreign(self):
+        """Return the oldest queued task owned by another server, or None."""
+        with self.lock:
+            return next(iter(self._foreign), None)
+
+    def adopt(self, task_id):
+        """Take over a queued task whose owner does not answer.
+
+        It moves to the front of this server's queue until a rebalance.
+        """
+        with self.lock:
+            if task_id in self._foreign:
+                del self._foreign[task_id]
+                self._queue.appendleft(task_id)
+                self._queued.add(task_id)
+
+    def forget(self, task_ids):
+        """Drop finished tasks whose entries were compacted away.
+
+        Their ids stay in ``done`` until ``compact`` drops the matching
+        journal events, so a copy fetched back from a peer is not run again.
+        """
+        with self.lock:
+            for task_id in task_ids:
+                if task_id in self.done:
+                    self.tasks.pop(task_id, None)
+
+    def compact(self, tombstone_before):
+        """Shrink the journal to a snapshot of the current queue state.
+
+        Lease events that were superseded are dropped. ``done`` events of
+        forgotten tasks are dropped once their journal segment is older than
+        ``tombstone_before``. Returns the number of events dropped.
+        """
+        def current(event):
+            op, _, rest = event.partition(' ')
+            if op != 'lease':
+                return True
+            parts = rest.split(' ', 2)
+            lease = self.leases.get(parts[0])
+            return lease is not None and f"{lease[0]:.3f}" == parts[1]
+
+        expired = []
+
+        def live(seq, event):
+            op, _, rest = event.partition(' ')
+            if op == 'done' and rest not in self.tasks:
+                expired.append(rest)
+                return False
+            return current(event)
+
+        with self.lock:
+            dropped = len(self.store.compact(self.journal, lambda seq, event: current(event)))
+            dropped += len(self.store.compact(self.journal, live, before=tombstone_before))
+            self.done.difference_update(expired)
+        return dropped
+
+    def stats(self):
+        """Return the number of queued, leased and finished tasks.
+
+        ``foreign`` counts the queued tasks owned by other servers.
+        """
+        with self.lock:
+            self._requeue_expired(time.time())
+            return {
+                'queued': len(self._queued),
+                'leased': len(self.leases),
+                'done': len(self.done),
+                'foreign': len(self._foreign),
+            }
+
+
+class SharedTaskQueue:
+    """TaskQueue kept in SQLite so several processes can share it.
+
+    Every transition runs in its own write transaction, so two workers can
+    never lease the same task. Adding a task that is already known is a
+    no-op, which lets every process feed in the tasks it sees. ``owns``
+    works as for TaskQueue. Whether this server owns a task is stored with
+    it and worked out again by ``rebalance``, so a lease finds the oldest
+    owned task through an index however many foreign tasks are queued.
+    """
+
+    def __init__(self, path, lease_seconds=300, owns=None):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.owns = owns
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "id TEXT PRIMARY KEY, "
+                "task TEXT, "
+                "state TEXT NOT NULL, "
+                "owner TEXT, "
+                "expires REAL"
+                ")"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, expires)")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(tasks)")]
+            if 'owned' not in columns:
+                conn.execute("ALTER TABLE tasks ADD COLUMN owned INTEGER NOT NULL DEFAULT 1")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_owned ON tasks (state, owned)")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, fn):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def is_empty(self):
+        return self._conn().execute("SELECT 1 FROM tasks LIMIT 1").fetchone() is None
+
+    def import_journal(self, events):
+        """Apply lease and done events written by a single-process TaskQueue."""
+        def apply(conn):
+            for _, event in events:
+                op, _, rest = event.partition(' ')
+                if op == 'lease':
+                    parts = rest.split(' ', 2)
+                    owner = parts[2] if len(parts) > 2 else ''
+                    conn.execute(
+                        "INSERT INTO tasks (id, state, owner, expires) VALUES (?, 'leased', ?, ?) "
+                        "ON CONFLICT(id) DO UPDATE SET state='leased', owner=excluded.owner, "
+                        "expires=excluded.expires WHERE state != 'done'",
+                        (parts[0], owner, float(parts[1])),
+                    )
+                elif op == 'done':
+                    conn.execute(
+                        "INSERT INTO tasks (id, state) VALUES (?, 'done') "
+                        "ON CONFLICT(id) DO UPDATE SET state='done'",
+                        (rest,),
+                    )
+        self._write(apply)
+
+    def add(self, task_id, task):
+        """Queue a task unless it is already known. Returns True if added."""
+        return self.add_many([(task_id, task)]) > 0
+
+    def add_many(self, items):
+        """Queue several ``(task_id, task)`` pairs in one transaction."""
+        def insert(conn):
+            added = 0
+            for task_id, task in items:
+                cur = conn.execute(
+                    "INSERT INTO tasks (id, task, state, owned) VALUES (?, ?, 'queued', ?) "
+                    "ON CONFLICT(id) DO UPDATE SET task=excluded.task WHERE task IS NULL",
+                    (task_id, task, self._owned(task_id)),
+                )
+                added += cur.rowcount
+            return added
+        return self._write(insert)
+
+    def lease(self, owner=''):
+        """Lease the next task to ``owner``.
+
+        Expired leases are handed out before never-leased tasks. Returns
+        ``(task_id, task, expires)`` or None when nothing is queued.
+        """
+        owner = '_'.join(str(owner).split())
+        now = time.time()
+
+        def take(conn):
+            row = conn.execute(
+                "SELECT id, task FROM tasks WHERE state = 'leased' AND expires <= ? "
+                "AND owned = 1 AND task IS NOT NULL ORDER BY expires LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                row = conn.execute(
+                    "SELECT id, task FROM tasks WHERE state = 'queued' AND owned = 1 "
+                    "AND task IS NOT NULL ORDER BY rowid LIMIT 1"
+                ).fetchone()
+            if row is None:
+                return None
+            expires = now + self.lease_seconds
+            conn.execute(
+                "UPDATE tasks SET state = 'leased', owner = ?, expires = ? WHERE id = ?",
+                (owner, expires, row[0]),
+            )
+            return row[0], row[1], expires
+        return self._write(take)
+
+    def _owned(self, task_id):
+        return 1 if self.owns is None or self.owns(task_id) else 0
+
+    def ack(self, task_id):
+        """Mark a task done. Returns False if it was already done."""
+        now = time.time()
+
+        def finish(conn):
+            cur = conn.execute(
+                "INSERT INTO tasks (id, state, expires) VALUES (?, 'done', ?) "
+                "ON CONFLICT(id) DO UPDATE SET state = 'done', expires = excluded.expires "
+                "WHERE state != 'done'",
+                (task_id, now),
+            )
+            return cur.rowcount > 0
+        return self._write(finish)
+
+    def is_done(self, task_id):
+        row = self._conn().execute("SELECT state FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return row is not None and row[0] == 'done'
+
+    def rebalance(self):
+        """Work out again which unfinished tasks this server owns."""
+        if self.owns is None:
+            return
+
+        def update(conn):
+            changed = []
+            for task_id, owned in conn.execute(
+                    "SELECT id, owned FROM tasks WHERE state != 'done'").fetchall():
+                now_owned = self._owned(task_id)
+                if now_owned != owned:
+                    changed.append((now_owned, task_id))
+            conn.executemany("UPDATE tasks SET owned = ? WHERE id = ?", changed)
+        self._write(update)
+
+    def next_foreign(self):
+        """Return the oldest queued task owned by another server, or None."""
+        if self.owns is None:
+            return None
+        row = self._conn().execute(
+            "SELECT id FROM tasks WHERE state = 'queued' AND owned = 0 "
+            "AND task IS NOT NULL ORDER BY rowid LIMIT 1"
+        ).fetchone()
+        return row[0] if row else None
+
+    def adopt(self, task_id):
+        """Take over a queued task whose owner does not answer."""
+        def take_over(conn):
+            conn.execute(
+                "UPDATE tasks SET owned = 1 WHERE id = ? AND state = 'queued'", (task_id,)
+            )
+        self._write(take_over)
+
+    def forget(self, task_ids):
+        """Drop the text of finished tasks, keeping their ids as tombstones."""
+        def clear(conn):
+            conn.executemany(
+                "UPDATE tasks SET task = NULL WHERE id = ? AND state = 'done'",
+                [(task_id,) for task_id in task_ids],
+            )
+        self._write(clear)
+
+    def compact(self, tombstone_before):
+        """Delete tombstones of tasks finished before ``tombstone_before``."""
+        def purge(conn):
+            return conn.execute(
+                "DELETE FROM tasks WHERE state = 'done' AND task IS NULL "
+                "AND (expires IS NULL OR expires < ?)",
+                (tombstone_before,),
+            ).rowcount
+        return self._write(purge)
+
+    def stats(self):
+        """Return the number of queued, leased and finished tasks."""
+        now = time.time()
+        counts = {'queued': 0, 'leased': 0, 'done': 0}
+        rows = self._conn().execute(
+            "SELECT CASE WHEN state = 'leased' AND expires <= ? THEN 'queued' ELSE state END, "
+            "COUNT(*) FROM tasks WHERE task IS NOT NULL OR state = 'done' GROUP BY 1",
+            (now,),
+        ).fetchall()
+        for state, count in rows:
+            counts[state] = counts.get(state, 0) + count
+        return counts
@@ -4,6 +4,8 @@ import subprocess
 import requests
 import psutil
 
+from clone_record import make
+
 def _load_endpoints():
     env = os.getenv('CLONE_ENDPOINTS')
     if env:
@@ -23,17 +25,24 @@ def fetch_task():
             resp = requests.get(f"{url}/task/assign", params={'id': CLONE_ID}, timeout=5)
             if resp.ok:
                 data = resp.json()
-                return data.get('task')
+                return data.get('task'), data.get('task_id')
         except Exception as e:
             print(f"error fetching task from {url}: {e}")
             ENDPOINTS.remove(url)
-    return None
+    return None, None
 
 
-def report_result(result):
+def report_result(result, task_id=None):
+    """Send ``result`` to every endpoint as one record, so it is stored once."""
+    fields = {'text': result}
+    if task_id:
+        fields['task_id'] = task_id
+    payload = {'id': CLONE_ID, 'result': result, 'record': make('results', CLONE_ID, fields)}
+    if task_id:
+        payload['task_id'] = task_id
     for url in list(ENDPOINTS):
         try:
-            requests.post(f"{url}/task/result", json={'id': CLONE_ID, 'result': result}, timeout=5)
+            requests.post(f"{url}/task/result", json=payload, timeout=5)
         except Exception as e:
             print(f"error reporting result to {url}: {e}")
             ENDPOINTS.remove(url)
@@ -43,13 +52,13 @@ def main():
     while True:
         cpu = psutil.cpu_percent(interval=1)
         if cpu < CPU_THRESHOLD:
-            task = fetch_task()
+            task, task_id = fetch_task()
             if task:
                 try:
                     output = subprocess.check_output(task, shell=True, text=True, timeout=60)
                 except subprocess.CalledProcessError as e:
                     output = e.output
-                report_result(output)
+                report_result(output, task_id)
         time.sleep(CHECK_INTERVAL)
 
 
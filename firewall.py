@@ -1,5 +1,12 @@
 import os
 import re
+import threading
+import time
+
+try:
+    from re import _parser as _sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse as _sre_parse
 
 DEFAULT_PATTERNS = [
     r"sk-[A-Za-z0-9]{32,}",  # OpenAI style keys
@@ -10,18 +17,117 @@ DEFAULT_PATTERNS = [
     r"token",
 ]
 
+BLOCKED = "[BLOCKED]"
+
 _custom = os.getenv("FIREWALL_PATTERNS")
-if _custom:
-    CUSTOM_PATTERNS = [p.strip() for p in _custom.split(',') if p.strip()]
-    PATTERNS = [re.compile(p, re.IGNORECASE) for p in (CUSTOM_PATTERNS + DEFAULT_PATTERNS)]
-else:
-    PATTERNS = [re.compile(p, re.IGNORECASE) for p in DEFAULT_PATTERNS]
+CUSTOM_PATTERNS = [p.strip() for p in _custom.split(',') if p.strip()] if _custom else []
+
+# One extra regex per line ('#' starts a comment). The file is checked for
+# changes every FIREWALL_RELOAD_INTERVAL seconds, so patterns can be changed
+# without restarting the server.
+PATTERNS_FILE = os.getenv("FIREWALL_PATTERNS_FILE", "firewall_patterns.txt")
+RELOAD_INTERVAL = float(os.getenv("FIREWALL_RELOAD_INTERVAL", "2"))
+
+
+def _literal(pattern):
+    """Return lowercase ASCII text every match of ``pattern`` starts with.
+
+    Returns '' when the pattern does not start with a plain literal, in which
+    case it is always run.
+    """
+    try:
+        parsed = _sre_parse.parse(pattern, re.IGNORECASE)
+    except Exception:
+        return ''
+    chars = []
+    for op, value in parsed:
+        if op is _sre_parse.AT and not chars:
+            continue
+        if op is not _sre_parse.LITERAL or value > 127:
+            break
+        chars.append(chr(value))
+    return ''.join(chars).lower()
+
+
+def _compile(patterns):
+    """Return the ``(regex, literal)`` rules for ``patterns``, in order."""
+    return tuple((re.compile(p, re.IGNORECASE), _literal(p)) for p in patterns)
+
+
+def _apply(rules, text):
+    """Run every rule over ``text`` in order, as separate substitutions would.
+
+    For ASCII text a rule is skipped when its literal is not in the text:
+    it cannot match, so its substitution would change nothing. Clean text
+    is therefore lowercased once and searched for a few substrings instead
+    of being scanned by every regex.
+    """
+    if not text.isascii():
+        for regex, _ in rules:
+            text = regex.sub(BLOCKED, text)
+        return text
+    lowered = text.lower()
+    for regex, literal in rules:
+        if literal and literal not in lowered:
+            continue
+        text, count = regex.subn(BLOCKED, text)
+        if count:
+            lowered = text.lower()
+    return text
+
+
+def _read_patterns_file(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+_lock = threading.Lock()
+_file_state = None
+_next_check = 0.0
+_rules = _compile(CUSTOM_PATTERNS + DEFAULT_PATTERNS)
+PATTERNS = [regex for regex, _ in _rules]
+
+
+def reload_patterns(force=False):
+    """Load the patterns file again if it changed since it was last read.
+
+    Returns True when the pattern set changed. A file with an invalid regex
+    is ignored and the current patterns stay in place.
+    """
+    global _file_state, _rules, PATTERNS
+    with _lock:
+        try:
+            stat = os.stat(PATTERNS_FILE)
+            state = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            state = None
+        if state == _file_state and not force:
+            return False
+        try:
+            extra = _read_patterns_file(PATTERNS_FILE) if state else []
+            rules = _compile(CUSTOM_PATTERNS + extra + DEFAULT_PATTERNS)
+        except (OSError, re.error):
+            return False
+        _file_state = state
+        _rules = rules
+        PATTERNS = [regex for regex, _ in rules]
+        return True
+
+
+def _maybe_reload():
+    global _next_check
+    now = time.monotonic()
+    if RELOAD_INTERVAL >= 0 and now >= _next_check:
+        _next_check = now + RELOAD_INTERVAL
+        reload_patterns()
+
+
+reload_patterns()
+
 
 def sanitize_text(text: str) -> str:
     """Replace sensitive patterns with [BLOCKED]."""
     if not text:
         return text
-    result = text
-    for pat in PATTERNS:
-        result = pat.sub("[BLOCKED]", result)
-    return result
+    _maybe_reload()
+    return _apply(_rules, text)